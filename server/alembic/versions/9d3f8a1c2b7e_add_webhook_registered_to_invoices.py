@@ -0,0 +1,28 @@
+"""Add webhook_registered to invoices table
+
+Revision ID: 9d3f8a1c2b7e
+Revises: 3ec897840ea4
+Create Date: 2026-10-18 10:12:41.532876
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9d3f8a1c2b7e'
+down_revision = '3ec897840ea4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'invoices',
+        sa.Column('webhook_registered',
+                  sa.Boolean,
+                  default=True,
+                  server_default='1'))
+
+
+def downgrade():
+    op.drop_column('invoices', 'webhook_registered')
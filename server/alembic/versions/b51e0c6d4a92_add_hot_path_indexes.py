@@ -0,0 +1,40 @@
+"""Add indexes on the columns used by the hot queries
+
+Revision ID: b51e0c6d4a92
+Revises: 9d3f8a1c2b7e
+Create Date: 2026-10-18 14:03:27.118264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b51e0c6d4a92'
+down_revision = '9d3f8a1c2b7e'
+branch_labels = None
+depends_on = None
+
+indexes = [
+    ('ix_orders_uuid', 'orders', ['uuid'], False),
+    ('ix_orders_status_channel_bid_per_byte', 'orders',
+     ['status', 'channel', sa.text('bid_per_byte DESC')], False),
+    ('ix_invoices_lid', 'invoices', ['lid'], True),
+    ('ix_invoices_order_id', 'invoices', ['order_id'], False),
+    ('ix_invoices_status_expires_at', 'invoices', ['status',
+                                                   'expires_at'], False),
+    ('ix_tx_confirmations_order_id_region_id', 'tx_confirmations',
+     ['order_id', 'region_id'], False),
+    ('ix_rx_confirmations_order_id_region_id', 'rx_confirmations',
+     ['order_id', 'region_id'], False),
+    ('ix_tx_retries_order_id', 'tx_retries', ['order_id'], False),
+]
+
+
+def upgrade():
+    for name, table, columns, unique in indexes:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    for name, table, _, _ in reversed(indexes):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,55 @@
+"""Add pending_invoices to orders table
+
+Revision ID: e2a7c4f19b35
+Revises: b51e0c6d4a92
+Create Date: 2026-10-18 16:24:09.730412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c4f19b35'
+down_revision = 'b51e0c6d4a92'
+branch_labels = None
+depends_on = None
+
+# See constants.InvoiceStatus
+PENDING_INVOICE_STATUS = 0
+PAID_INVOICE_STATUS = 1
+# Over-the-air message length (see bidding.calc_ota_msg_len)
+OTA_MSG_LEN = "(message_size + 52 * ((message_size + 1463) / 1464))"
+
+
+def upgrade():
+    op.add_column(
+        'orders',
+        sa.Column('pending_invoices',
+                  sa.Integer,
+                  nullable=False,
+                  default=0,
+                  server_default='0'))
+    # Rebuild all the bid aggregates from the invoices, given that they are
+    # maintained incrementally from now on
+    op.execute(f"""
+        UPDATE orders SET
+            pending_invoices = (
+                SELECT COUNT(*) FROM invoices
+                WHERE invoices.order_id = orders.id
+                AND invoices.status = {PENDING_INVOICE_STATUS}),
+            unpaid_bid = (
+                SELECT COALESCE(SUM(amount), 0) FROM invoices
+                WHERE invoices.order_id = orders.id
+                AND invoices.status = {PENDING_INVOICE_STATUS}),
+            bid = (
+                SELECT COALESCE(SUM(amount), 0) FROM invoices
+                WHERE invoices.order_id = orders.id
+                AND invoices.status = {PAID_INVOICE_STATUS})
+        WHERE EXISTS (
+            SELECT 1 FROM invoices WHERE invoices.order_id = orders.id)
+    """)
+    op.execute(f"UPDATE orders SET bid_per_byte = bid * 1.0 / {OTA_MSG_LEN}")
+
+
+def downgrade():
+    op.drop_column('orders', 'pending_invoices')
@@ -0,0 +1,28 @@
+"""Add counters table
+
+Revision ID: f3d81b6c5a20
+Revises: e2a7c4f19b35
+Create Date: 2026-10-18 18:02:37.514208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f3d81b6c5a20'
+down_revision = 'e2a7c4f19b35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('counters',
+                    sa.Column('name', sa.String(32), primary_key=True),
+                    sa.Column('value', sa.Integer, nullable=False, default=0))
+    # Continue the Tx sequence numbers from the last assigned one
+    op.execute("INSERT INTO counters (name, value) "
+               "SELECT 'tx_seq_num', COALESCE(MAX(tx_seq_num), 0) FROM orders")
+
+
+def downgrade():
+    op.drop_table('counters')
@@ -50,6 +50,19 @@ errors = {
     'ORDER_CHANNEL_UNAUTHORIZED_OP': (130, "Unauthorized channel operation",
                                       "Operation not supported on channel {}",
                                       HTTPStatus.UNAUTHORIZED),
+    'UPLOAD_SESSION_NOT_FOUND': (131, "Upload session not found",
+                                 "Upload session {} not found",
+                                 HTTPStatus.NOT_FOUND),
+    'UPLOAD_OFFSET_MISMATCH': (132, "Upload offset mismatch",
+                               "The upload session is at offset {}",
+                               HTTPStatus.CONFLICT),
+    'UPLOAD_INCOMPLETE': (133, "Upload incomplete",
+                          "Received {} of the {} bytes of the message",
+                          HTTPStatus.BAD_REQUEST),
+    'MESSAGE_DIGEST_MISMATCH':
+    (134, "Message upload problem",
+     "The SHA256 digest of the uploaded message is {}",
+     HTTPStatus.BAD_REQUEST),
 }
 
 
@@ -1,20 +1,95 @@
 from http import HTTPStatus
+import threading
+import time
+
 import requests
 
 from error import get_http_error_resp
+from flask import current_app
 from flask_restful import Resource
-import constants
+import lightning_charge
+
+
+def fetch_info():
+    """Fetch the Lightning node information from Lightning Charge
+
+    Returns:
+        The node information or None on failure.
+
+    """
+    try:
+        info_response = lightning_charge.get("/info")
+    except requests.exceptions.RequestException:
+        return None
+    if info_response.status_code != HTTPStatus.OK:
+        return None
+    return info_response.json()
+
+
+class InfoCache:
+    """Cache of the Lightning node information
+
+    The cached information is served as is while fresh, i.e., within the TTL.
+    Once stale, it is still served for a grace period while refreshed in the
+    background, so that the requests do not wait for Lightning Charge. When
+    Lightning Charge is unreachable, the last good information keeps being
+    served until the end of the grace period.
+
+    Args:
+        ttl (float): Time to live in seconds.
+        grace_period (float): Period in seconds after the TTL during which
+            the stale information can still be served.
+
+    """
+
+    def __init__(self, ttl, grace_period):
+        self.ttl = ttl
+        self.grace_period = grace_period
+        self.info = None
+        self.fetched_at = None
+        self.refresh_thread = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Fetch the information and update the cache if successful"""
+        info = fetch_info()
+        if info is not None:
+            with self._lock:
+                self.info = info
+                self.fetched_at = time.monotonic()
+        return info
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self.refresh_thread is not None and \
+                    self.refresh_thread.is_alive():
+                return
+            self.refresh_thread = threading.Thread(target=self.refresh,
+                                                   daemon=True)
+            self.refresh_thread.start()
+
+    def get(self):
+        """Get the node information
+
+        Returns:
+            The node information or None if unavailable.
+
+        """
+        if self.info is not None:
+            age = time.monotonic() - self.fetched_at
+            if age < self.ttl:
+                return self.info
+            if age < self.ttl + self.grace_period:
+                self._refresh_in_background()
+                return self.info
+
+        return self.refresh()
 
 
 class InfoResource(Resource):
 
     def get(self):
-        try:
-            info_response = requests.get(f"{constants.CHARGE_ROOT}/info",
-                                         timeout=(constants.CONNECTION_TIMEOUT,
-                                                  constants.RESPONSE_TIMEOUT))
-            if info_response.status_code != HTTPStatus.OK:
-                return get_http_error_resp('LIGHTNING_CHARGE_INFO_FAILED')
-            return info_response.json(), HTTPStatus.OK
-        except requests.exceptions.RequestException:
+        info = current_app.config['INFO_CACHE'].get()
+        if info is None:
             return get_http_error_resp('LIGHTNING_CHARGE_INFO_FAILED')
+        return info, HTTPStatus.OK
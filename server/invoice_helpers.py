@@ -1,15 +1,19 @@
 from http import HTTPStatus
 import datetime
+import logging
 import requests
 
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, select
 
-from constants import InvoiceStatus
+from constants import InvoiceStatus, OrderStatus
 import constants
+import lightning_charge
+import scheduler
 from database import db
 from error import get_http_error_resp
-from models import Invoice
-from order_helpers import maybe_mark_order_as_expired, maybe_mark_order_as_paid
+from models import Invoice, Order
+from order_helpers import maybe_mark_order_as_paid, mark_orders_as_expired, \
+    remove_message_files, update_bids
 from utils import hmac_sha256_digest
 
 
@@ -28,22 +32,17 @@ def new_invoice(order, bid):
     try:
         bid = int(bid)
         # generate Lightning invoice
-        charged_response = requests.post(f"{constants.CHARGE_ROOT}/invoice",
-                                         json={
-                                             'msatoshi': bid,
-                                             'description':
-                                             constants.LN_INVOICE_DESCRIPTION,
-                                             'expiry':
-                                             constants.LN_INVOICE_EXPIRY,
-                                             'metadata': {
-                                                 'uuid':
-                                                 order.uuid,
-                                                 'sha256_message_digest':
-                                                 order.message_digest
-                                             }
-                                         },
-                                         timeout=(constants.CONNECTION_TIMEOUT,
-                                                  constants.RESPONSE_TIMEOUT))
+        charged_response = lightning_charge.post(
+            "/invoice",
+            json={
+                'msatoshi': bid,
+                'description': constants.LN_INVOICE_DESCRIPTION,
+                'expiry': constants.LN_INVOICE_EXPIRY,
+                'metadata': {
+                    'uuid': order.uuid,
+                    'sha256_message_digest': order.message_digest
+                }
+            })
     except requests.exceptions.RequestException:
         return False, get_http_error_resp('LIGHTNING_CHARGE_INVOICE_ERROR')
     except ValueError:
@@ -64,29 +63,138 @@ def new_invoice(order, bid):
                       expires_at=datetime.datetime.utcnow() +
                       datetime.timedelta(seconds=constants.LN_INVOICE_EXPIRY))
 
-    try:
-        # register the webhook
-        charged_auth_token = hmac_sha256_digest(
-            constants.LIGHTNING_WEBHOOK_KEY, invoice.lid)
-        callback_url = (f"{constants.CALLBACK_URI_ROOT}/callback"
-                        f"/{invoice.lid}/{charged_auth_token}")
-
-        webhook_registration_response = requests.post(
-            f"{constants.CHARGE_ROOT}/invoice/{invoice.lid}/webhook",
-            json={'url': callback_url},
-            timeout=(constants.CONNECTION_TIMEOUT, constants.RESPONSE_TIMEOUT))
+    # In async mode, leave the webhook registration to the workers (see
+    # register_pending_webhooks) so that it does not hold the request
+    if constants.LN_WEBHOOK_REGISTRATION == 'async':
+        invoice.webhook_registered = False
+        return True, invoice
 
-        if webhook_registration_response.status_code != HTTPStatus.CREATED:
-            return False, get_http_error_resp(
-                'LIGHTNING_CHARGE_WEBHOOK_REGISTRATION_ERROR')
+    # Without webhooks, the payments are consumed from the payment stream
+    if constants.LN_WEBHOOK_REGISTRATION == 'none':
+        return True, invoice
 
-    except requests.exceptions.RequestException:
+    if not register_webhook(invoice.lid):
         return False, get_http_error_resp(
             'LIGHTNING_CHARGE_WEBHOOK_REGISTRATION_ERROR')
 
     return True, invoice
 
 
+def register_webhook(lid):
+    """Register the payment webhook of a Lightning Charge invoice
+
+    Returns:
+        Boolean indicating whether the registration was successful.
+
+    """
+    charged_auth_token = hmac_sha256_digest(constants.LIGHTNING_WEBHOOK_KEY,
+                                            lid)
+    callback_url = (f"{constants.CALLBACK_URI_ROOT}/callback"
+                    f"/{lid}/{charged_auth_token}")
+    try:
+        webhook_registration_response = lightning_charge.post(
+            f"/invoice/{lid}/webhook", json={'url': callback_url})
+    except requests.exceptions.RequestException:
+        return False
+
+    return webhook_registration_response.status_code == HTTPStatus.CREATED
+
+
+def _is_paid_on_charge(lid):
+    try:
+        response = lightning_charge.get(f"/invoice/{lid}")
+    except requests.exceptions.RequestException:
+        return False
+
+    return response.status_code == HTTPStatus.OK and \
+        response.json().get('status') == 'paid'
+
+
+def pay_invoices(lids):
+    """Pay the invoices with given Lightning Charge ids
+
+    Returns:
+        Set with the channels of the orders that became paid as a result.
+
+    """
+    channels = set()
+    if not lids:
+        return channels
+
+    invoices = Invoice.query.filter(Invoice.lid.in_(set(lids))).all()
+    for invoice in invoices:
+        if not invoice.order_id or \
+                invoice.status != InvoiceStatus.pending.value:
+            continue
+        success, order_paid = pay_invoice(invoice)
+        if success and order_paid:
+            channels.add(invoice.order.channel)
+    return channels
+
+
+def poll_paid_invoices(after_id=0):
+    """Check which pending invoices were paid on Lightning Charge
+
+    Check up to CHARGE_POLL_BATCH_SIZE pending invoices per call, in id order,
+    so that the number of requests sent to Lightning Charge on each call is
+    bounded regardless of the number of pending invoices. Successive calls
+    can page through all pending invoices.
+
+    Args:
+        after_id (int): Check the invoices with greater ids only (e.g., the
+            last invoice id checked on the previous call).
+
+    Returns:
+        Tuple with the list of Lightning Charge ids of the paid invoices and
+        the id of the last invoice checked, or None if there are no more
+        pending invoices to check.
+
+    """
+    invoices = Invoice.query.filter(
+        and_(Invoice.status == InvoiceStatus.pending.value, Invoice.id
+             > after_id)).order_by(
+                 Invoice.id).limit(constants.CHARGE_POLL_BATCH_SIZE + 1).all()
+    has_more = len(invoices) > constants.CHARGE_POLL_BATCH_SIZE
+    invoices = invoices[:constants.CHARGE_POLL_BATCH_SIZE]
+    lids = [
+        invoice.lid for invoice in invoices if _is_paid_on_charge(invoice.lid)
+    ]
+    return lids, invoices[-1].id if has_more else None
+
+
+def register_pending_webhooks():
+    """Register the webhooks of the invoices created in async mode
+
+    Retry the registration of the pending invoices whose webhooks are not
+    registered yet. Once registered, check whether the invoice was paid in the
+    meantime, in which case its payment callback was missed, and pay it.
+
+    Returns:
+        Tuple with the list of invoices whose webhooks got registered and the
+        list of invoices paid as a result.
+
+    """
+    invoices = Invoice.query.filter(
+        and_(Invoice.webhook_registered.is_(False),
+             Invoice.status == InvoiceStatus.pending.value)).all()
+    registered = []
+    paid = []
+    for invoice in invoices:
+        if not register_webhook(invoice.lid):
+            logging.warning(
+                f"Failed to register the webhook of invoice {invoice.lid}")
+            continue
+
+        invoice.webhook_registered = True
+        db.session.commit()
+        registered.append(invoice)
+
+        if _is_paid_on_charge(invoice.lid) and pay_invoice(invoice)[0]:
+            paid.append(invoice)
+
+    return registered, paid
+
+
 def get_and_authenticate_invoice(lid, charged_auth_token):
     invoice = Invoice.query.filter_by(lid=lid).first()
 
@@ -103,16 +211,47 @@ def get_and_authenticate_invoice(lid, charged_auth_token):
 
 
 def pay_invoice(invoice):
-    if invoice.status == InvoiceStatus.paid.value:
-        return get_http_error_resp('INVOICE_ALREADY_PAID')
-    if invoice.status == InvoiceStatus.expired.value:
-        return get_http_error_resp('INVOICE_ALREADY_EXPIRED')
+    """Mark an invoice as paid
 
-    invoice.status = InvoiceStatus.paid.value
-    invoice.paid_at = datetime.datetime.utcnow()
-    db.session.commit()
-    maybe_mark_order_as_paid(invoice.order_id)
-    return None
+    The invoice is flipped from pending to paid with a conditional update, so
+    that, when the same payment is processed concurrently (e.g., by duplicate
+    payment callbacks handled on different workers), only one of the callers
+    pays the invoice.
+
+    Returns:
+        A pair whose first element is a boolean indicating whether the
+        invoice was paid by this call. If False, the second element is the
+        error response. If True, the second element is a boolean indicating
+        whether the invoice's order was marked as paid as a result.
+
+    """
+    if invoice.status == InvoiceStatus.pending.value:
+        n_updated = Invoice.query.filter(
+            and_(Invoice.id == invoice.id,
+                 Invoice.status == InvoiceStatus.pending.value)).update(
+                     {
+                         Invoice.status: InvoiceStatus.paid.value,
+                         Invoice.paid_at: datetime.datetime.utcnow()
+                     },
+                     synchronize_session=False)
+        if n_updated == 1 and invoice.order_id is not None:
+            update_bids(invoice.order,
+                        paid=invoice.amount,
+                        unpaid=-invoice.amount,
+                        pending_invoices=-1)
+        db.session.commit()  # also reloads the invoice on the next access
+        if n_updated == 1:
+            order_paid = maybe_mark_order_as_paid(invoice.order_id)
+            # Queue the order for transmission, or requeue it with the higher
+            # bid when the invoice pays a bump of an order already paid
+            if invoice.order is not None and \
+                    invoice.order.status == OrderStatus.paid.value:
+                scheduler.push(invoice.order)
+            return True, order_paid
+
+    if invoice.status == InvoiceStatus.expired.value:
+        return False, get_http_error_resp('INVOICE_ALREADY_EXPIRED')
+    return False, get_http_error_resp('INVOICE_ALREADY_PAID')
 
 
 def get_pending_invoices(order_id):
@@ -121,31 +260,66 @@ def get_pending_invoices(order_id):
              Invoice.status == constants.InvoiceStatus.pending.value)).all()
 
 
-def expire_invoice(invoice):
-    if invoice.status == InvoiceStatus.pending.value:
-        invoice.status = constants.InvoiceStatus.expired.value
-        db.session.commit()
-
-
 def expire_unpaid_invoices():
     """Expire unpaid invoices
 
     Expire any unpaid invoice that has reached its expiration time. The
-    corresponding order may be auto-expired as a result.
+    corresponding orders left without pending invoices are expired as a
+    result. The invoices are expired in batches of up to CLEANUP_BATCH_SIZE
+    invoices, each within a single transaction, with set-based updates.
 
     Returns:
-        Tuple with the list of invoices and the list of orders that got expired
-        by this function.
+        Tuple with the list of Lightning Charge ids of the invoices and the
+        list of UUIDs of the orders that got expired by this function.
 
     """
-    invoices_to_expire = Invoice.query.filter(
-        and_(Invoice.status == constants.InvoiceStatus.pending.value,
-             func.datetime(Invoice.expires_at)
-             < datetime.datetime.utcnow())).all()
-    expired_orders = []
-    for invoice in invoices_to_expire:
-        expire_invoice(invoice)
-        expired_order = maybe_mark_order_as_expired(invoice.order_id)
-        if (expired_order is not None):
-            expired_orders.append(expired_order)
-    return invoices_to_expire, expired_orders
+    pending = Invoice.status == InvoiceStatus.pending.value
+    criterion = and_(
+        pending,
+        func.datetime(Invoice.expires_at) < datetime.datetime.utcnow())
+
+    expired_lids = []
+    expired_uuids = []
+    while True:
+        batch = db.session.query(Invoice.id,
+                                 Invoice.order_id).filter(criterion).limit(
+                                     constants.CLEANUP_BATCH_SIZE).all()
+        if not batch:
+            break
+
+        ids = [row.id for row in batch]
+        Invoice.query.filter(Invoice.id.in_(ids), pending).update(
+            {Invoice.status: InvoiceStatus.expired.value},
+            synchronize_session=False)
+        # Invoices paid concurrently are left untouched by the update
+        expired = db.session.query(Invoice.id, Invoice.lid).filter(
+            Invoice.id.in_(ids),
+            Invoice.status == InvoiceStatus.expired.value).all()
+        expired_lids.extend(row.lid for row in expired)
+
+        # Take the expired invoices out of the bid aggregates of their orders
+        in_batch = and_(Invoice.order_id == Order.id,
+                        Invoice.id.in_([row.id for row in expired]))
+        order_ids = set(row.order_id for row in batch)
+        Order.query.filter(Order.id.in_(order_ids)).update(
+            {
+                Order.unpaid_bid:
+                Order.unpaid_bid -
+                select([func.coalesce(func.sum(Invoice.amount), 0)
+                        ]).where(in_batch).as_scalar(),
+                Order.pending_invoices:
+                Order.pending_invoices -
+                select([func.count(Invoice.id)]).where(in_batch).as_scalar()
+            },
+            synchronize_session=False)
+
+        orders = mark_orders_as_expired(
+            and_(Order.id.in_(order_ids), Order.pending_invoices == 0))
+        db.session.commit()
+        remove_message_files(orders)
+        expired_uuids.extend(order.uuid for order in orders)
+
+        if len(batch) < constants.CLEANUP_BATCH_SIZE:
+            break
+
+    return expired_lids, expired_uuids
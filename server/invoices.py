@@ -1,15 +1,57 @@
-from constants import OrderStatus
+from collections import OrderedDict
+import threading
+import time
+
+from constants import InvoiceStatus
 from error import get_http_error_resp
+from flask import current_app
 from flask_restful import Resource
 from invoice_helpers import get_and_authenticate_invoice, \
     pay_invoice
-from models import Order
 import transmitter
 
 
+class RecentCallbacks:
+    """Record of the recently processed payment callbacks
+
+    Lightning Charge retries the payment callbacks, so the same callback can
+    arrive several times. Once an authenticated callback is processed, its
+    duplicates are answered from this record within the given period,
+    without looking the invoice up on the database.
+
+    Args:
+        ttl (float): Period in seconds during which a callback is remembered.
+
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._expiry = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, lid, charged_auth_token):
+        now = time.monotonic()
+        with self._lock:
+            # With a fixed TTL, the entries expire in insertion order
+            while self._expiry and next(iter(self._expiry.values())) <= now:
+                self._expiry.popitem(last=False)
+            key = (lid, charged_auth_token)
+            self._expiry.pop(key, None)
+            self._expiry[key] = now + self.ttl
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._expiry.get(key)
+        return expiry is not None and expiry > time.monotonic()
+
+
 class InvoiceResource(Resource):
     # invoice paid callback from charged
     def post(self, lid, charged_auth_token):
+        recent_callbacks = current_app.config['RECENT_CALLBACKS']
+        if (lid, charged_auth_token) in recent_callbacks:
+            return get_http_error_resp('INVOICE_ALREADY_PAID')
+
         success, invoice_or_error = get_and_authenticate_invoice(
             lid, charged_auth_token)
         if not success:
@@ -18,12 +60,15 @@ class InvoiceResource(Resource):
         if not invoice.order_id:
             return get_http_error_resp('ORPHANED_INVOICE')
 
-        error_msg = pay_invoice(invoice)
-        if error_msg:
-            return error_msg
+        success, order_paid_or_error = pay_invoice(invoice)
+        if invoice.status == InvoiceStatus.paid.value:
+            recent_callbacks.add(lid, charged_auth_token)
+        if not success:
+            return order_paid_or_error
 
-        order = Order.query.filter_by(id=invoice.order_id).first()
-        if order.status == OrderStatus.paid.value:
-            transmitter.tx_start(order.channel)
+        # Only the callback that marked the order as paid starts the
+        # transmission
+        if order_paid_or_error:
+            transmitter.tx_start(invoice.order.channel)
 
         return {'message': f'invoice {invoice.lid} paid'}
@@ -0,0 +1,208 @@
+"""Lightning Charge client
+
+Each process keeps a single client with a pooled requests session so that the
+connections to Lightning Charge are kept alive and reused across requests.
+Failed requests are retried a bounded number of times with jittered
+exponential backoff. Moreover, a circuit breaker stops sending requests for a
+while after consecutive failures so that, when Lightning Charge is down, the
+callers fail fast instead of waiting out the timeouts on every request.
+
+"""
+from http import HTTPStatus
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+
+import constants
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Exception raised when a request is rejected by the open circuit"""
+
+
+class CircuitBreaker:
+    """Circuit breaker
+
+    The circuit opens after a number of consecutive failures and rejects all
+    calls while open. After a cool-down period, it lets a trial call through
+    (half-open state). The circuit closes if the trial call succeeds or opens
+    once again otherwise.
+
+    Args:
+        failure_threshold (int): Consecutive failures that open the circuit.
+        reset_timeout (float): Cool-down period in seconds.
+
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a call can go through"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # Half-open: let this call through and hold the others back until
+            # its outcome is known
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning("Lightning Charge circuit breaker open")
+                self.opened_at = time.monotonic()
+
+
+class LightningChargeClient:
+    """Client for the Lightning Charge API
+
+    Args:
+        root (str): Root URL of the Lightning Charge API.
+        pool_size (int): Maximum number of connections kept in the pool.
+        max_retries (int): Maximum number of retries per request.
+        retry_backoff (float): Base backoff interval in seconds.
+        breaker (CircuitBreaker): Circuit breaker guarding the requests.
+
+    """
+
+    def __init__(self, root, pool_size, max_retries, retry_backoff, breaker):
+        self.root = root
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def _connect_failed(error):
+        """Check whether a request failed to establish its connection"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if not isinstance(error, requests.exceptions.ConnectionError) or \
+                not error.args:
+            return False
+        reason = error.args[0]
+        if isinstance(reason, urllib3.exceptions.MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+    def _retriable(self, method, error=None):
+        # Requests that failed to establish the connection never reached the
+        # server, so they are retried regardless of the method. Other errors
+        # (e.g., read timeouts or connections dropped after the request was
+        # sent) and server errors are retried on idempotent requests only,
+        # given that retrying a POST could create a duplicate invoice, for
+        # instance.
+        if self._connect_failed(error):
+            return True
+        return method == 'GET'
+
+    def _backoff(self, attempt):
+        # Full jitter
+        time.sleep(random.uniform(0, self.retry_backoff * 2**attempt))
+
+    def request(self, method, path, **kwargs):
+        """Send a request to Lightning Charge
+
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to the API root URL.
+            **kwargs: Keyword arguments passed to requests.Session.request.
+
+        Returns:
+            The response to the request.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails on all
+                attempts or if the circuit is open (CircuitOpenError).
+
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("Lightning Charge circuit breaker open")
+
+        kwargs.setdefault(
+            'timeout',
+            (constants.CONNECTION_TIMEOUT, constants.RESPONSE_TIMEOUT))
+        url = f"{self.root}{path}"
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as error:
+                if attempt < self.max_retries and \
+                        self._retriable(method, error=error):
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                self.breaker.record_failure()
+                raise
+
+            if response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+                if attempt < self.max_retries and self._retriable(method):
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """Get the Lightning Charge client of the current process
+
+    The client is created on the first use within each process, so that
+    forked processes (e.g., gunicorn workers) do not share the connections.
+
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = LightningChargeClient(
+            constants.CHARGE_ROOT, constants.CHARGE_POOL_SIZE,
+            constants.CHARGE_MAX_RETRIES, constants.CHARGE_RETRY_BACKOFF,
+            CircuitBreaker(constants.CHARGE_BREAKER_THRESHOLD,
+                           constants.CHARGE_BREAKER_RESET_SECS))
+        _client_pid = os.getpid()
+    return _client
+
+
+def get(path, **kwargs):
+    """Send a GET request to Lightning Charge (see LightningChargeClient)"""
+    return get_client().get(path, **kwargs)
+
+
+def post(path, **kwargs):
+    """Send a POST request to Lightning Charge (see LightningChargeClient)"""
+    return get_client().post(path, **kwargs)
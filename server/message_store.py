@@ -0,0 +1,438 @@
+"""Content-addressed message store
+
+Each message file is stored once as a blob named after its SHA-256 digest
+(which is also the order's message_digest) under MSG_BLOB_PATH. Each order
+holding the message gets its own reference to the blob under MSG_STORE_PATH,
+named after the order's uuid and implemented as a hard link. Hence, orders
+uploading the same content share a single copy on disk, and the blob's link
+count doubles as its reference count: a blob whose link count drops to one is
+no longer referenced by any order.
+
+Both blobs and message files are sharded into two levels of subdirectories
+named after the first four characters of the file name (e.g., ab/cd/abcd...)
+to keep the number of entries per directory small.
+
+Optionally (see MSG_STORE_COMPRESSION), messages are stored compressed with
+gzip whenever that makes them smaller. In this case, both the blob and the
+message file names get a .gz suffix. The original size and digest remain
+recorded on the order.
+
+"""
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+from hashlib import sha256
+
+from flask import Request
+
+import constants
+
+CHUNK_SIZE = 65536
+GZIP_SUFFIX = '.gz'
+STORE_FILE_MODE = 0o644
+
+
+class MessageTooLarge(Exception):
+    """Exception raised when an upload exceeds its maximum message size"""
+
+    def __init__(self, max_size):
+        super().__init__(f"message exceeds the maximum size of {max_size}")
+        self.max_size = max_size
+
+
+def _mkstemp():
+    """Create a temporary upload file on the message store directory
+
+    The file becomes the stored message file (and blob) once hard linked, so
+    make it readable like regular files (mkstemp creates it with mode 0600).
+    Otherwise, nginx could not serve it via X-Accel-Redirect.
+
+    """
+    fd, path = tempfile.mkstemp(prefix='.upload-',
+                                dir=constants.MSG_STORE_PATH)
+    os.fchmod(fd, STORE_FILE_MODE)
+    return fd, path
+
+
+class MessageUpload:
+    """Message file being written into the message store
+
+    The message data is written into a temporary file on the message store
+    directory while its size and SHA-256 digest are computed on the fly. Once
+    the upload is validated, it can be added to the store with the save
+    function. The temporary file is removed when the upload is closed.
+
+    Args:
+        max_size (int): Maximum message size in bytes. The upload is aborted
+            with a MessageTooLarge exception as soon as it is exceeded.
+
+    """
+
+    def __init__(self, max_size):
+        fd, self.tmp_path = _mkstemp()
+        self._file = os.fdopen(fd, 'w+b')
+        self._hash = sha256()
+        self.max_size = max_size
+        self.size = 0
+        self.suffix = ''
+
+    @classmethod
+    def from_file(cls, path, max_size):
+        """Create an upload holding the contents of an existing file
+
+        The file is hard linked into the upload's temporary file, so it is
+        left untouched when the upload is closed or saved. It should not be
+        modified while the upload is open, though.
+
+        """
+        upload = cls(max_size)
+        upload._file.close()
+        os.remove(upload.tmp_path)
+        os.link(path, upload.tmp_path)
+        upload._file = open(upload.tmp_path, 'r+b')
+        for block in iter(lambda: upload._file.read(CHUNK_SIZE), b''):
+            upload.size += len(block)
+            upload._hash.update(block)
+        return upload
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @property
+    def digest(self):
+        """Hex SHA-256 digest of the data written so far"""
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            # Stop right away instead of filling the disk with a message that
+            # is going to be rejected anyway
+            self.close()
+            raise MessageTooLarge(self.max_size)
+        self._hash.update(data)
+        self._file.write(data)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def compress(self):
+        """Compress the uploaded data with gzip if that makes it smaller
+
+        Returns:
+            Boolean indicating whether the upload got compressed.
+
+        """
+        self._file.close()
+        fd, gz_path = _mkstemp()
+        with open(self.tmp_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            with gzip.GzipFile(filename='', fileobj=dst, mode='wb',
+                               mtime=0) as gz_dst:
+                shutil.copyfileobj(src, gz_dst, CHUNK_SIZE)
+
+        if os.path.getsize(gz_path) >= self.size:
+            os.remove(gz_path)
+            return False
+
+        os.replace(gz_path, self.tmp_path)
+        self.suffix = GZIP_SUFFIX
+        return True
+
+    def link(self, path):
+        """Hard link the uploaded data into the given path"""
+        self._file.close()
+        _link(self.tmp_path, path)
+
+    def close(self):
+        """Close the upload and remove its temporary file"""
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def max_upload_size(admin_mode):
+    """Largest message size accepted by any channel open for posting"""
+    return max(info.max_msg_size for info in constants.CHANNEL_INFO.values()
+               if admin_mode or 'post' in info.user_permissions)
+
+
+class MessageUploadRequest(Request):
+    """Request class streaming file uploads directly into the message store
+
+    Werkzeug buffers multipart file uploads into anonymous temporary files by
+    default, which would need to be copied and read once again afterwards.
+    Instead, stream each uploaded file straight into a MessageUpload.
+
+    All the uploads created for the request are closed (and their temporary
+    files removed) when the request is closed, including those left behind
+    when the form parsing is aborted (e.g., by MessageTooLarge).
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.message_uploads = []
+
+    def _get_file_stream(self,
+                         total_content_length,
+                         content_type,
+                         filename=None,
+                         content_length=None):
+        admin_mode = self.path.startswith("/admin/")
+        upload = MessageUpload(max_upload_size(admin_mode))
+        self.message_uploads.append(upload)
+        return upload
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for upload in self.message_uploads:
+                upload.close()
+
+
+def _shard(root, name):
+    """Sharded path for the given file name (e.g., root/ab/cd/abcd...)"""
+    return os.path.join(root, name[0:2], name[2:4], name)
+
+
+def _link(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.link(src, dst)
+
+
+def _rename(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.rename(src, dst)
+
+
+def message_path(uuid):
+    """Path to the message file referenced by the order with given uuid"""
+    return _shard(constants.MSG_STORE_PATH, uuid)
+
+
+def blob_path(digest):
+    """Path to the blob holding the message with given SHA-256 digest"""
+    return _shard(constants.MSG_BLOB_PATH, digest)
+
+
+def _candidate_paths(path, legacy_path, suffixes=('', GZIP_SUFFIX)):
+    # While the legacy files are migrated, a file can be moved from its legacy
+    # flat path into its sharded path at any moment. Checking the sharded path
+    # once again after the legacy path ensures the file is found regardless.
+    # The legacy files are never compressed.
+    paths = [path + suffix for suffix in suffixes]
+    if '' in suffixes:
+        return paths + [legacy_path] + paths
+    return paths
+
+
+def _message_paths(uuid):
+    return _candidate_paths(message_path(uuid),
+                            os.path.join(constants.MSG_STORE_PATH, uuid))
+
+
+def _blob_paths(digest, suffixes=('', GZIP_SUFFIX)):
+    return _candidate_paths(blob_path(digest),
+                            os.path.join(constants.MSG_BLOB_PATH, digest),
+                            suffixes)
+
+
+def _suffix(path):
+    return GZIP_SUFFIX if path.endswith(GZIP_SUFFIX) else ''
+
+
+def is_compressed(path):
+    """Check whether the message file on the given path is compressed"""
+    return _suffix(path) == GZIP_SUFFIX
+
+
+def decompress(path):
+    """Generator of decompressed data chunks from a compressed message"""
+    with gzip.open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield block
+
+
+def find_message(uuid):
+    """Find the message file of the order with given uuid
+
+    Returns:
+        Path to the message file or None if not found.
+
+    """
+    for path in _message_paths(uuid):
+        if os.path.exists(path):
+            return path
+
+
+def save(upload, uuid):
+    """Save an upload as the message of the order with given uuid
+
+    If a blob with the same digest already exists, the order's message file
+    becomes a reference to it, and the uploaded data is discarded. Otherwise,
+    the upload becomes the new blob, compressed if so configured.
+
+    Args:
+        upload (MessageUpload): Validated message upload.
+        uuid (str): UUID of the order holding the message.
+
+    """
+    path = message_path(uuid)
+    for blob in _blob_paths(upload.digest):
+        try:
+            _link(blob, path + _suffix(blob))
+            return
+        except FileNotFoundError:
+            pass
+
+    if constants.MSG_STORE_COMPRESSION == 'gzip':
+        upload.compress()
+
+    # Create the order's reference before publishing the new blob so that the
+    # data is never left without references (a concurrent remove call could
+    # otherwise delete the blob before it is linked).
+    upload.link(path + upload.suffix)
+    try:
+        upload.link(blob_path(upload.digest) + upload.suffix)
+    except FileExistsError:
+        # The same content was stored concurrently. Keep the independent copy.
+        pass
+
+
+def remove(order):
+    """Remove the order's message file
+
+    The underlying blob is removed too once the order was its last reference.
+    If a concurrent save call links a new reference to the blob in the
+    meantime, the new reference keeps the data alive regardless.
+
+    """
+    for path in _message_paths(order.uuid):
+        try:
+            os.remove(path)
+            break
+        except FileNotFoundError:
+            pass
+    else:
+        return
+
+    for blob in _blob_paths(order.message_digest, (_suffix(path), )):
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+            break
+        except FileNotFoundError:
+            pass
+
+
+def sha256_checksum(path):
+    msg_hash = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            msg_hash.update(block)
+    return msg_hash.hexdigest()
+
+
+def cleanup_stale_uploads():
+    """Remove the temporary upload files left behind for too long
+
+    The temporary files are removed when the uploads are closed, but can be
+    left behind if the server process dies in the middle of an upload.
+
+    Returns:
+        Number of removed files.
+
+    """
+    if not os.path.isdir(constants.MSG_STORE_PATH):
+        return 0
+
+    n_removed = 0
+    # The inode change time is updated on every write and also when the file
+    # is hard linked (see MessageUpload.from_file)
+    deadline = time.time() - constants.STALE_UPLOAD_TIMEOUT_SECS
+    with os.scandir(constants.MSG_STORE_PATH) as it:
+        for entry in it:
+            if not entry.name.startswith('.upload-'):
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_ctime < deadline:
+                    os.remove(entry.path)
+                    n_removed += 1
+            except FileNotFoundError:
+                pass  # closed in the meantime
+    return n_removed
+
+
+def _legacy_files(root):
+    """List the files stored directly on the given directory"""
+    with os.scandir(root) as it:
+        # Skip the shard directories and the temporary upload files
+        return [
+            entry for entry in it if entry.is_file(
+                follow_symlinks=False) and not entry.name.startswith('.')
+        ]
+
+
+def _link_legacy_message(path):
+    """Link a message file stored before the content-addressed store"""
+    blob = blob_path(sha256_checksum(path))
+    try:
+        _link(path, blob)
+    except FileExistsError:
+        tmp_path = os.path.join(constants.MSG_STORE_PATH,
+                                '.migrate-' + os.path.basename(path))
+        os.link(blob, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def migrate_legacy_files():
+    """Migrate the message files stored with a legacy layout
+
+    Move the blobs and message files stored directly on MSG_BLOB_PATH and
+    MSG_STORE_PATH into their sharded paths. Also, link the message files
+    created before the content-addressed store into a blob first, either a new
+    blob or an existing one with the same content.
+
+    Each file is moved with an atomic rename, and the other functions of this
+    module look for files on both layouts. Hence, this function can run in the
+    background while the message store is in use. It is also idempotent.
+
+    Returns:
+        Number of files migrated by this function.
+
+    """
+    os.makedirs(constants.MSG_BLOB_PATH, exist_ok=True)
+    n_migrated = 0
+
+    # Move the blobs first so that the legacy message files can be linked to
+    # the existing blobs on their sharded paths
+    for entry in _legacy_files(constants.MSG_BLOB_PATH):
+        try:
+            _rename(entry.path, blob_path(entry.name))
+            n_migrated += 1
+        except FileNotFoundError:
+            pass  # removed in the meantime
+
+    for entry in _legacy_files(constants.MSG_STORE_PATH):
+        try:
+            if entry.stat().st_nlink == 1:
+                _link_legacy_message(entry.path)
+            _rename(entry.path, message_path(entry.name))
+            n_migrated += 1
+        except FileNotFoundError:
+            pass  # removed in the meantime
+
+    if n_migrated > 0:
+        logging.info(f"Migrated {n_migrated} files into the sharded "
+                     "content-addressed message store")
+    return n_migrated
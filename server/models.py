@@ -5,27 +5,35 @@ from database import db
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    # The bid_per_byte column is indexed in descending order so that orders
+    # with equal bids are still served in insertion (id) order
+    __table_args__ = (db.Index('ix_orders_status_channel_bid_per_byte',
+                               'status', 'channel',
+                               db.text('bid_per_byte DESC')), )
     id = db.Column(db.Integer, primary_key=True)
     bid = db.Column(db.Integer, default=0)
     message_size = db.Column(db.Integer, nullable=False)
     bid_per_byte = db.Column(db.Float, default=0)  # TODO: remove (redundant)
     message_digest = db.Column(db.String(64), nullable=False)
     status = db.Column(db.Integer)
-    uuid = db.Column(db.String(36), nullable=False)
+    uuid = db.Column(db.String(36), nullable=False, index=True)
     created_at = db.Column(db.DateTime, default=func.now())
     cancelled_at = db.Column(db.DateTime)
     started_transmission_at = db.Column(db.DateTime)
     ended_transmission_at = db.Column(db.DateTime)
     tx_seq_num = db.Column(db.Integer, unique=True)
     unpaid_bid = db.Column(db.Integer, nullable=False)
+    pending_invoices = db.Column(db.Integer, nullable=False, default=0)
     region_code = db.Column(db.Integer)
     channel = db.Column(db.Integer, default=1)
     invoices = db.relationship('Invoice', backref='order', lazy=True)
     tx_confirmations = db.relationship('TxConfirmation',
                                        backref='order',
+                                       order_by='TxConfirmation.id',
                                        lazy=True)
     rx_confirmations = db.relationship('RxConfirmation',
                                        backref='order',
+                                       order_by='RxConfirmation.id',
                                        lazy=True)
     retransmission = db.relationship("TxRetry",
                                      uselist=False,
@@ -35,19 +43,24 @@ class Order(db.Model):
 
 class Invoice(db.Model):
     __tablename__ = 'invoices'
+    __table_args__ = (db.Index('ix_invoices_status_expires_at', 'status',
+                               'expires_at'), )
     id = db.Column(db.Integer, primary_key=True)
-    lid = db.Column(db.String(100), nullable=False)
+    lid = db.Column(db.String(100), nullable=False, unique=True, index=True)
     invoice = db.Column(db.String(1024), nullable=False)
     paid_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=func.now())
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)
     status = db.Column(db.Integer)
     amount = db.Column(db.Integer)
     expires_at = db.Column(db.DateTime, nullable=False)
+    webhook_registered = db.Column(db.Boolean, default=True)
 
 
 class TxConfirmation(db.Model):
     __tablename__ = 'tx_confirmations'
+    __table_args__ = (db.Index('ix_tx_confirmations_order_id_region_id',
+                               'order_id', 'region_id'), )
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=func.now())
     order_id = db.Column(db.Integer,
@@ -59,6 +72,8 @@ class TxConfirmation(db.Model):
 
 class RxConfirmation(db.Model):
     __tablename__ = 'rx_confirmations'
+    __table_args__ = (db.Index('ix_rx_confirmations_order_id_region_id',
+                               'order_id', 'region_id'), )
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=func.now())
     order_id = db.Column(db.Integer,
@@ -71,9 +86,15 @@ class RxConfirmation(db.Model):
 class TxRetry(db.Model):
     __tablename__ = 'tx_retries'
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)
     last_attempt = db.Column(db.DateTime)
     retry_count = db.Column(db.Integer, default=0)
     region_code = db.Column(db.Integer)
     pending = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=func.now())
+
+
+class Counter(db.Model):
+    __tablename__ = 'counters'
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
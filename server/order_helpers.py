@@ -1,12 +1,11 @@
 import logging
-import os
 from datetime import datetime, timedelta
 from math import ceil
 
 from flask import request
-from sqlalchemy import and_, or_, func
+from sqlalchemy import and_, or_, func, inspect
 
-from bidding import calc_ota_msg_len, validate_bid
+from bidding import calc_ota_msg_len, get_min_bid, validate_bid
 from constants import InvoiceStatus, OrderStatus
 from database import db
 from error import get_http_error_resp
@@ -15,6 +14,8 @@ from regions import region_number_to_id, monitored_rx_regions, \
     region_code_to_id_list, region_code_to_number_list, \
     region_id_to_number, Regions, region_id_list_to_code
 import constants
+import message_store
+import scheduler
 from utils import hmac_sha256_digest
 
 USER_AUTH_KEY = hmac_sha256_digest('user-token', constants.CHARGE_API_TOKEN)
@@ -25,27 +26,61 @@ def compute_auth_token(uuid):
     return hmac_sha256_digest(USER_AUTH_KEY, uuid)
 
 
-def _paid_invoices_total(order):
-    total = 0
-    for invoice in order.invoices:
-        if invoice.status == InvoiceStatus.paid.value:
-            total += invoice.amount
-    return total
+def update_bids(order, paid=0, unpaid=0, pending_invoices=0):
+    """Update the bid aggregates of an order
 
+    Add the given increments to the paid bid (and the bid per byte), the
+    unpaid bid, and the number of pending invoices of the order. On orders
+    already stored in the database, the increments are applied with SQL
+    arithmetic so that concurrent updates (e.g., a bid bump racing with a
+    payment) do not overwrite each other. The caller commits the changes.
 
-def _unpaid_invoices_total(order):
-    total = 0
-    for invoice in order.invoices:
-        if invoice.status == InvoiceStatus.pending.value:
-            total += invoice.amount
-    return total
+    """
+    ota_msg_len = calc_ota_msg_len(order.message_size)
+    if not inspect(order).persistent:
+        order.bid = (order.bid or 0) + paid
+        order.bid_per_byte = order.bid / ota_msg_len
+        order.unpaid_bid = (order.unpaid_bid or 0) + unpaid
+        order.pending_invoices = (order.pending_invoices or 0) + \
+            pending_invoices
+        return
 
+    Order.query.filter_by(id=order.id).update(
+        {
+            Order.bid: Order.bid + paid,
+            Order.bid_per_byte: (Order.bid + paid) / float(ota_msg_len),
+            Order.unpaid_bid: Order.unpaid_bid + unpaid,
+            Order.pending_invoices: Order.pending_invoices + pending_invoices
+        },
+        synchronize_session=False)
+    db.session.expire(
+        order, ['bid', 'bid_per_byte', 'unpaid_bid', 'pending_invoices'])
 
-def adjust_bids(order):
-    order.bid = _paid_invoices_total(order)
-    order.bid_per_byte = order.bid / calc_ota_msg_len(order.message_size)
-    order.unpaid_bid = _unpaid_invoices_total(order)
-    db.session.commit()
+
+def add_invoice(order, invoice):
+    """Add a new invoice to an order and account for it on the bids"""
+    invoice.order = order
+    if invoice.status == InvoiceStatus.pending.value:
+        update_bids(order, unpaid=invoice.amount, pending_invoices=1)
+    elif invoice.status == InvoiceStatus.paid.value:
+        update_bids(order, paid=invoice.amount)
+
+
+def check_message_size(msg_size, channel):
+    """Check whether the message size is acceptable on the given channel
+
+    Returns:
+        None if the size is acceptable, or the error response otherwise.
+
+    """
+    if (msg_size < constants.MIN_MESSAGE_SIZE):
+        return get_http_error_resp('MESSAGE_FILE_TOO_SMALL',
+                                   constants.MIN_MESSAGE_SIZE)
+
+    max_msg_size = constants.CHANNEL_INFO[channel].max_msg_size
+    if (msg_size > max_msg_size):
+        return get_http_error_resp('MESSAGE_FILE_TOO_LARGE',
+                                   max_msg_size / (2**20))
 
 
 def get_and_authenticate_order(uuid, body_args, query_args):
@@ -72,45 +107,68 @@ def get_and_authenticate_order(uuid, body_args, query_args):
 
 
 def maybe_mark_order_as_paid(order_id):
+    """Mark the order as paid if pending and if its paid bid is sufficient
+
+    The order is flipped from pending to paid with a conditional update, so
+    that only one of concurrent callers (e.g., handling the payments of two
+    invoices of the same order) marks it as paid.
+
+    Returns:
+        Boolean indicating whether the order was marked as paid by this call.
+
+    """
     order = Order.query.filter_by(id=order_id).first()
-    adjust_bids(order)
+    if order.status != OrderStatus.pending.value or \
+            not validate_bid(order.message_size, order.bid):
+        return False
 
-    if order.status == OrderStatus.pending.value and\
-       validate_bid(order.message_size, order.bid):
-        order.status = OrderStatus.paid.value
-        db.session.commit()
+    n_updated = Order.query.filter(
+        and_(Order.id == order_id, Order.status == OrderStatus.pending.value,
+             Order.bid >= get_min_bid(order.message_size))).update(
+                 {Order.status: OrderStatus.paid.value},
+                 synchronize_session=False)
+    db.session.commit()
+    return n_updated == 1
 
 
-def expire_order(order):
-    if order.status == OrderStatus.pending.value:
-        logging.info(f"Marking order {order.uuid} as expired")
-        order.status = constants.OrderStatus.expired.value
-        db.session.commit()
-        delete_message_file(order)
+def mark_orders_as_expired(criterion, limit=None):
+    """Mark the pending orders matching a criterion as expired
 
+    Run set-based queries within the current transaction without committing
+    it. The message files are not removed either, given that they should only
+    be removed once the transaction is committed (see remove_message_files).
 
-def maybe_mark_order_as_expired(order_id):
-    """Expire the order if it's pending and has no other pending invoices:"""
-    order = Order.query.filter_by(
-        id=order_id, status=constants.OrderStatus.pending.value).first()
+    Args:
+        criterion: SQLAlchemy filter criterion selecting the orders.
+        limit (int, optional): Maximum number of orders to expire.
 
-    if not order:
-        return
+    Returns:
+        List of rows with the uuid and message_digest of the expired orders.
+
+    """
+    pending = Order.status == OrderStatus.pending.value
+    query = db.session.query(Order.id).filter(pending, criterion)
+    if limit is not None:
+        query = query.limit(limit)
+    ids = [row.id for row in query]
+    if not ids:
+        return []
 
-    n_pending_invoices = 0
-    for invoice in order.invoices:
-        if invoice.status == InvoiceStatus.pending.value:
-            n_pending_invoices += 1
+    Order.query.filter(Order.id.in_(ids), pending).update(
+        {Order.status: OrderStatus.expired.value}, synchronize_session=False)
 
-    if n_pending_invoices == 0:
-        expire_order(order)
-        return order
+    # Orders paid or cancelled concurrently are left untouched by the update
+    return db.session.query(Order.uuid, Order.message_digest).filter(
+        Order.id.in_(ids), Order.status == OrderStatus.expired.value).all()
+
+
+def remove_message_files(orders):
+    for order in orders:
+        delete_message_file(order)
 
 
 def delete_message_file(order):
-    message_file = os.path.join(constants.MSG_STORE_PATH, order.uuid)
-    if os.path.exists(message_file):
-        os.remove(message_file)
+    message_store.remove(order)
 
 
 def synthesize_presumed_rx_confirmations(order):
@@ -241,20 +299,25 @@ def add_rx_confirmation_if_not_present(order, region_number, presumed=False):
 def expire_old_pending_orders():
     """Expire old pending orders
 
-    Expire any pending order that has reached its expiration time.
+    Expire any pending order that has reached its expiration time. The orders
+    are expired in batches of up to CLEANUP_BATCH_SIZE orders, each within a
+    single transaction, and their message files are removed after each batch.
 
     Returns:
-        List of orders that got expired by this function.
+        List with the UUIDs of the orders that got expired by this function.
 
     """
-    orders_to_expire = Order.query.filter(
-        and_(
-            Order.status == constants.OrderStatus.pending.value,
-            func.datetime(Order.created_at) < datetime.utcnow() -
-            timedelta(days=constants.EXPIRE_PENDING_ORDERS_AFTER_DAYS))).all()
-    for order in orders_to_expire:
-        expire_order(order)
-    return orders_to_expire
+    criterion = func.datetime(Order.created_at) < datetime.utcnow() - \
+        timedelta(days=constants.EXPIRE_PENDING_ORDERS_AFTER_DAYS)
+    expired_uuids = []
+    while True:
+        orders = mark_orders_as_expired(criterion,
+                                        limit=constants.CLEANUP_BATCH_SIZE)
+        db.session.commit()
+        remove_message_files(orders)
+        expired_uuids.extend(order.uuid for order in orders)
+        if len(orders) < constants.CLEANUP_BATCH_SIZE:
+            return expired_uuids
 
 
 def cleanup_old_message_files():
@@ -318,6 +381,7 @@ def upsert_retransmission(order):
                                region_code=missing_confirmations_code)
         db.session.add(new_retry_tx)
     db.session.commit()
+    scheduler.push_retry(order)
 
 
 def refresh_retransmission_table():
@@ -347,6 +411,14 @@ def refresh_retransmission_table():
     after the message is already serialized (after the first Tx confirmation).
     Other sources of delay (propagation, routing, etc.) are neglected in both
     cases by assuming "tx_confirm_timeout_secs" is big enough to cover them.
+    Furthermore, on channels with an in-flight window larger than one (see
+    ChannelInfo.max_inflight), an order may wait for the transmission of up to
+    "max_inflight - 1" orders queued before it on the Tx hosts. Hence, the
+    serialization delay is scaled by the window size, which assumes the
+    orders queued before it have a similar size.
+    Likewise, a pre-staged order (see transmitter.prestage) can be published up
+    to "prestage_secs" before its serialization starts, so the pre-staging
+    lead time is added to the timeout interval.
 
     In summary, the timeout interval (with or without the serialization delay)
     adds to different starting points, as follows:
@@ -355,62 +427,137 @@ def refresh_retransmission_table():
     2) To the last (most recent) retransmission timestamp.
     3) To the order transmission start timestamp.
 
+    Normally, the retransmissions are triggered by per-order timers set to
+    these deadlines (see process_retransmission_deadlines). This function
+    scans all orders awaiting Tx confirmations instead, so it also resets the
+    timers of the orders not due yet, in case any timer update was lost.
+
     """
     orders = Order.query.filter(
         or_(Order.status == constants.OrderStatus.transmitting.value,
-            Order.status == constants.OrderStatus.confirming.value)).all()
+            Order.status == constants.OrderStatus.confirming.value)).order_by(
+                Order.id).all()
 
     orders_to_retry = []
     for order in orders:
-        tx_rate = constants.CHANNEL_INFO[order.channel].tx_rate
-        tx_confirm_timeout_secs = constants.CHANNEL_INFO[
-            order.channel].tx_confirm_timeout_secs
-        tx_delay = int(ceil(calc_ota_msg_len(order.message_size) / tx_rate))
-        timeout_interval = tx_delay + tx_confirm_timeout_secs
-
-        last_tx_confirmation = TxConfirmation.query.filter_by(
-            order_id=order.id).order_by(
-                TxConfirmation.created_at.desc()).first()
-        retry_info = TxRetry.query.filter_by(order_id=order.id).first()
-
-        if order.status == constants.OrderStatus.confirming.value and \
-                last_tx_confirmation is not None:
-            # Case 1
-            t_next_retry = last_tx_confirmation.created_at + timedelta(
-                seconds=tx_confirm_timeout_secs)
-            if datetime.utcnow() > t_next_retry:
-                orders_to_retry.append(order)
-        elif retry_info and retry_info.retry_count > 0:
-            # Case 2
-            #
-            # The order could have received Tx confirmations previously, but
-            # certainly not for the last retransmission, otherwise it would be
-            # in confirming state already.
-            #
-            # NOTE: check case 2 before case 3. If there are no confirmations,
-            # but the order has already been retransmitted, the next
-            # retransmission time should add to the last retransmission
-            # timestamp (here), not the transmission start timestamp (below).
-            t_timeout = retry_info.last_attempt + timedelta(
-                seconds=timeout_interval)
-            if datetime.utcnow() > t_timeout:
-                orders_to_retry.append(order)
-        elif last_tx_confirmation is None:
-            # Case 3
-            t_timeout = order.started_transmission_at + timedelta(
-                seconds=timeout_interval)
-            if datetime.utcnow() > t_timeout:
-                orders_to_retry.append(order)
+        deadline = get_retransmission_deadline(order)
+        if deadline is None:
+            continue
+        if datetime.utcnow() > deadline:
+            orders_to_retry.append(order)
+        else:
+            # Resynchronize the retransmission timers (see
+            # process_retransmission_deadlines)
+            scheduler.set_deadline(order, deadline)
 
     for order in orders_to_retry:
-        if (order.status == OrderStatus.transmitting.value):
-            order.status = OrderStatus.confirming.value
-            db.session.commit()
-        upsert_retransmission(order)
+        retransmit_on_timeout(order)
+
+
+def get_retransmission_deadline(order):
+    """Get the time after which an order requires retransmission
+
+    Applies the three cases documented in refresh_retransmission_table to an
+    order in transmitting or confirming state.
+
+    Returns:
+        The deadline (naive UTC datetime) or None if none of the cases apply.
+
+    """
+    channel_info = constants.CHANNEL_INFO[order.channel]
+    tx_rate = channel_info.tx_rate
+    tx_confirm_timeout_secs = channel_info.tx_confirm_timeout_secs
+    tx_delay = channel_info.max_inflight * int(
+        ceil(calc_ota_msg_len(order.message_size) / tx_rate))
+    timeout_interval = tx_delay + tx_confirm_timeout_secs + \
+        channel_info.prestage_secs
+
+    last_tx_confirmation = TxConfirmation.query.filter_by(
+        order_id=order.id).order_by(TxConfirmation.created_at.desc()).first()
+    retry_info = TxRetry.query.filter_by(order_id=order.id).first()
+
+    if order.status == constants.OrderStatus.confirming.value and \
+            last_tx_confirmation is not None:
+        # Case 1
+        return last_tx_confirmation.created_at + timedelta(
+            seconds=tx_confirm_timeout_secs)
+    elif retry_info and retry_info.retry_count > 0:
+        # Case 2
+        #
+        # The order could have received Tx confirmations previously, but
+        # certainly not for the last retransmission, otherwise it would be
+        # in confirming state already.
+        #
+        # NOTE: check case 2 before case 3. If there are no confirmations,
+        # but the order has already been retransmitted, the next
+        # retransmission time should add to the last retransmission
+        # timestamp (here), not the transmission start timestamp (below).
+        return retry_info.last_attempt + timedelta(seconds=timeout_interval)
+    elif last_tx_confirmation is None:
+        # Case 3
+        return order.started_transmission_at + timedelta(
+            seconds=timeout_interval)
+
+
+def schedule_retransmission(order):
+    """Set the retransmission timer of an order awaiting Tx confirmations"""
+    deadline = get_retransmission_deadline(order)
+    if deadline is not None:
+        scheduler.set_deadline(order, deadline)
+
+
+def retransmit_on_timeout(order):
+    """Schedule the retransmission of an order not confirmed on time"""
+    if (order.status == OrderStatus.transmitting.value):
+        order.status = OrderStatus.confirming.value
+        db.session.commit()
+    upsert_retransmission(order)
+    # Until retransmitted, the order waits on the retransmission queue
+    scheduler.clear_deadline(order.id)
+
+
+def process_retransmission_deadlines():
+    """Retransmit the orders whose retransmission timers expired
+
+    Event-driven alternative to refresh_retransmission_table, which only
+    looks into the orders whose deadlines are due, rather than scanning all
+    orders awaiting Tx confirmations. Each due order is checked against its
+    current deadline, given that Tx confirmations may have arrived since the
+    timer was set, in which case the timer is pushed back.
+
+    Returns:
+        List with the orders scheduled for retransmission.
+
+    Raises:
+        scheduler.SchedulerUnavailable: If the timers cannot be read.
+
+    """
+    retried = []
+    for order_id in scheduler.due_deadlines(datetime.utcnow()):
+        order = Order.query.filter_by(id=order_id).first()
+        deadline = None
+        if order is not None and order.status in [
+                OrderStatus.transmitting.value, OrderStatus.confirming.value
+        ]:
+            deadline = get_retransmission_deadline(order)
+
+        if deadline is None:
+            scheduler.clear_deadline(order_id)
+        elif datetime.utcnow() > deadline:
+            retransmit_on_timeout(order)
+            retried.append(order)
+        else:
+            scheduler.set_deadline(order, deadline)
+    return retried
 
 
 def get_next_retransmission(channel):
-    """Get the next highest bidding order requiring retransmission"""
+    """Get the next highest bidding order requiring retransmission
+
+    Fallback for when the scheduler queues are unavailable (see
+    scheduler.next_retransmission).
+
+    """
     refresh_retransmission_table()
 
     orders_with_retry_info = db.session.query(
@@ -1,13 +1,12 @@
 from datetime import datetime, timedelta
 from http import HTTPStatus
-from hashlib import sha256
 import json
 import os
 from uuid import uuid4
 
 from flask import current_app, request, send_file
 from flask_restful import Resource
-from marshmallow import ValidationError
+from marshmallow import EXCLUDE, ValidationError
 from sqlalchemy import and_, or_
 
 from constants import CHANNEL_INFO, ORDER_FETCH_STATES, OrderStatus
@@ -15,24 +14,95 @@ from database import db
 from error import get_http_error_resp
 from invoice_helpers import new_invoice, pay_invoice
 from models import Order, TxRetry
-from regions import region_number_list_to_code
+from regions import all_region_numbers, region_number_list_to_code
 from schemas import admin_order_schema, order_schema, orders_schema, \
-    order_upload_req_schema, order_bump_schema, \
+    order_upload_req_schema, order_quote_req_schema, order_bump_schema, \
     rx_confirmation_schema, tx_confirmation_schema
 import bidding
 import constants
+import message_store
 import order_helpers
+import scheduler
 import transmitter
 
-SHA256_BLOCK_SIZE = 65536
 
+def send_message_file(order, message_path, admin_mode=False):
+    """Send an order's message file from the message store
+
+    If an internal nginx location is configured for the message store, let
+    nginx serve the file via the X-Accel-Redirect header so that the worker
+    handling the request is released right away. Since nginx cannot evaluate
+    the digest-based ETag, If-None-Match is answered here before redirecting,
+    and requests carrying If-Range are served without nginx. Otherwise, the
+    response supports conditional and range requests. In all cases, the ETag
+    is given by the message digest.
+
+    Compressed message files are sent as they are, with the corresponding
+    Content-Encoding, to clients accepting gzip encoding. For the other
+    clients, they are decompressed on the fly, without range support.
+
+    Messages that were already sent never change, so they can be cached for as
+    long as their files are retained. The other messages must be revalidated.
+
+    """
+    compressed = message_store.is_compressed(message_path)
+    send_encoded = compressed and request.accept_encodings['gzip'] > 0
+
+    if constants.MSG_X_ACCEL_REDIRECT_PREFIX and not compressed and \
+            request.if_none_match.contains(order.message_digest):
+        resp = current_app.response_class(status=HTTPStatus.NOT_MODIFIED)
+        resp.set_etag(order.message_digest)
+    elif constants.MSG_X_ACCEL_REDIRECT_PREFIX and not compressed and \
+            'If-Range' not in request.headers:
+        rel_path = os.path.relpath(message_path, constants.MSG_STORE_PATH)
+        resp = current_app.response_class(mimetype='application/json')
+        resp.headers['X-Accel-Redirect'] = os.path.join(
+            constants.MSG_X_ACCEL_REDIRECT_PREFIX, rel_path)
+        resp.headers['Content-Disposition'] = \
+            f'attachment; filename={order.uuid}'
+        # Served by nginx with this ETag instead of its own (see nginx.conf)
+        resp.set_etag(order.message_digest)
+    elif compressed and not send_encoded:
+        resp = current_app.response_class(
+            message_store.decompress(message_path),
+            mimetype='application/json',
+            direct_passthrough=True)
+        resp.headers['Content-Disposition'] = \
+            f'attachment; filename={order.uuid}'
+        resp.content_length = order.message_size
+        resp.set_etag(order.message_digest)
+    else:
+        resp = send_file(message_path,
+                         mimetype='application/json',
+                         as_attachment=True,
+                         attachment_filename=order.uuid,
+                         add_etags=False)
+        resp.headers['Accept-Ranges'] = 'bytes'
+        if send_encoded:
+            resp.content_encoding = 'gzip'
+            resp.set_etag(order.message_digest + '-gzip')
+        else:
+            resp.set_etag(order.message_digest)
 
-def sha256_checksum(filename, block_size=SHA256_BLOCK_SIZE):
-    msg_hash = sha256()
-    with open(filename, 'rb') as f:
-        for block in iter(lambda: f.read(block_size), b''):
-            msg_hash.update(block)
-    return msg_hash.hexdigest()
+    if compressed:
+        resp.vary.add('Accept-Encoding')
+
+    resp.expires = None
+    if order.status in [OrderStatus.sent.value, OrderStatus.received.value]:
+        resp.headers['Cache-Control'] = '{}, max-age={}, immutable'.format(
+            'private' if admin_mode else 'public',
+            constants.SENT_MESSAGE_CACHE_MAX_AGE)
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+
+    if resp.status_code == HTTPStatus.NOT_MODIFIED or \
+            'X-Accel-Redirect' in resp.headers:
+        return resp
+    if compressed and not send_encoded:
+        return resp.make_conditional(request)
+    return resp.make_conditional(request,
+                                 accept_ranges=True,
+                                 complete_length=resp.content_length)
 
 
 class OrderResource(Resource):
@@ -72,110 +142,367 @@ class OrderResource(Resource):
             return get_http_error_resp('ORDER_CANCELLATION_ERROR',
                                        OrderStatus(order.status).name)
 
-        message_file = os.path.join(constants.MSG_STORE_PATH, order.uuid)
-        if os.path.exists(message_file):
-            os.remove(message_file)
+        message_store.remove(order)
         order.status = OrderStatus.cancelled.value
         order.cancelled_at = datetime.utcnow()
         db.session.commit()
+        scheduler.remove(order)
         return {"message": "order cancelled"}
 
 
-class OrderUploadResource(Resource):
-
-    def post(self):
-        admin_mode = request.path.startswith("/admin/")
-
+def check_upload_preflight(admin_mode):
+    """Check an order upload based on its headers before parsing the body
+
+    The request's Content-Length bounds the message size from above and, once
+    discounting the maximum form overhead, from below. Reject the upload early
+    if the former exceeds the maximum size on the target channel(s) or if the
+    latter is already too large for the declared bid. This avoids writing
+    messages that are going to be rejected into the message store.
+
+    Clients sending the "Expect: 100-continue" header can declare the channel
+    and bid on the query string so that both can be checked in advance.
+    Otherwise, only the maximum size accepted on the route is checked. On the
+    admin route, the bid is only checked if the channel is also declared,
+    given the admin channels may not require payment. Note
+    the WSGI server (gunicorn) answers "100 Continue" before the request
+    reaches the application, and nginx buffers the request body by default,
+    so the body is still transmitted to the server.
+
+    Returns:
+        None if the upload can proceed, or the error response otherwise.
+
+    """
+    content_length = request.content_length
+    if content_length is None:
+        return
+
+    declared = {}
+    query = {}
+    if request.headers.get('Expect', '').lower() == '100-continue':
+        query = request.args
         try:
-            args = order_upload_req_schema.load(request.form)
+            # Ignore the unrelated query parameters (e.g., cache busters)
+            declared = order_upload_req_schema.load(query, unknown=EXCLUDE)
         except ValidationError as error:
             return error.messages, HTTPStatus.BAD_REQUEST
 
-        has_msg = 'message' in args
-        has_file = 'file' in request.files
-
-        channel = args['channel']
+    if 'channel' in query:
+        channel = declared['channel']
         if not admin_mode and 'post' not in \
                 constants.CHANNEL_INFO[channel].user_permissions:
             return get_http_error_resp('ORDER_CHANNEL_UNAUTHORIZED_OP',
                                        channel)
-        requires_payment = CHANNEL_INFO[channel].requires_payment
-
-        if (has_msg and has_file):
-            return "Choose message or file", HTTPStatus.BAD_REQUEST
-
-        if (not (has_msg or has_file)):
-            return get_http_error_resp('MESSAGE_MISSING')
-
-        uuid = str(uuid4())
-        filepath = os.path.join(constants.MSG_STORE_PATH, uuid)
-
-        if (has_msg):
-            with open(filepath, 'w') as fd:
-                fd.write(args['message'])
-        else:
-            file = request.files['file']
-            file.save(filepath)
-
-        msg_size = os.stat(filepath).st_size
-
-        if (msg_size < constants.MIN_MESSAGE_SIZE):
-            os.remove(filepath)
-            return get_http_error_resp('MESSAGE_FILE_TOO_SMALL',
-                                       constants.MIN_MESSAGE_SIZE)
-
-        if (msg_size > constants.CHANNEL_INFO[channel].max_msg_size):
-            os.remove(filepath)
-            return get_http_error_resp(
-                'MESSAGE_FILE_TOO_LARGE',
-                constants.CHANNEL_INFO[channel].max_msg_size / (2**20))
+        max_size = constants.CHANNEL_INFO[channel].max_msg_size
+    else:
+        channel = constants.USER_CHANNEL
+        max_size = message_store.max_upload_size(admin_mode)
+
+    if content_length > max_size + constants.MAX_UPLOAD_FORM_OVERHEAD:
+        return get_http_error_resp('MESSAGE_FILE_TOO_LARGE',
+                                   max_size / (2**20))
+
+    min_msg_size = content_length - constants.MAX_UPLOAD_FORM_OVERHEAD
+    if 'bid' in query and ('channel' in query or not admin_mode) and \
+            min_msg_size > 0 and CHANNEL_INFO[channel].requires_payment and \
+            not bidding.validate_bid(min_msg_size, declared['bid']):
+        return get_http_error_resp('BID_TOO_SMALL',
+                                   bidding.get_min_bid(min_msg_size))
+
+
+def build_order(upload, args):
+    """Build an order for a message upload
+
+    Check the message size and bid, create the order and its invoice, and
+    save the uploaded message into the message store. The order is not added
+    to the database session. The upload is closed in any case.
+
+    Args:
+        upload (MessageUpload): Message upload.
+        args (dict): Order upload request arguments (see OrderUploadReqSchema)
+            whose channel is already authorized.
+
+    Returns:
+        Pair with a boolean indicating success and the new order, or the
+        error response on failure.
+
+    """
+    channel = args['channel']
+    requires_payment = CHANNEL_INFO[channel].requires_payment
+    uuid = str(uuid4())
+
+    with upload:
+        msg_size = upload.size
+        error = order_helpers.check_message_size(msg_size, channel)
+        if error:
+            return False, error
 
         bid = int(args.get('bid')) if requires_payment else 0
         if (requires_payment and not bidding.validate_bid(msg_size, bid)):
-            os.remove(filepath)
             min_bid = bidding.get_min_bid(msg_size)
-            return get_http_error_resp('BID_TOO_SMALL', min_bid)
+            return False, get_http_error_resp('BID_TOO_SMALL', min_bid)
 
-        msg_digest = sha256_checksum(filepath)
         starting_state = OrderStatus.pending.value if requires_payment \
             else OrderStatus.paid.value
         new_order = Order(uuid=uuid,
-                          unpaid_bid=bid,
+                          unpaid_bid=0,
                           message_size=msg_size,
-                          message_digest=msg_digest,
+                          message_digest=upload.digest,
                           status=starting_state,
                           channel=channel)
 
         if requires_payment:
             success, invoice = new_invoice(new_order, bid)
             if not success:
-                return invoice
-            new_order.invoices.append(invoice)
+                return False, invoice
+            order_helpers.add_invoice(new_order, invoice)
 
-        if 'regions' in args:
-            regions_in_request = json.loads(args['regions'])
-            new_order.region_code = region_number_list_to_code(
-                regions_in_request)
+        message_store.save(upload, uuid)
 
-        db.session.add(new_order)
-        db.session.commit()
+    if 'regions' in args:
+        regions_in_request = json.loads(args['regions'])
+        new_order.region_code = region_number_list_to_code(regions_in_request)
 
-        if constants.FORCE_PAYMENT and requires_payment:
-            current_app.logger.info('force payment of the invoice')
-            pay_invoice(invoice)
-            transmitter.tx_start(new_order.channel)
-        elif not requires_payment:
-            transmitter.tx_start(new_order.channel)
+    return True, new_order
 
-        # Return the invoice only if the channel requires payment for orders
-        resp = {
-            'auth_token': order_helpers.compute_auth_token(uuid),
-            'uuid': uuid
+
+def start_new_order(order):
+    """Get a newly committed order going
+
+    Returns:
+        Boolean indicating whether the order is ready for transmission.
+
+    """
+    if not CHANNEL_INFO[order.channel].requires_payment:
+        scheduler.push(order)
+        return True
+
+    if constants.FORCE_PAYMENT:
+        current_app.logger.info('force payment of the invoice')
+        pay_invoice(order.invoices[0])
+        return True
+
+    return False
+
+
+def new_order_resp(order):
+    """Response to the upload of a newly created order"""
+    resp = {
+        'auth_token': order_helpers.compute_auth_token(order.uuid),
+        'uuid': order.uuid
+    }
+    # Return the invoice only if the channel requires payment for orders
+    if CHANNEL_INFO[order.channel].requires_payment:
+        resp['lightning_invoice'] = json.loads(order.invoices[0].invoice)
+    return resp
+
+
+def create_order(upload, args):
+    """Create an order for a message upload
+
+    Build the order (see build_order), commit it to the database, and start
+    its transmission if it is ready.
+
+    Returns:
+        The response to the order upload request.
+
+    """
+    success, new_order = build_order(upload, args)
+    if not success:
+        return new_order
+
+    db.session.add(new_order)
+    db.session.commit()
+
+    if start_new_order(new_order):
+        transmitter.tx_start(new_order.channel)
+
+    return new_order_resp(new_order)
+
+
+class OrderBatchUploadResource(Resource):
+    """Upload of multiple orders in a single request
+
+    The body must provide the message files as multiple "file" parts and an
+    "orders" parameter with a JSON list holding the order upload arguments of
+    each message (see OrderUploadReqSchema). The list entries providing a
+    text message are matched to no file, and the others are matched to the
+    message files in order.
+
+    All valid orders are committed to the database at once, and the
+    transmissions are started once per affected channel. The response holds
+    the individual result of each order, including its HTTP status code.
+
+    """
+
+    def post(self):
+        # Close all the uploads on every return path, including the files
+        # parsed before an error and the uploads never handed to build_order.
+        # Closing an upload already closed (or saved) is harmless.
+        text_uploads = []
+        try:
+            return self._post(text_uploads)
+        finally:
+            for upload in request.message_uploads + text_uploads:
+                upload.close()
+
+    def _post(self, text_uploads):
+        try:
+            files = request.files.getlist('file')
+            entries = json.loads(request.form.get('orders', '[]'))
+        except message_store.MessageTooLarge as error:
+            return get_http_error_resp('MESSAGE_FILE_TOO_LARGE',
+                                       error.max_size / (2**20))
+        except json.JSONDecodeError:
+            return "Invalid orders list", HTTPStatus.BAD_REQUEST
+
+        if not isinstance(entries, list) or \
+                not all(isinstance(x, dict) for x in entries):
+            return "Invalid orders list", HTTPStatus.BAD_REQUEST
+
+        if len(entries) == 0:
+            return get_http_error_resp('MESSAGE_MISSING')
+
+        if len(entries) > constants.MAX_BATCH_ORDERS:
+            return f"Up to {constants.MAX_BATCH_ORDERS} orders per batch", \
+                HTTPStatus.BAD_REQUEST
+
+        if len(files) != sum('message' not in x for x in entries):
+            return "Expected one message file per order without a text " \
+                "message", HTTPStatus.BAD_REQUEST
+
+        files = iter(files)
+        results = []
+        for entry in entries:
+            if 'message' in entry:
+                upload = message_store.MessageUpload(
+                    message_store.max_upload_size(admin_mode=True))
+                text_uploads.append(upload)
+            else:
+                upload = next(files).stream
+
+            # Accept the regions as a list, besides the string format taken
+            # by the regular order upload
+            if isinstance(entry.get('regions'), list):
+                entry['regions'] = json.dumps(entry['regions'])
+
+            try:
+                args = order_upload_req_schema.load(entry)
+            except ValidationError as error:
+                upload.close()
+                results.append(
+                    (False, (error.messages, HTTPStatus.BAD_REQUEST)))
+                continue
+
+            if 'message' in args:
+                upload.write(args['message'].encode())
+
+            results.append(build_order(upload, args))
+
+        new_orders = [order for success, order in results if success]
+        db.session.add_all(new_orders)
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Do not leave the saved messages behind without their orders
+            for order in new_orders:
+                message_store.remove(order)
+            raise
+
+        channels = set(order.channel for order in new_orders
+                       if start_new_order(order))
+        for channel in sorted(channels):
+            transmitter.tx_start(channel)
+
+        resp = []
+        for success, result in results:
+            if success:
+                resp.append(
+                    dict(new_order_resp(result), status=HTTPStatus.OK.value))
+            else:
+                error, status = result
+                resp.append(dict(error, status=status.value))
+
+        return {'orders': resp}
+
+
+class OrderQuoteResource(Resource):
+
+    def get(self):
+        admin_mode = request.path.startswith("/admin/")
+
+        try:
+            args = order_quote_req_schema.load(request.args)
+        except ValidationError as error:
+            return error.messages, HTTPStatus.BAD_REQUEST
+
+        channel = args['channel']
+        if not admin_mode and 'post' not in \
+                constants.CHANNEL_INFO[channel].user_permissions:
+            return get_http_error_resp('ORDER_CHANNEL_UNAUTHORIZED_OP',
+                                       channel)
+        requires_payment = CHANNEL_INFO[channel].requires_payment
+
+        msg_size = args['size']
+        error = order_helpers.check_message_size(msg_size, channel)
+        if error:
+            return error
+
+        regions = json.loads(args['regions']) if 'regions' in args \
+            else all_region_numbers
+
+        return {
+            'size': msg_size,
+            'channel': channel,
+            'regions': regions,
+            'ota_msg_len': bidding.calc_ota_msg_len(msg_size),
+            'min_bid':
+            bidding.get_min_bid(msg_size) if requires_payment else 0,
+            'max_msg_size': constants.CHANNEL_INFO[channel].max_msg_size,
+            'requires_payment': requires_payment
         }
-        if requires_payment:
-            resp['lightning_invoice'] = json.loads(invoice.invoice)
 
-        return resp
+
+class OrderUploadResource(Resource):
+
+    def post(self):
+        admin_mode = request.path.startswith("/admin/")
+
+        error = check_upload_preflight(admin_mode)
+        if error:
+            return error
+
+        try:
+            args = order_upload_req_schema.load(request.form)
+        except ValidationError as error:
+            return error.messages, HTTPStatus.BAD_REQUEST
+        except message_store.MessageTooLarge as error:
+            return get_http_error_resp('MESSAGE_FILE_TOO_LARGE',
+                                       error.max_size / (2**20))
+
+        has_msg = 'message' in args
+        has_file = 'file' in request.files
+
+        channel = args['channel']
+        if not admin_mode and 'post' not in \
+                constants.CHANNEL_INFO[channel].user_permissions:
+            return get_http_error_resp('ORDER_CHANNEL_UNAUTHORIZED_OP',
+                                       channel)
+
+        if (has_msg and has_file):
+            return "Choose message or file", HTTPStatus.BAD_REQUEST
+
+        if (not (has_msg or has_file)):
+            return get_http_error_resp('MESSAGE_MISSING')
+
+        if (has_msg):
+            upload = message_store.MessageUpload(
+                message_store.max_upload_size(admin_mode))
+            upload.write(args['message'].encode())
+        else:
+            upload = request.files['file'].stream
+
+        return create_order(upload, args)
 
 
 class BumpOrderResource(Resource):
@@ -206,8 +533,7 @@ class BumpOrderResource(Resource):
         if not success:
             return invoice
 
-        order.invoices.append(invoice)
-        order_helpers.adjust_bids(order)
+        order_helpers.add_invoice(order, invoice)
         db.session.commit()
 
         return {
@@ -329,11 +655,11 @@ class GetMessageResource(Resource):
         if not order:
             return get_http_error_resp('ORDER_NOT_FOUND', uuid)
 
-        message_path = os.path.join(constants.MSG_STORE_PATH, uuid)
-        return send_file(message_path,
-                         mimetype='application/json',
-                         as_attachment=True,
-                         add_etags=False)
+        message_path = message_store.find_message(uuid)
+        if not message_path:
+            return get_http_error_resp('ORDER_NOT_FOUND', uuid)
+
+        return send_message_file(order, message_path)
 
 
 class GetMessageBySeqNumResource(Resource):
@@ -354,11 +680,11 @@ class GetMessageBySeqNumResource(Resource):
             return get_http_error_resp('ORDER_CHANNEL_UNAUTHORIZED_OP',
                                        order.channel)
 
-        message_path = os.path.join(constants.MSG_STORE_PATH, order.uuid)
-        return send_file(message_path,
-                         mimetype='application/json',
-                         as_attachment=True,
-                         add_etags=False)
+        message_path = message_store.find_message(order.uuid)
+        if not message_path:
+            return get_http_error_resp('SEQUENCE_NUMBER_NOT_FOUND', tx_seq_num)
+
+        return send_message_file(order, message_path, admin_mode)
 
 
 class TxConfirmationResource(Resource):
@@ -406,6 +732,11 @@ class TxConfirmationResource(Resource):
                 last_status == OrderStatus.transmitting.value:
             transmitter.tx_start(order.channel)
 
+        # The Tx confirmation timeout restarts on every confirmation received
+        # while the order remains in confirming state
+        if order.status == OrderStatus.confirming.value:
+            order_helpers.schedule_retransmission(order)
+
         return {
             'message': f'transmission confirmed for regions {args["regions"]}'
         }
@@ -0,0 +1,94 @@
+"""Lightning Charge payment stream consumer
+
+Lightning Charge publishes every paid invoice on its /payment-stream endpoint
+as a server-sent event whose data is the invoice in JSON format. The consumer
+keeps a connection open to this endpoint on a background thread and queues
+the ids of the paid invoices, which are then processed in batches (see
+worker_manager.process_payments). This way, the API server does not need to
+register a payment webhook for each invoice.
+
+"""
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+import requests
+
+import constants
+import lightning_charge
+
+MAX_RECONNECT_DELAY = 30  # seconds
+
+
+class PaymentStreamConsumer:
+    """Consumer of the Lightning Charge payment stream
+
+    Attributes:
+        paid (queue.Queue): Ids of the paid invoices received on the stream.
+        connected (bool): Whether the payment stream is currently connected.
+        missed_payments (bool): Whether payments may have been missed, namely
+            before the first connection or while disconnected. In this case,
+            the caller should poll the pending invoices instead.
+        poll_cursor (int): Id of the last invoice polled by the ongoing pass
+            over the pending invoices, or None if no pass is ongoing.
+
+    """
+
+    def __init__(self):
+        self.paid = queue.Queue()
+        self.connected = False
+        self.missed_payments = True
+        self.poll_cursor = None
+        self.enable = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        logging.info("Starting the payment stream consumer")
+        self.thread.start()
+
+    def stop(self):
+        self.enable = False
+
+    def consume(self, lines):
+        """Queue the paid invoices from the event stream lines"""
+        for line in lines:
+            if not self.enable:
+                break
+            if not line.startswith('data:'):
+                continue
+            try:
+                invoice = json.loads(line[len('data:'):])
+            except json.JSONDecodeError:
+                logging.warning(f"Invalid payment stream event: {line}")
+                continue
+            if isinstance(invoice, dict) and 'id' in invoice:
+                self.paid.put(invoice['id'])
+
+    def connect(self):
+        """Connect to the payment stream and consume it until disconnected"""
+        # No read timeout, as the stream can be idle for long periods
+        with lightning_charge.get("/payment-stream",
+                                  stream=True,
+                                  timeout=(constants.CONNECTION_TIMEOUT,
+                                           None)) as response:
+            response.raise_for_status()
+            self.connected = True
+            logging.info("Connected to the Lightning Charge payment stream")
+            self.consume(response.iter_lines(decode_unicode=True))
+
+    def loop(self):
+        attempt = 0
+        while self.enable:
+            try:
+                self.connect()
+                attempt = 0
+            except requests.exceptions.RequestException as e:
+                logging.warning(f"Payment stream error: {e}")
+            self.connected = False
+            self.missed_payments = True
+            # Reconnect with jittered exponential backoff
+            time.sleep(random.uniform(0, min(MAX_RECONNECT_DELAY, 2**attempt)))
+            attempt += 1
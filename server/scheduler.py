@@ -0,0 +1,366 @@
+"""Transmission scheduler
+
+Keeps two priority queues per channel: one with the paid orders waiting for
+transmission and another with the orders pending retransmission. Both are
+ordered by bid per byte (highest first) and, among equal bids, by order id
+(oldest first), so that picking the next order to transmit does not scan the
+orders table.
+
+The queues are Redis sorted sets, so that they are shared by the API server
+processes and the workers and survive restarts. They are updated whenever an
+order is paid (or gets a higher paid bid), cancelled, scheduled for
+retransmission, or transmitted, and rebuilt from the database by the workers
+(see rebuild). The database remains the source of truth: the orders picked
+from the queues are checked against the database, and stale entries are
+discarded. When Redis is unavailable, the callers fall back to querying the
+database directly.
+
+Additionally, the scheduler keeps the retransmission timers of the orders
+awaiting Tx confirmations, i.e., the times after which each order is due for
+retransmission. They are kept on another sorted set, scored by the deadline,
+which works as a min-heap shared by all processes and persisted across
+restarts (see due_deadlines).
+
+"""
+from datetime import datetime
+import logging
+from math import ceil
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+import constants
+from database import db
+from models import Order, TxRetry
+
+PAID_QUEUE = 'scheduler:paid:{}'
+RETRY_QUEUE = 'scheduler:retry:{}'
+DRR_STATE = 'scheduler:drr'
+DEADLINES = 'scheduler:deadlines'
+
+
+class SchedulerUnavailable(Exception):
+    """Exception raised when the queues cannot be read"""
+
+
+def redis():
+    return current_app.config.get("REDIS_INSTANCE")
+
+
+def _member(order_id):
+    # Zero-padded so that the lexicographic order of the members breaks ties
+    # in favor of the oldest orders
+    return f'{order_id:012d}'
+
+
+def _score(order):
+    # Sorted sets are ascending, so negate the bid to serve the highest first
+    return -order.bid_per_byte
+
+
+def _add(key, order):
+    try:
+        redis().zadd(key.format(order.channel),
+                     {_member(order.id): _score(order)})
+    except RedisError as e:
+        logging.warning(f"Failed to queue order {order.uuid}: {e}")
+
+
+def push(order):
+    """Queue a paid order for transmission (or update its bid)"""
+    _add(PAID_QUEUE, order)
+
+
+def push_retry(order):
+    """Queue an order for retransmission"""
+    _add(RETRY_QUEUE, order)
+
+
+def remove(order):
+    """Remove an order from the queues of its channel"""
+    try:
+        redis().zrem(PAID_QUEUE.format(order.channel), _member(order.id))
+        redis().zrem(RETRY_QUEUE.format(order.channel), _member(order.id))
+    except RedisError as e:
+        logging.warning(f"Failed to dequeue order {order.uuid}: {e}")
+
+
+def _peek(key, is_valid):
+    """Get the first valid entry of a queue
+
+    Args:
+        key (str): Queue key.
+        is_valid (callable): Function that validates the order id of each
+            entry against the database and returns the corresponding database
+            record(s), or None if the entry is stale.
+
+    Raises:
+        SchedulerUnavailable: If the queue cannot be read.
+
+    """
+    try:
+        while True:
+            entries = redis().zrange(key, 0, 0)
+            if not entries:
+                return None
+            res = is_valid(int(entries[0]))
+            if res is not None:
+                return res
+            redis().zrem(key, entries[0])
+    except RedisError as e:
+        raise SchedulerUnavailable(e)
+
+
+def next_order(channel):
+    """Get the next paid order to transmit on a channel
+
+    Returns:
+        The paid order with the highest bid per byte or None if there is no
+        paid order waiting for transmission.
+
+    Raises:
+        SchedulerUnavailable: If the queue cannot be read.
+
+    """
+
+    def is_valid(order_id):
+        # Filter on the database values, not on the session's (possibly
+        # stale) copy, given the order may have changed on another process
+        return Order.query.filter_by(
+            id=order_id,
+            channel=channel,
+            status=constants.OrderStatus.paid.value).first()
+
+    return _peek(PAID_QUEUE.format(channel), is_valid)
+
+
+def next_retransmission(channel):
+    """Get the next order to retransmit on a channel
+
+    Returns:
+        Pair with the order pending retransmission with the highest bid per
+        byte and its retransmission record, or (None, None) if there is no
+        order pending retransmission.
+
+    Raises:
+        SchedulerUnavailable: If the queue cannot be read.
+
+    """
+
+    def is_valid(order_id):
+        res = db.session.query(Order, TxRetry).filter(
+            Order.id == order_id, TxRetry.order_id == Order.id,
+            Order.channel == channel, TxRetry.pending.is_(True)).first()
+        return tuple(res) if res is not None else None
+
+    return _peek(RETRY_QUEUE.format(channel), is_valid) or (None, None)
+
+
+def rebuild():
+    """Rebuild the queues from the database
+
+    Queue all the paid orders and all the orders pending retransmission, and
+    drop the queue entries that no longer apply. Entries are only added or
+    removed individually (rather than replacing the whole queues) so that
+    concurrent updates from the API server are not lost.
+
+    The queues are read before the database so that the orders queued by the
+    API server after the database snapshot are neither taken as stale nor
+    reset to an older bid. Only the entries that were already queued before
+    the snapshot can be dropped, and the scores of the queued entries are only
+    raised in priority, since the paid bids never decrease.
+
+    """
+    try:
+        queued = {
+            key.format(channel):
+            dict(redis().zrange(key.format(channel), 0, -1, withscores=True))
+            for channel in constants.CHANNELS
+            for key in [PAID_QUEUE, RETRY_QUEUE]
+        }
+    except RedisError as e:
+        logging.warning(f"Failed to rebuild the scheduler queues: {e}")
+        return
+
+    paid_orders = Order.query.filter_by(
+        status=constants.OrderStatus.paid.value).all()
+    retry_orders = db.session.query(Order).filter(
+        Order.id == TxRetry.order_id, TxRetry.pending.is_(True)).all()
+
+    try:
+        for channel in constants.CHANNELS:
+            for key, orders in [(PAID_QUEUE, paid_orders),
+                                (RETRY_QUEUE, retry_orders)]:
+                key = key.format(channel)
+                entries = {
+                    _member(order.id): _score(order)
+                    for order in orders if order.channel == channel
+                }
+                updates = {
+                    member: score
+                    for member, score in entries.items()
+                    if score < queued[key].get(member.encode(), float('inf'))
+                }
+                stale = set(queued[key]) - set(x.encode() for x in entries)
+                if updates:
+                    redis().zadd(key, updates)
+                if stale:
+                    redis().zrem(key, *stale)
+    except RedisError as e:
+        logging.warning(f"Failed to rebuild the scheduler queues: {e}")
+
+
+def _timestamp(dt):
+    # Deadlines are naive UTC datetimes, like the database timestamps
+    return (dt - datetime(1970, 1, 1)).total_seconds()
+
+
+def set_deadline(order, deadline):
+    """Set (or reset) the retransmission timer of an order
+
+    Args:
+        order (Order): Order awaiting Tx confirmations.
+        deadline (datetime): Naive UTC time after which the order is due for
+            retransmission.
+
+    """
+    try:
+        redis().zadd(DEADLINES, {_member(order.id): _timestamp(deadline)})
+    except RedisError as e:
+        logging.warning(
+            f"Failed to set the retransmission timer of order {order.uuid}: "
+            f"{e}")
+
+
+def clear_deadline(order_id):
+    """Cancel the retransmission timer of an order"""
+    try:
+        redis().zrem(DEADLINES, _member(order_id))
+    except RedisError as e:
+        logging.warning(
+            f"Failed to clear the retransmission timer of order {order_id}: "
+            f"{e}")
+
+
+def due_deadlines(now):
+    """Get the orders whose retransmission timers expired
+
+    Args:
+        now (datetime): Current naive UTC time.
+
+    Returns:
+        List with the ids of the orders due for retransmission, earliest
+        deadline first. The timers are not cleared, as the orders may no
+        longer require retransmission (e.g., due to Tx confirmations received
+        after the timer was set), which is up to the caller to verify.
+
+    Raises:
+        SchedulerUnavailable: If the timers cannot be read.
+
+    """
+    try:
+        entries = redis().zrangebyscore(DEADLINES, '-inf', _timestamp(now))
+    except RedisError as e:
+        raise SchedulerUnavailable(e)
+    return [int(x) for x in entries]
+
+
+def drr_quantum(channel):
+    return constants.DRR_QUANTUM_BYTES * constants.CHANNEL_INFO[channel].weight
+
+
+def new_drr_state():
+    return {
+        'deficits': {
+            channel: 0
+            for channel in constants.CHANNELS
+        },
+        'ptr': 0,
+        'granted': False
+    }
+
+
+def drr_pick(heads, idle, state):
+    """Pick the next channel to transmit on the shared carrier
+
+    Deficit round-robin over the over-the-air bytes: the channels are visited
+    in a round-robin fashion and, on each visit, a channel is granted a
+    quantum of bytes proportional to its weight (see drr_quantum), which
+    accumulates on its deficit counter. The channel can transmit its next
+    order when the order's length fits in the deficit, which is then
+    decreased by the length. Hence, in the long run, each channel gets a share
+    of the carrier proportional to its weight, regardless of its message
+    sizes. Idle channels lose their deficit, so that the capacity they leave
+    unused goes to the other channels.
+
+    Args:
+        heads (dict): Over-the-air length of the next order of each channel
+            eligible for transmission.
+        idle (set): Channels without orders to transmit. The channels in
+            neither of the two arguments (e.g., with a full in-flight window)
+            are skipped without losing their deficits.
+        state (dict): DRR state (see new_drr_state), updated in place.
+
+    Returns:
+        The channel to transmit on or None if no channel is eligible.
+
+    """
+    channels = constants.CHANNELS
+    deficits = state['deficits']
+    for channel in idle:
+        deficits[channel] = 0
+
+    if not heads:
+        return None
+
+    while True:
+        for _ in range(len(channels)):
+            channel = channels[state['ptr']]
+            if channel in heads:
+                if not state['granted']:
+                    deficits[channel] += drr_quantum(channel)
+                    state['granted'] = True
+                if heads[channel] <= deficits[channel]:
+                    deficits[channel] -= heads[channel]
+                    return channel
+            state['ptr'] = (state['ptr'] + 1) % len(channels)
+            state['granted'] = False
+
+        # No channel could transmit in a full round (e.g., only channels with
+        # large messages are eligible). Skip the rounds in which none would.
+        n_rounds = min(
+            ceil((heads[x] - deficits[x]) / drr_quantum(x)) for x in heads) - 1
+        for channel in heads:
+            deficits[channel] += n_rounds * drr_quantum(channel)
+
+
+def load_drr_state():
+    """Load the DRR state shared by all processes from Redis"""
+    state = new_drr_state()
+    try:
+        fields = {
+            k.decode(): v.decode()
+            for k, v in redis().hgetall(DRR_STATE).items()
+        }
+    except RedisError as e:
+        logging.warning(f"Failed to load the DRR state: {e}")
+        return state
+
+    for channel in constants.CHANNELS:
+        state['deficits'][channel] = float(fields.get(f'deficit:{channel}', 0))
+    state['ptr'] = int(fields.get('ptr', 0)) % len(constants.CHANNELS)
+    state['granted'] = fields.get('granted') == '1'
+    return state
+
+
+def save_drr_state(state):
+    mapping = {
+        f'deficit:{channel}': deficit
+        for channel, deficit in state['deficits'].items()
+    }
+    mapping['ptr'] = state['ptr']
+    mapping['granted'] = int(state['granted'])
+    try:
+        redis().hset(DRR_STATE, mapping=mapping)
+    except RedisError as e:
+        logging.warning(f"Failed to save the DRR state: {e}")
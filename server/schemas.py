@@ -71,6 +71,32 @@ class OrderUploadReqSchema(Schema):
                          validate=validate.OneOf(constants.CHANNELS))
 
 
+class OrderQuoteReqSchema(Schema):
+    size = fields.Int(required=True, validate=validate.Range(min=0))
+    regions = fields.String(required=False,
+                            validate=must_be_region_number_list)
+    channel = fields.Int(missing=constants.USER_CHANNEL,
+                         validate=validate.OneOf(constants.CHANNELS))
+
+
+class UploadSessionReqSchema(Schema):
+    size = fields.Int(required=True, validate=validate.Range(min=0))
+    channel = fields.Int(missing=constants.USER_CHANNEL,
+                         validate=validate.OneOf(constants.CHANNELS))
+
+
+class UploadChunkReqSchema(Schema):
+    offset = fields.Int(required=True, validate=validate.Range(min=0))
+
+
+class UploadSessionFinalizeReqSchema(Schema):
+    bid = fields.Int(missing=0, validate=validate.Range(min=0))
+    regions = fields.String(required=False,
+                            validate=must_be_region_number_list)
+    sha256 = fields.Str(required=True,
+                        validate=validate.Regexp('^[0-9a-f]{64}$'))
+
+
 class OrderBumpSchema(Schema):
     uuid = fields.String()
     bid_increase = fields.Int(required=True, validate=validate.Range(min=0))
@@ -109,6 +135,10 @@ class RxConfirmationSchema(Schema):
 order_schema = OrderSchema()
 admin_order_schema = AdminOrderSchema()
 order_upload_req_schema = OrderUploadReqSchema()
+order_quote_req_schema = OrderQuoteReqSchema()
+upload_session_req_schema = UploadSessionReqSchema()
+upload_chunk_req_schema = UploadChunkReqSchema()
+upload_session_finalize_req_schema = UploadSessionFinalizeReqSchema()
 order_bump_schema = OrderBumpSchema()
 orders_schema = OrdersSchema()
 tx_confirmation_schema = TxConfirmationSchema()
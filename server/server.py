@@ -8,35 +8,50 @@ import redis
 
 import constants
 from database import db
-from info import InfoResource
-from invoices import InvoiceResource
+from info import InfoCache, InfoResource
+from invoices import InvoiceResource, RecentCallbacks
+from message_store import MessageUploadRequest
 from orders import \
     BumpOrderResource, \
     GetMessageBySeqNumResource, \
     GetMessageResource, \
+    OrderBatchUploadResource, \
     OrderResource, \
     OrdersResource, \
+    OrderQuoteResource, \
     OrderUploadResource, \
     RxConfirmationResource, \
     TxConfirmationResource
 from queues import QueueResource
+from transmitter import TxLockStatsResource
+from upload_sessions import UploadSessionResource, UploadSessionsResource
 
 
 def create_app(from_test=False):
-    if not os.path.isdir(constants.MSG_STORE_PATH):
-        os.makedirs(constants.MSG_STORE_PATH)
+    for path in [constants.MSG_BLOB_PATH, constants.UPLOAD_SESSION_PATH]:
+        if not os.path.isdir(path):
+            os.makedirs(path)
 
     app = Flask(__name__)
+    app.request_class = MessageUploadRequest
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{constants.DB_FILE}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['TESTING'] = from_test
     app.config["REDIS_INSTANCE"] = redis.from_url(constants.REDIS_URI)
+    app.config["INFO_CACHE"] = InfoCache(constants.INFO_CACHE_TTL_SECS,
+                                         constants.INFO_CACHE_GRACE_SECS)
+    app.config["RECENT_CALLBACKS"] = RecentCallbacks(
+        constants.PAYMENT_CALLBACK_DEDUP_SECS)
 
     db.init_app(app)
     with app.app_context():
         db.create_all()
     api = Api(app)
     api.add_resource(OrderUploadResource, '/order', '/admin/order')
+    api.add_resource(OrderQuoteResource, '/order/quote', '/admin/order/quote')
+    api.add_resource(OrderBatchUploadResource, '/admin/order/batch')
+    api.add_resource(UploadSessionsResource, '/admin/order/upload')
+    api.add_resource(UploadSessionResource, '/admin/order/upload/<session_id>')
     api.add_resource(OrdersResource, '/orders/<state>',
                      '/admin/orders/<state>')
     api.add_resource(OrderResource, '/order/<uuid>', '/admin/order/<uuid>')
@@ -48,6 +63,7 @@ def create_app(from_test=False):
     api.add_resource(GetMessageBySeqNumResource, '/message/<tx_seq_num>',
                      '/admin/message/<tx_seq_num>')
     api.add_resource(QueueResource, '/queue.html')
+    api.add_resource(TxLockStatsResource, '/admin/tx/lock-stats')
 
     if constants.env == 'development' or constants.env == 'test':
         api.add_resource(GetMessageResource, '/order/<uuid>/sent_message')
@@ -4,6 +4,7 @@ import json
 import os
 import random
 import string
+import threading
 from http import HTTPStatus
 
 from database import db
@@ -11,6 +12,7 @@ from models import Invoice, Order
 from utils import hmac_sha256_digest
 import bidding
 import constants
+import message_store
 
 
 def rnd_string(n_bytes):
@@ -47,7 +49,7 @@ def place_order(client,
 
 
 def check_upload(order_uuid, expected_data):
-    path = os.path.join(constants.MSG_STORE_PATH, order_uuid)
+    path = message_store.message_path(order_uuid)
     assert os.path.exists(path)
 
     with open(path) as fd:
@@ -186,3 +188,108 @@ def generate_test_order(mock_new_invoice,
 
     db.session.commit()
     return post_rv.get_json()
+
+
+class FakeLock:
+    """In-memory stand-in for the Redis lock (without the lease)"""
+
+    def __init__(self, lock, blocking_timeout):
+        self.lock = lock
+        self.blocking_timeout = blocking_timeout
+
+    def acquire(self):
+        timeout = -1 if self.blocking_timeout is None else \
+            self.blocking_timeout
+        return self.lock.acquire(timeout=timeout)
+
+    def release(self):
+        self.lock.release()
+
+
+class FakeRedis:
+    """In-memory stand-in for the subset of the Redis API used by the server
+
+    Implements publishing (as a no-op), locks, the hash commands used for the
+    transmission lock statistics, and the sorted set commands used by the
+    transmission scheduler, with members and fields stored as bytes, like in
+    Redis. Pipelined commands are executed right away.
+
+    """
+
+    def __init__(self):
+        self.zsets = {}
+        self.hashes = {}
+        self.locks = {}
+        self._lock = threading.Lock()
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+    def lock(self, name, timeout=None, blocking_timeout=None):
+        with self._lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        return FakeLock(lock, blocking_timeout)
+
+    def hincrby(self, key, field, amount=1):
+        with self._lock:
+            fields = self.hashes.setdefault(key, {})
+            value = int(fields.get(field.encode(), 0)) + amount
+            fields[field.encode()] = str(value).encode()
+        return value
+
+    def hincrbyfloat(self, key, field, amount=1.0):
+        with self._lock:
+            fields = self.hashes.setdefault(key, {})
+            value = float(fields.get(field.encode(), 0)) + amount
+            fields[field.encode()] = repr(value).encode()
+        return value
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        mapping = dict(mapping or {})
+        if field is not None:
+            mapping[field] = value
+        with self._lock:
+            fields = self.hashes.setdefault(key, {})
+            for k, v in mapping.items():
+                fields[k.encode()] = str(v).encode()
+        return len(mapping)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def publish(self, channel, message):
+        return 0
+
+    def zadd(self, key, mapping):
+        zset = self.zsets.setdefault(key, {})
+        for member, score in mapping.items():
+            zset[member.encode() if isinstance(member, str) else member] = \
+                score
+        return len(mapping)
+
+    def zrem(self, key, *members):
+        zset = self.zsets.get(key, {})
+        members = [x.encode() if isinstance(x, str) else x for x in members]
+        return sum(zset.pop(x, None) is not None for x in members)
+
+    def zrange(self, key, start, end, withscores=False):
+        zset = self.zsets.get(key, {})
+        members = sorted(zset, key=lambda x: (zset[x], x))
+        members = members[start:] if end == -1 else members[start:end + 1]
+        if withscores:
+            return [(x, float(zset[x])) for x in members]
+        return members
+
+    def zrangebyscore(self, key, min, max):
+        zset = self.zsets.get(key, {})
+        min, max = float(min), float(max)
+        return [
+            x for x in sorted(zset, key=lambda x: (zset[x], x))
+            if min <= zset[x] <= max
+        ]
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
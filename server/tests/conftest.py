@@ -1,9 +1,12 @@
 import pytest
 
+from common import FakeRedis
+
 
 @pytest.fixture
 def mockredis(mocker):
-    _mr = mocker.Mock(name="mockredis")
+    _mr = mocker.Mock(name="mockredis", wraps=FakeRedis())
     mocker.patch("transmitter.redis", return_value=_mr)
+    mocker.patch("scheduler.redis", return_value=_mr)
     mocker.patch("transmitter.redis.from_url", return_value=_mr)
     return _mr
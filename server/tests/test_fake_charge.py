@@ -0,0 +1,117 @@
+import json
+import pytest
+from http import HTTPStatus
+from unittest.mock import patch
+
+from tools import fake_charge
+
+
+@pytest.fixture
+def charge():
+    payer = fake_charge.Payer(fake_charge.parse_delay('const:0'),
+                              rate=0,
+                              pay_ratio=1,
+                              callback_workers=1)
+    app = fake_charge.create_app(payer, fake_charge.parse_delay('const:0'))
+    with app.test_client() as client:
+        yield payer, client
+
+
+def test_parse_delay():
+    assert fake_charge.parse_delay('const:0.5')() == 0.5
+    assert 1 <= fake_charge.parse_delay('uniform:1,2')() <= 2
+    assert fake_charge.parse_delay('exp:1')() >= 0
+    assert fake_charge.parse_delay('lognormal:0,1')() > 0
+    for spec in ['const', 'const:a', 'uniform:1', 'normal:1,2']:
+        with pytest.raises(ValueError):
+            fake_charge.parse_delay(spec)
+
+
+@patch('tools.fake_charge.requests.post')
+def test_invoice_payment(mock_post, charge):
+    payer, client = charge
+    mock_post.return_value.status_code = HTTPStatus.OK
+    rv = client.post('/invoice',
+                     json={
+                         'msatoshi': 1000,
+                         'metadata': {
+                             'uuid': 'some uuid'
+                         }
+                     })
+    assert rv.status_code == HTTPStatus.CREATED
+    invoice = rv.get_json()
+    assert invoice['status'] == 'unpaid'
+    assert invoice['metadata'] == {'uuid': 'some uuid'}
+
+    rv = client.post(f"/invoice/{invoice['id']}/webhook",
+                     json={'url': 'http://api/callback/lid/token'})
+    assert rv.status_code == HTTPStatus.CREATED
+
+    # Pay the invoice as the payer thread would
+    stream = payer.subscribe()
+    payer.pay(invoice['id'])
+    payer._callbacks.shutdown(wait=True)
+    mock_post.assert_called_once_with('http://api/callback/lid/token',
+                                      timeout=30)
+    assert stream.get_nowait()['id'] == invoice['id']
+
+    rv = client.get(f"/invoice/{invoice['id']}")
+    assert rv.get_json()['status'] == 'paid'
+    assert rv.get_json()['paid_at'] is not None
+    assert 'webhooks' not in rv.get_json()
+
+    rv = client.get('/stats')
+    assert rv.get_json() == {
+        'invoices': 1,
+        'paid': 1,
+        'callbacks': 1,
+        'callback_errors': 0
+    }
+
+
+@patch('tools.fake_charge.requests.post')
+@patch('tools.fake_charge.threading.Timer')
+def test_callback_retries(mock_timer, mock_post, charge):
+    payer, _ = charge
+    mock_post.return_value.status_code = HTTPStatus.NOT_FOUND
+    payer._fire_callback('some url')
+    mock_timer.assert_called_once_with(0.1,
+                                       payer._callbacks.submit,
+                                       args=(payer._fire_callback, 'some url',
+                                             1))
+
+    # Bounded retries
+    mock_timer.reset_mock()
+    payer._fire_callback('some url', attempt=5)
+    mock_timer.assert_not_called()
+    assert payer.stats['callback_errors'] == 1
+
+    # Client errors other than not found are not retried
+    mock_post.return_value.status_code = HTTPStatus.BAD_REQUEST
+    payer._fire_callback('some url')
+    mock_timer.assert_not_called()
+    assert payer.stats['callbacks'] == 1
+
+
+def test_payment_stream(charge):
+    payer, client = charge
+    rv = client.post('/invoice', json={'msatoshi': 1000})
+    lid = rv.get_json()['id']
+
+    rv = client.get('/payment-stream')
+    assert rv.status_code == HTTPStatus.OK
+    events = rv.response
+    assert next(events).decode() == ':connected\n\n'
+    payer.pay(lid)
+    event = next(events).decode()
+    assert event.startswith('data:')
+    assert json.loads(event[len('data:'):])['id'] == lid
+    rv.close()
+
+
+def test_unknown_invoice(charge):
+    _, client = charge
+    assert client.get('/invoice/some_lid').status_code == HTTPStatus.NOT_FOUND
+    rv = client.post('/invoice/some_lid/webhook', json={'url': 'some url'})
+    assert rv.status_code == HTTPStatus.NOT_FOUND
+    assert client.get('/info').status_code == HTTPStatus.OK
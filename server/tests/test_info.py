@@ -1,8 +1,10 @@
 import pytest
 import requests
+from flask import current_app
 from http import HTTPStatus
 from unittest.mock import Mock, patch
 
+import constants
 import server
 from error import assert_error
 
@@ -16,7 +18,7 @@ def client():
     server.teardown_app(app)
 
 
-@patch('info.requests.get')
+@patch('info.lightning_charge.get')
 def test_get_info_successfuly(mock_get_info, client):
     mock_get_info.return_value = Mock()
     mock_get_info.return_value.status_code = HTTPStatus.OK
@@ -69,7 +71,7 @@ def test_get_info_successfuly(mock_get_info, client):
     assert get_json_resp == SAMPLE_INFO
 
 
-@patch('info.requests.get')
+@patch('info.lightning_charge.get')
 def test_get_info_failure(mock_get_info, client):
     mock_get_info.return_value = Mock()
     mock_get_info.return_value.status_code = HTTPStatus.UNAUTHORIZED
@@ -78,9 +80,58 @@ def test_get_info_failure(mock_get_info, client):
     assert_error(get_info_rv.get_json(), 'LIGHTNING_CHARGE_INFO_FAILED')
 
 
-@patch('info.requests.get')
+@patch('info.lightning_charge.get')
 def test_get_info_exception(mock_get_info, client):
     mock_get_info.side_effect = requests.exceptions.RequestException
     get_info_rv = client.get('/info')
     assert get_info_rv.status_code == HTTPStatus.INTERNAL_SERVER_ERROR
     assert_error(get_info_rv.get_json(), 'LIGHTNING_CHARGE_INFO_FAILED')
+
+
+@patch('info.time.monotonic')
+@patch('info.lightning_charge.get')
+def test_get_info_cached(mock_get_info, mock_monotonic, client):
+    mock_monotonic.return_value = 1000
+    mock_get_info.return_value = Mock(status_code=HTTPStatus.OK)
+    mock_get_info.return_value.json = lambda: {'blockheight': 1}
+    assert client.get('/info').get_json() == {'blockheight': 1}
+
+    # Served from the cache within the TTL
+    mock_get_info.return_value.json = lambda: {'blockheight': 2}
+    mock_monotonic.return_value += constants.INFO_CACHE_TTL_SECS - 1
+    assert client.get('/info').get_json() == {'blockheight': 1}
+    assert mock_get_info.call_count == 1
+
+    # Once stale, the cached information is served while refreshed in the
+    # background
+    mock_monotonic.return_value += 1
+    assert client.get('/info').get_json() == {'blockheight': 1}
+    info_cache = current_app.config['INFO_CACHE']
+    info_cache.refresh_thread.join()
+    assert mock_get_info.call_count == 2
+    assert client.get('/info').get_json() == {'blockheight': 2}
+
+
+@patch('info.time.monotonic')
+@patch('info.lightning_charge.get')
+def test_get_info_cached_charge_unreachable(mock_get_info, mock_monotonic,
+                                            client):
+    mock_monotonic.return_value = 1000
+    mock_get_info.return_value = Mock(status_code=HTTPStatus.OK)
+    mock_get_info.return_value.json = lambda: {'blockheight': 1}
+    assert client.get('/info').get_json() == {'blockheight': 1}
+
+    # The last good information is served during the grace period
+    mock_get_info.side_effect = requests.exceptions.RequestException
+    info_cache = current_app.config['INFO_CACHE']
+    mock_monotonic.return_value += constants.INFO_CACHE_TTL_SECS
+    for _ in range(2):
+        rv = client.get('/info')
+        assert rv.status_code == HTTPStatus.OK
+        assert rv.get_json() == {'blockheight': 1}
+        info_cache.refresh_thread.join()
+        mock_monotonic.return_value += constants.INFO_CACHE_GRACE_SECS - 1
+
+    # And not afterwards
+    rv = client.get('/info')
+    assert_error(rv.get_json(), 'LIGHTNING_CHARGE_INFO_FAILED')
@@ -33,12 +33,16 @@ def test_expire_pending_invoice(mock_new_invoice, client):
 
     db_invoice = \
         Invoice.query.filter_by(lid=invoice_id).first()
-    invoice_helpers.expire_invoice(db_invoice)
+    db_invoice.expires_at = datetime.utcnow() - timedelta(days=1)
+    db.session.commit()
+    assert invoice_helpers.expire_unpaid_invoices()[0] == [invoice_id]
 
     # refetch and check
     db_invoice = \
         Invoice.query.filter_by(lid=invoice_id).first()
     assert db_invoice.status == InvoiceStatus.expired.value
+    assert db_invoice.order.unpaid_bid == 0
+    assert db_invoice.order.pending_invoices == 0
 
 
 @patch('orders.new_invoice')
@@ -51,7 +55,9 @@ def test_expire_non_pending_invoice(mock_new_invoice, client, status):
 
     db_invoice = \
         Invoice.query.filter_by(lid=invoice_id).first()
-    invoice_helpers.expire_invoice(db_invoice)
+    db_invoice.expires_at = datetime.utcnow() - timedelta(days=1)
+    db.session.commit()
+    assert invoice_helpers.expire_unpaid_invoices() == ([], [])
 
     # refetch and check
     # status should not change
@@ -87,8 +93,8 @@ def test_expire_unpaid_invoices(mock_new_invoice, client):
     expired_invoices, expired_orders = invoice_helpers.expire_unpaid_invoices()
     assert len(expired_invoices) == 1
     assert len(expired_orders) == 1
-    assert expired_invoices[0].lid == to_be_expired_invoice_lid
-    assert expired_orders[0].uuid == to_be_expired_order_uuid
+    assert expired_invoices[0] == to_be_expired_invoice_lid
+    assert expired_orders[0] == to_be_expired_order_uuid
 
     # refetch and check
 
@@ -119,6 +125,62 @@ def test_expire_unpaid_invoices(mock_new_invoice, client):
     assert db_order.status == OrderStatus.pending.value
 
 
+@patch('orders.new_invoice')
+@pytest.mark.parametrize("status", [
+    OrderStatus.paid, OrderStatus.transmitting, OrderStatus.sent,
+    OrderStatus.received, OrderStatus.cancelled, OrderStatus.expired
+])
+def test_expire_unpaid_invoices_of_non_pending_order(mock_new_invoice, client,
+                                                     status):
+    order = generate_test_order(mock_new_invoice, client, order_status=status)
+    lid = order['lightning_invoice']['id']
+    Invoice.query.filter_by(lid=lid).first().expires_at = \
+        datetime.utcnow() - timedelta(days=1)
+    db.session.commit()
+
+    # Only pending orders are expired along with their last pending invoice
+    assert invoice_helpers.expire_unpaid_invoices() == ([lid], [])
+    db_order = Order.query.filter_by(uuid=order['uuid']).first()
+    assert db_order.status == status.value
+
+
+@patch('constants.CLEANUP_BATCH_SIZE', 2)
+@patch('orders.new_invoice')
+def test_expire_unpaid_invoices_in_batches(mock_new_invoice, client):
+    orders = [
+        generate_test_order(mock_new_invoice, client, order_id=i + 1)
+        for i in range(5)
+    ]
+    lids = [x['lightning_invoice']['id'] for x in orders]
+    for lid in lids:
+        Invoice.query.filter_by(lid=lid).first().expires_at = \
+            datetime.utcnow() - timedelta(days=1)
+    db.session.commit()
+
+    # An order with another pending invoice should not be expired
+    db_order = Order.query.filter_by(uuid=orders[0]['uuid']).first()
+    mock_new_invoice.return_value = (True,
+                                     new_invoice(db_order.id,
+                                                 InvoiceStatus.pending, 1000))
+    rv = client.post(f"/order/{orders[0]['uuid']}/bump",
+                     data={'bid_increase': 1000},
+                     headers={'X-Auth-Token': orders[0]['auth_token']})
+    assert rv.status_code == HTTPStatus.OK
+
+    expired_lids, expired_uuids = invoice_helpers.expire_unpaid_invoices()
+    assert sorted(expired_lids) == sorted(lids)
+    assert sorted(expired_uuids) == sorted(x['uuid'] for x in orders[1:])
+    db_order = Order.query.filter_by(uuid=orders[0]['uuid']).first()
+    assert db_order.status == OrderStatus.pending.value
+    assert db_order.unpaid_bid == 1000
+    assert db_order.pending_invoices == 1
+    for order in orders[1:]:
+        db_order = Order.query.filter_by(uuid=order['uuid']).first()
+        assert db_order.status == OrderStatus.expired.value
+        assert db_order.unpaid_bid == 0
+        assert db_order.pending_invoices == 0
+
+
 def test_new_invoice_invalid_bid():
     new_order = Order(uuid='123',
                       unpaid_bid=2000,
@@ -134,7 +196,7 @@ def test_new_invoice_invalid_bid():
         (False, get_http_error_resp('PARAM_COERCION', 'bid'))
 
 
-@patch('invoice_helpers.requests.post')
+@patch('invoice_helpers.lightning_charge.post')
 @pytest.mark.parametrize("http_status", [
     HTTPStatus.OK, HTTPStatus.NOT_FOUND, HTTPStatus.BAD_REQUEST,
     HTTPStatus.UNAUTHORIZED
@@ -152,7 +214,7 @@ def test_new_invoice_lightning_service_does_not_return_created(
         (False, get_http_error_resp('LIGHTNING_CHARGE_INVOICE_ERROR'))
 
 
-@patch('invoice_helpers.requests.post')
+@patch('invoice_helpers.lightning_charge.post')
 @pytest.mark.parametrize("exception_or_timeout",
                          [requests.exceptions.RequestException, Timeout])
 def test_new_invoice_lightning_service_exception_or_timeout(
@@ -167,7 +229,7 @@ def test_new_invoice_lightning_service_exception_or_timeout(
         (False, get_http_error_resp('LIGHTNING_CHARGE_INVOICE_ERROR'))
 
 
-@patch('invoice_helpers.requests.post')
+@patch('invoice_helpers.lightning_charge.post')
 def test_new_invoice_lightning_service_missing_id_in_response(
         lightning_service_mock):
     SAMPLE_LIGHTNING_INVOICE = str({
@@ -213,7 +275,7 @@ SAMPLE_LIGHTNING_INVOICE = {
 }
 
 
-@patch('invoice_helpers.requests.post')
+@patch('invoice_helpers.lightning_charge.post')
 @pytest.mark.parametrize("webhook_http_status", [
     HTTPStatus.OK, HTTPStatus.NOT_FOUND, HTTPStatus.BAD_REQUEST,
     HTTPStatus.UNAUTHORIZED
@@ -244,7 +306,7 @@ def test_new_invoice_lightning_service_invalid_webhook_response(
             'LIGHTNING_CHARGE_WEBHOOK_REGISTRATION_ERROR'))
 
 
-@patch('invoice_helpers.requests.post')
+@patch('invoice_helpers.lightning_charge.post')
 @pytest.mark.parametrize("exception_or_timeout",
                          [requests.exceptions.RequestException, Timeout])
 def test_new_invoice_webhook_exception_or_timeout(requests_mock,
@@ -265,7 +327,7 @@ def test_new_invoice_webhook_exception_or_timeout(requests_mock,
             'LIGHTNING_CHARGE_WEBHOOK_REGISTRATION_ERROR'))
 
 
-@patch('invoice_helpers.requests.post')
+@patch('invoice_helpers.lightning_charge.post')
 def test_new_invoice_successfully(requests_mock):
     lightning_response_mock = MagicMock()
     lightning_response_mock.status_code = HTTPStatus.CREATED
@@ -291,6 +353,75 @@ def test_new_invoice_successfully(requests_mock):
     assert new_invoice.status == InvoiceStatus.pending.value
 
 
+@patch('constants.LN_WEBHOOK_REGISTRATION', 'async')
+@patch('invoice_helpers.lightning_charge.post')
+def test_new_invoice_async_webhook_registration(requests_mock):
+    # Only the invoice creation request should be made
+    lightning_response_mock = MagicMock()
+    lightning_response_mock.status_code = HTTPStatus.CREATED
+    lightning_response_mock.json.return_value = SAMPLE_LIGHTNING_INVOICE
+    requests_mock.return_value = lightning_response_mock
+
+    new_order = Order(id=1,
+                      uuid='470c2b2a-8646-4def-b1bb-71d07706d0e5',
+                      unpaid_bid=2000,
+                      message_size=10,
+                      message_digest='0759807b1e6d5ed5fe0a7d',
+                      status=OrderStatus.pending.value)
+
+    success, invoice = invoice_helpers.new_invoice(new_order, 2000)
+    assert success
+    assert not invoice.webhook_registered
+    requests_mock.assert_called_once()
+
+
+@patch('invoice_helpers.lightning_charge.get')
+@patch('invoice_helpers.lightning_charge.post')
+@patch('orders.new_invoice')
+def test_register_pending_webhooks(mock_new_invoice, requests_post_mock,
+                                   requests_get_mock, client):
+    lids = []
+    for order_id in range(1, 4):
+        lid = generate_test_order(mock_new_invoice, client,
+                                  order_id=order_id)['lightning_invoice']['id']
+        Invoice.query.filter_by(lid=lid).first().webhook_registered = False
+        lids.append(lid)
+    db.session.commit()
+
+    # The first registration fails, and the third invoice turns out to be
+    # paid already
+    def charge_post(url, **kwargs):
+        status = HTTPStatus.INTERNAL_SERVER_ERROR if lids[0] in url \
+            else HTTPStatus.CREATED
+        return Mock(status_code=status)
+
+    def charge_get(url, **kwargs):
+        status = 'paid' if url.endswith(lids[2]) else 'unpaid'
+        return Mock(status_code=HTTPStatus.OK,
+                    json=Mock(return_value={'status': status}))
+
+    requests_post_mock.side_effect = charge_post
+    requests_get_mock.side_effect = charge_get
+
+    registered, paid = invoice_helpers.register_pending_webhooks()
+    assert sorted(x.lid for x in registered) == sorted(lids[1:])
+    assert [x.lid for x in paid] == [lids[2]]
+    db_invoices = [Invoice.query.filter_by(lid=lid).first() for lid in lids]
+    assert [x.webhook_registered for x in db_invoices] == [False, True, True]
+    assert db_invoices[1].status == InvoiceStatus.pending.value
+    assert db_invoices[2].status == InvoiceStatus.paid.value
+    assert Order.query.get(db_invoices[2].order_id).status == \
+        OrderStatus.paid.value
+
+    # The failed registration is retried on the next call
+    requests_post_mock.side_effect = None
+    requests_post_mock.return_value = Mock(status_code=HTTPStatus.CREATED)
+    registered, paid = invoice_helpers.register_pending_webhooks()
+    assert [x.lid for x in registered] == [lids[0]]
+    assert paid == []
+    assert invoice_helpers.register_pending_webhooks() == ([], [])
+
+
 @patch('orders.new_invoice')
 def test_get_pending_invoices(mock_new_invoice, client):
     # Create an order and bump it twice so that it ends up with three
@@ -221,3 +221,71 @@ def test_try_to_pay_an_expired_invoice(mock_new_invoice, client):
     assert db_invoice.status == InvoiceStatus.expired.value
     assert db_order.status == InvoiceStatus.pending.value
     assert db_invoice.paid_at is None
+
+
+@patch('orders.new_invoice')
+@patch('invoices.transmitter.tx_start')
+def test_paid_invoice_callback_duplicates(mock_tx_start, mock_new_invoice,
+                                          client):
+    n_bytes = 500
+    invoice = new_invoice(1, InvoiceStatus.pending,
+                          bidding.get_min_bid(n_bytes))
+    mock_new_invoice.return_value = (True, invoice)
+    post_rv = place_order(client, n_bytes)
+    assert post_rv.status_code == HTTPStatus.OK
+
+    charged_auth_token = hmac_sha256_digest(constants.LIGHTNING_WEBHOOK_KEY,
+                                            invoice.lid)
+    rv = client.post(f'/callback/{invoice.lid}/{charged_auth_token}')
+    assert rv.status_code == HTTPStatus.OK
+    mock_tx_start.assert_called_once()
+
+    # Retried callbacks are answered without looking the invoice up
+    with patch('invoices.get_and_authenticate_invoice') as mock_get_invoice:
+        for _ in range(2):
+            rv = client.post(f'/callback/{invoice.lid}/{charged_auth_token}')
+            assert rv.status_code == HTTPStatus.BAD_REQUEST
+            assert_error(rv.get_json(), 'INVOICE_ALREADY_PAID')
+        mock_get_invoice.assert_not_called()
+    mock_tx_start.assert_called_once()
+
+    # A different auth token does not hit the record of the recent callbacks
+    rv = client.post(f'/callback/{invoice.lid}/some_text')
+    assert rv.status_code == HTTPStatus.UNAUTHORIZED
+
+
+@patch('orders.new_invoice')
+@patch('invoices.transmitter.tx_start')
+def test_paid_invoice_callback_race(mock_tx_start, mock_new_invoice, client):
+    n_bytes = 500
+    invoice = new_invoice(1, InvoiceStatus.pending,
+                          bidding.get_min_bid(n_bytes))
+    mock_new_invoice.return_value = (True, invoice)
+    post_rv = place_order(client, n_bytes)
+    assert post_rv.status_code == HTTPStatus.OK
+    uuid_order = post_rv.get_json()['uuid']
+
+    # Mimic a concurrent callback that pays the invoice (on another worker)
+    # after this callback has loaded the invoice as pending
+    db_invoice = Invoice.query.filter_by(lid=invoice.lid).first()
+    assert db_invoice.status == InvoiceStatus.pending.value
+
+    def pay_concurrently(lid):
+        Invoice.query.filter_by(lid=lid).update(
+            {Invoice.status: InvoiceStatus.paid.value},
+            synchronize_session=False)
+        db.session.commit()
+        return db_invoice
+
+    with patch('invoices.get_and_authenticate_invoice',
+               side_effect=lambda lid, _: (True, pay_concurrently(lid))):
+        charged_auth_token = hmac_sha256_digest(
+            constants.LIGHTNING_WEBHOOK_KEY, invoice.lid)
+        rv = client.post(f'/callback/{invoice.lid}/{charged_auth_token}')
+    assert rv.status_code == HTTPStatus.BAD_REQUEST
+    assert_error(rv.get_json(), 'INVOICE_ALREADY_PAID')
+
+    # Only the callback that paid the invoice can start the transmission
+    mock_tx_start.assert_not_called()
+    db_order = Order.query.filter_by(uuid=uuid_order).first()
+    assert db_order.status == OrderStatus.pending.value
@@ -0,0 +1,156 @@
+import pytest
+import requests
+import urllib3
+from http import HTTPStatus
+from http.client import RemoteDisconnected
+from unittest.mock import Mock, patch
+
+from constants import OrderStatus
+from error import get_http_error_resp
+from models import Order
+import invoice_helpers
+import lightning_charge
+
+
+@pytest.fixture
+def charge_client():
+    client = lightning_charge.LightningChargeClient(
+        'http://charge', 2, 2, 0, lightning_charge.CircuitBreaker(3, 30))
+    with patch.object(client.session, 'request') as mock_request:
+        yield client, mock_request
+
+
+def connect_error():
+    return requests.exceptions.ConnectionError(
+        urllib3.exceptions.MaxRetryError(
+            None, '/invoice',
+            urllib3.exceptions.NewConnectionError(None, 'Connection refused')))
+
+
+def disconnect_error():
+    return requests.exceptions.ConnectionError(
+        urllib3.exceptions.ProtocolError(
+            'Connection aborted.',
+            RemoteDisconnected('Remote end closed connection')))
+
+
+def test_retry_connection_errors(charge_client):
+    client, mock_request = charge_client
+    mock_request.side_effect = [
+        connect_error(), requests.exceptions.ConnectTimeout,
+        Mock(status_code=HTTPStatus.CREATED)
+    ]
+    assert client.post('/invoice').status_code == HTTPStatus.CREATED
+    assert mock_request.call_count == 3
+    assert mock_request.call_args[0] == ('POST', 'http://charge/invoice')
+
+    # Bounded retries
+    mock_request.reset_mock()
+    mock_request.side_effect = connect_error()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('/invoice')
+    assert mock_request.call_count == 3
+
+
+def test_retry_dropped_connections(charge_client):
+    client, mock_request = charge_client
+
+    # A POST could have reached the server before the connection dropped
+    mock_request.side_effect = disconnect_error()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post('/invoice')
+    assert mock_request.call_count == 1
+
+    mock_request.reset_mock()
+    mock_request.side_effect = [
+        disconnect_error(),
+        Mock(status_code=HTTPStatus.OK)
+    ]
+    assert client.get('/info').status_code == HTTPStatus.OK
+    assert mock_request.call_count == 2
+
+
+def test_retry_idempotent_requests_only(charge_client):
+    client, mock_request = charge_client
+
+    # A POST could have reached the server before timing out
+    mock_request.side_effect = requests.exceptions.ReadTimeout
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post('/invoice')
+    assert mock_request.call_count == 1
+
+    mock_request.reset_mock()
+    mock_request.side_effect = None
+    mock_request.return_value = Mock(status_code=HTTPStatus.BAD_GATEWAY)
+    assert client.post('/invoice').status_code == HTTPStatus.BAD_GATEWAY
+    assert mock_request.call_count == 1
+
+    mock_request.reset_mock()
+    mock_request.side_effect = [
+        requests.exceptions.ReadTimeout,
+        Mock(status_code=HTTPStatus.BAD_GATEWAY),
+        Mock(status_code=HTTPStatus.OK)
+    ]
+    assert client.get('/info').status_code == HTTPStatus.OK
+    assert mock_request.call_count == 3
+
+
+@patch('lightning_charge.time.monotonic')
+def test_circuit_breaker(mock_monotonic, charge_client):
+    client, mock_request = charge_client
+    mock_monotonic.return_value = 1000
+    mock_request.side_effect = requests.exceptions.ConnectionError
+
+    # The circuit opens after three consecutive failed requests
+    for _ in range(3):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.post('/invoice')
+    mock_request.reset_mock()
+    with pytest.raises(lightning_charge.CircuitOpenError):
+        client.post('/invoice')
+    mock_request.assert_not_called()
+
+    # After the cool-down period, a single trial request goes through
+    mock_monotonic.return_value = 1031
+    mock_request.side_effect = None
+    mock_request.return_value = Mock(status_code=HTTPStatus.OK)
+    assert client.get('/info').status_code == HTTPStatus.OK
+    assert mock_request.call_count == 1
+
+    # The successful trial closes the circuit
+    assert client.get('/info').status_code == HTTPStatus.OK
+    assert mock_request.call_count == 2
+
+
+@patch('lightning_charge.time.monotonic')
+def test_circuit_breaker_failed_trial(mock_monotonic, charge_client):
+    client, mock_request = charge_client
+    mock_monotonic.return_value = 1000
+    mock_request.return_value = Mock(status_code=HTTPStatus.BAD_GATEWAY)
+    for _ in range(3):
+        client.post('/invoice')
+
+    mock_monotonic.return_value = 1031
+    assert client.post('/invoice').status_code == HTTPStatus.BAD_GATEWAY
+    with pytest.raises(lightning_charge.CircuitOpenError):
+        client.post('/invoice')
+
+
+@patch('lightning_charge.get_client')
+def test_new_invoice_circuit_open(mock_get_client):
+    mock_get_client.return_value.post.side_effect = \
+        lightning_charge.CircuitOpenError
+    new_order = Order(uuid='123',
+                      unpaid_bid=2000,
+                      message_size=10,
+                      message_digest='some digest',
+                      status=OrderStatus.pending.value)
+    assert invoice_helpers.new_invoice(new_order, 2000) ==\
+        (False, get_http_error_resp('LIGHTNING_CHARGE_INVOICE_ERROR'))
+
+
+def test_client_per_process():
+    client = lightning_charge.get_client()
+    assert lightning_charge.get_client() is client
+    with patch('lightning_charge.os.getpid', return_value=-1):
+        assert lightning_charge.get_client() is not client
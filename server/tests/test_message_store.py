@@ -0,0 +1,228 @@
+import gzip
+import io
+import os
+import pytest
+from http import HTTPStatus
+from unittest.mock import patch
+from uuid import uuid4
+
+from werkzeug.test import EnvironBuilder
+
+from common import new_invoice, rnd_string, upload_test_file
+from constants import InvoiceStatus, OrderStatus
+from database import db
+from models import Order
+import bidding
+import constants
+import message_store
+import server
+
+
+@pytest.fixture
+def client(mockredis):
+    app = server.create_app(from_test=True)
+    app.app_context().push()
+    with app.test_client() as client:
+        yield client
+    server.teardown_app(app)
+
+
+@patch('orders.new_invoice')
+def test_duplicate_messages_share_blob(mock_new_invoice, client):
+    msg = rnd_string(500)
+    bid = bidding.get_min_bid(len(msg))
+    orders = []
+    for order_id in range(2):
+        mock_new_invoice.return_value = (True,
+                                         new_invoice(order_id + 1,
+                                                     InvoiceStatus.pending,
+                                                     bid))
+        rv = upload_test_file(client, msg, bid)
+        orders.append(
+            Order.query.filter_by(uuid=rv.get_json()['uuid']).first())
+
+    assert orders[0].message_digest == orders[1].message_digest
+    blob = message_store.blob_path(orders[0].message_digest)
+    paths = [message_store.message_path(order.uuid) for order in orders]
+
+    # Both orders reference the same blob
+    assert os.stat(blob).st_nlink == 3
+    assert os.path.samefile(paths[0], blob)
+    assert os.path.samefile(paths[1], blob)
+
+    # The blob stays while any order still references it
+    message_store.remove(orders[0])
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(blob)
+    with open(paths[1]) as fd:
+        assert fd.read() == msg
+
+    message_store.remove(orders[1])
+    assert not os.path.exists(paths[1])
+    assert not os.path.exists(blob)
+
+
+def upload_tmp_files():
+    return [
+        x for x in os.listdir(constants.MSG_STORE_PATH)
+        if x.startswith('.upload-')
+    ]
+
+
+def test_aborted_upload_request_cleanup(client):
+    max_size = message_store.max_upload_size(admin_mode=False)
+    builder = EnvironBuilder(path='/order',
+                             method='POST',
+                             data={
+                                 'file1': (io.BytesIO(b'a' * 10), 'file1'),
+                                 'file2':
+                                 (io.BytesIO(b'b' * (max_size + 1)), 'file2')
+                             })
+    request = message_store.MessageUploadRequest(builder.get_environ())
+
+    # The parsing is aborted on the second file, after the first one was
+    # fully written into its temporary file
+    with pytest.raises(message_store.MessageTooLarge):
+        request.files
+    assert len(request.message_uploads) == 2
+
+    request.close()
+    assert upload_tmp_files() == []
+
+
+def test_cleanup_stale_uploads(client):
+    upload = message_store.MessageUpload(max_size=100)
+    upload.write(b'data')
+    assert message_store.cleanup_stale_uploads() == 0
+    assert len(upload_tmp_files()) == 1
+
+    with patch('constants.STALE_UPLOAD_TIMEOUT_SECS', -1):
+        assert message_store.cleanup_stale_uploads() == 1
+    assert upload_tmp_files() == []
+    upload.close()
+
+
+@patch('orders.new_invoice')
+@pytest.mark.parametrize("compression", [None, 'gzip'])
+def test_stored_file_mode(mock_new_invoice, client, compression):
+    msg = 'a' * 1000
+    bid = bidding.get_min_bid(len(msg))
+    mock_new_invoice.return_value = (True,
+                                     new_invoice(1, InvoiceStatus.pending,
+                                                 bid))
+    with patch('constants.MSG_STORE_COMPRESSION', compression):
+        rv = upload_test_file(client, msg, bid)
+    db_order = Order.query.filter_by(uuid=rv.get_json()['uuid']).first()
+
+    # The stored files must be readable by the reverse proxy
+    path = message_store.find_message(db_order.uuid)
+    assert message_store.is_compressed(path) == (compression == 'gzip')
+    assert os.stat(path).st_mode & 0o777 == 0o644
+
+
+def test_sharded_layout(client):
+    uuid = str(uuid4())
+    assert message_store.message_path(uuid) == os.path.join(
+        constants.MSG_STORE_PATH, uuid[0:2], uuid[2:4], uuid)
+    digest = 'ab' * 32
+    assert message_store.blob_path(digest) == os.path.join(
+        constants.MSG_BLOB_PATH, 'ab', 'ab', digest)
+
+
+def test_migrate_legacy_files(client):
+    # Message files stored before the content-addressed store
+    contents = ['message a', 'message a', 'message b']
+    uuids = [str(uuid4()) for _ in contents]
+    for uuid, content in zip(uuids, contents):
+        with open(os.path.join(constants.MSG_STORE_PATH, uuid), 'w') as fd:
+            fd.write(content)
+
+    # Message file and blob stored with the flat content-addressed layout
+    contents.append('message c')
+    uuids.append(str(uuid4()))
+    flat_path = os.path.join(constants.MSG_STORE_PATH, uuids[-1])
+    with open(flat_path, 'w') as fd:
+        fd.write(contents[-1])
+    flat_blob = os.path.join(constants.MSG_BLOB_PATH,
+                             message_store.sha256_checksum(flat_path))
+    os.link(flat_path, flat_blob)
+
+    # The legacy files are found before the migration
+    for uuid in uuids:
+        assert message_store.find_message(uuid) == os.path.join(
+            constants.MSG_STORE_PATH, uuid)
+
+    assert message_store.migrate_legacy_files() == 5
+
+    paths = [message_store.message_path(uuid) for uuid in uuids]
+    assert os.path.samefile(paths[0], paths[1])
+    assert not os.path.samefile(paths[0], paths[2])
+    for uuid, path, content in zip(uuids, paths, contents):
+        assert message_store.find_message(uuid) == path
+        assert not os.path.exists(os.path.join(constants.MSG_STORE_PATH, uuid))
+        with open(path) as fd:
+            assert fd.read() == content
+        blob = message_store.blob_path(message_store.sha256_checksum(path))
+        assert os.path.samefile(path, blob)
+    assert not os.path.exists(flat_blob)
+
+    # Running it again is a no-op
+    assert message_store.migrate_legacy_files() == 0
+
+
+@patch('orders.new_invoice')
+@patch('constants.MSG_STORE_COMPRESSION', 'gzip')
+def test_compressed_message(mock_new_invoice, client):
+    msg = 'Hello World! ' * 100
+    bid = bidding.get_min_bid(len(msg))
+    mock_new_invoice.return_value = (True,
+                                     new_invoice(1, InvoiceStatus.pending,
+                                                 bid))
+    rv = upload_test_file(client, msg, bid)
+    assert rv.status_code == HTTPStatus.OK
+    uuid = rv.get_json()['uuid']
+    db_order = Order.query.filter_by(uuid=uuid).first()
+
+    # The message is stored compressed, but the order keeps the original size
+    # and digest of the message
+    path = message_store.find_message(uuid)
+    assert path == message_store.message_path(uuid) + '.gz'
+    assert os.path.getsize(path) < len(msg)
+    assert db_order.message_size == len(msg)
+    with gzip.open(path) as fd:
+        assert fd.read() == msg.encode()
+    assert os.path.samefile(
+        path,
+        message_store.blob_path(db_order.message_digest) + '.gz')
+
+    db_order.status = OrderStatus.sent.value
+    db_order.tx_seq_num = 1
+    db.session.commit()
+
+    # Clients accepting gzip get the compressed file
+    rv = client.get('/message/1', headers={'Accept-Encoding': 'gzip'})
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert rv.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(rv.data) == msg.encode()
+
+    # Other clients get the message decompressed on the fly
+    rv = client.get('/message/1')
+    assert rv.status_code == HTTPStatus.OK
+    assert 'Content-Encoding' not in rv.headers
+    assert int(rv.headers['Content-Length']) == len(msg)
+    assert rv.data == msg.encode()
+
+    # Incompressible messages are stored as they are
+    rv = client.post('/order',
+                     data={
+                         'bid': bid,
+                         'file': (io.BytesIO(os.urandom(500)), 'testfile')
+                     })
+    path = message_store.find_message(rv.get_json()['uuid'])
+    assert path == message_store.message_path(rv.get_json()['uuid'])
+
+    message_store.remove(db_order)
+    assert message_store.find_message(uuid) is None
+    assert not os.path.exists(
+        message_store.blob_path(db_order.message_digest) + '.gz')
@@ -0,0 +1,75 @@
+import re
+import pytest
+from datetime import datetime
+
+from sqlalchemy import and_, func
+
+from constants import InvoiceStatus, OrderStatus
+from database import db
+from models import Invoice, Order, RxConfirmation, TxConfirmation, TxRetry
+import server
+
+
+@pytest.fixture
+def app():
+    app = server.create_app(from_test=True)
+    app.app_context().push()
+    yield app
+    server.teardown_app(app)
+
+
+def query_plan(query):
+    """Get the SQLite query plan details of a given SQLAlchemy query"""
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[key] for key in compiled.positiontup]
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"EXPLAIN QUERY PLAN {compiled}", params)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def hot_queries():
+    return {
+        'order by uuid':
+        Order.query.filter_by(uuid='uuid'),
+        'order by tx_seq_num':
+        Order.query.filter_by(tx_seq_num=1),
+        'next paid order':
+        Order.query.filter(
+            and_(Order.status == OrderStatus.paid.value,
+                 Order.channel == 1)).order_by(Order.bid_per_byte.desc()),
+        'transmitting orders':
+        Order.query.filter(
+            and_(Order.status == OrderStatus.transmitting.value,
+                 Order.channel == 1)),
+        'invoice by lid':
+        Invoice.query.filter_by(lid='lid'),
+        'order invoices':
+        Invoice.query.filter_by(order_id=1),
+        'expired invoices':
+        Invoice.query.filter(
+            and_(Invoice.status == InvoiceStatus.pending.value,
+                 func.datetime(Invoice.expires_at) < datetime.utcnow())),
+        'tx confirmations':
+        TxConfirmation.query.filter_by(order_id=1, region_id=1),
+        'rx confirmations':
+        RxConfirmation.query.filter_by(order_id=1, region_id=1),
+        'tx retry by order':
+        TxRetry.query.filter_by(order_id=1),
+    }
+
+
+def test_hot_queries_use_indexes(app):
+    # SQLite versions older than 3.36 print "SCAN TABLE <table>" and "SEARCH
+    # TABLE <table> ..." instead of "SCAN <table>" and "SEARCH <table> ..."
+    for name, query in hot_queries().items():
+        plan = query_plan(query)
+        table_accesses = [
+            x for x in plan if re.match(r'^(SCAN|SEARCH) (TABLE )?\w+', x)
+        ]
+        assert table_accesses, f"{name}: unrecognized plan {plan}"
+        full_scans = [x for x in plan if re.match(r'^SCAN (TABLE )?\w+$', x)]
+        assert not full_scans, f"{name}: {plan}"
@@ -1,4 +1,5 @@
 import io
+import json
 import os
 import pytest
 from http import HTTPStatus
@@ -9,12 +10,12 @@ from constants import InvoiceStatus, OrderStatus
 from database import db
 from error import assert_error, get_http_error_resp
 from models import Invoice, Order, RxConfirmation
-from order_helpers import adjust_bids, _paid_invoices_total, \
-    _unpaid_invoices_total
-from regions import Regions, SATELLITE_REGIONS
+from order_helpers import add_invoice, update_bids
+from regions import Regions, SATELLITE_REGIONS, region_number_list_to_code
 from utils import hmac_sha256_digest
 import bidding
 import constants
+import message_store
 import server
 
 from common import check_invoice, pay_invoice, check_upload, new_invoice, \
@@ -31,7 +32,7 @@ def client(mockredis):
 
 
 def check_received_message(order_uuid, received_message):
-    path = os.path.join(constants.MSG_STORE_PATH, order_uuid)
+    path = message_store.message_path(order_uuid)
     assert os.path.exists(path)
     with open(path, 'rb') as fd:
         sent_message = fd.read()
@@ -106,6 +107,246 @@ def test_uploaded_file_too_large(client):
     assert rv.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
 
 
+def test_rejected_upload_not_stored(client):
+    # Uploads that fail validation should not leave any message file (nor any
+    # temporary upload file) behind on the message store
+    n_bytes = constants.DEFAULT_MAX_MESSAGE_SIZE + 1
+    rv = place_order(client, n_bytes)
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_LARGE')
+
+    n_bytes = 500
+    rv = place_order(client, n_bytes, bid=bidding.get_min_bid(n_bytes) - 1)
+    assert_error(rv.get_json(), 'BID_TOO_SMALL')
+
+    rv = place_order(client, 0)
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_SMALL')
+
+    for _, _, files in os.walk(constants.MSG_STORE_PATH):
+        assert files == []
+
+
+@patch('message_store.MessageUpload')
+def test_upload_rejected_before_reading_body(mock_upload, client):
+    # Uploads whose Content-Length exceeds the maximum message size should be
+    # rejected based on the headers alone, without consuming the body
+    n_bytes = constants.DEFAULT_MAX_MESSAGE_SIZE + \
+        constants.MAX_UPLOAD_FORM_OVERHEAD + 1
+    rv = client.post('/order',
+                     data={
+                         'bid': bidding.get_min_bid(n_bytes),
+                         'file': (io.BytesIO(bytes(n_bytes)), 'test.txt')
+                     })
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_LARGE')
+    assert rv.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    mock_upload.assert_not_called()
+
+    # With "Expect: 100-continue", the bid declared on the query string is
+    # checked against the minimum message size implied by the Content-Length
+    n_bytes = 2 * constants.MAX_UPLOAD_FORM_OVERHEAD
+    min_msg_size = n_bytes - constants.MAX_UPLOAD_FORM_OVERHEAD
+    bid = bidding.get_min_bid(min_msg_size) - 1
+    rv = client.post(f'/order?bid={bid}',
+                     data={
+                         'bid': bid,
+                         'file': (io.BytesIO(bytes(n_bytes)), 'test.txt')
+                     },
+                     headers={'Expect': '100-continue'})
+    assert_error(rv.get_json(), 'BID_TOO_SMALL')
+    assert rv.status_code == HTTPStatus.BAD_REQUEST
+    mock_upload.assert_not_called()
+
+    # The declared channel must accept posting
+    rv = client.post(f'/order?channel={constants.BTC_SRC_CHANNEL}',
+                     data={
+                         'bid': bid,
+                         'file': (io.BytesIO(bytes(n_bytes)), 'test.txt')
+                     },
+                     headers={'Expect': '100-continue'})
+    assert_error(rv.get_json(), 'ORDER_CHANNEL_UNAUTHORIZED_OP')
+    mock_upload.assert_not_called()
+
+
+def test_admin_upload_with_expect_and_bid_only_on_query(client):
+    # On the admin route, the bid declared on the query string is not checked
+    # when the channel is only given on the form, as it may be a free channel
+    n_bytes = 2 * constants.MAX_UPLOAD_FORM_OVERHEAD
+    rv = client.post('/admin/order?bid=0',
+                     data={
+                         'bid': 0,
+                         'channel': constants.BTC_SRC_CHANNEL,
+                         'file': (io.BytesIO(bytes(n_bytes)), 'test.txt')
+                     },
+                     headers={'Expect': '100-continue'})
+    assert rv.status_code == HTTPStatus.OK
+
+
+@patch('orders.new_invoice')
+def test_upload_with_expect_and_unknown_query_args(mock_new_invoice, client):
+    # Unrelated query parameters do not affect uploads with "Expect:
+    # 100-continue", like they do not affect the others
+    n_bytes = 500
+    bid = bidding.get_min_bid(n_bytes)
+    mock_new_invoice.return_value = (True,
+                                     new_invoice(1, InvoiceStatus.pending,
+                                                 bid))
+    rv = client.post(f'/order?bid={bid}&_=12345',
+                     data={
+                         'bid': bid,
+                         'file': (io.BytesIO(bytes(n_bytes)), 'test.txt')
+                     },
+                     headers={'Expect': '100-continue'})
+    assert rv.status_code == HTTPStatus.OK
+
+
+@patch('orders.transmitter.tx_start')
+@patch('orders.new_invoice')
+def test_batch_order_upload(mock_new_invoice, mock_tx_start, client):
+    msgs = [rnd_string(100), rnd_string(200), rnd_string(300)]
+    bid = bidding.get_min_bid(len(msgs[2]))
+    mock_new_invoice.return_value = (True,
+                                     new_invoice(1, InvoiceStatus.pending,
+                                                 bid))
+    entries = [
+        {
+            'channel': constants.GOSSIP_CHANNEL,
+            'regions': [Regions.g18.value]
+        },
+        {
+            'channel': constants.AUTH_CHANNEL,
+            'message': msgs[1]
+        },
+        {
+            'bid': bid
+        },
+        {
+            'channel': constants.BTC_SRC_CHANNEL,
+            'bid': -1
+        },
+        {
+            'bid': 0
+        },
+    ]
+    rv = client.post('/admin/order/batch',
+                     data={
+                         'orders':
+                         json.dumps(entries),
+                         'file': [(io.BytesIO(msgs[0].encode()), 'f0'),
+                                  (io.BytesIO(msgs[2].encode()), 'f2'),
+                                  (io.BytesIO(b'x'), 'f3'),
+                                  (io.BytesIO(b'x'), 'f4')]
+                     })
+    assert rv.status_code == HTTPStatus.OK
+    results = rv.get_json()['orders']
+    assert [x['status'] for x in results] == [
+        HTTPStatus.OK, HTTPStatus.OK, HTTPStatus.OK, HTTPStatus.BAD_REQUEST,
+        HTTPStatus.BAD_REQUEST
+    ]
+    assert 'bid' in results[3]
+    assert_error(results[4], 'BID_TOO_SMALL')
+
+    for result, msg in zip(results[:3], msgs):
+        check_upload(result['uuid'], msg)
+    assert 'lightning_invoice' not in results[0]
+    assert 'lightning_invoice' not in results[1]
+    assert 'lightning_invoice' in results[2]
+
+    db_order = Order.query.filter_by(uuid=results[0]['uuid']).first()
+    assert db_order.channel == constants.GOSSIP_CHANNEL
+    assert db_order.region_code == region_number_list_to_code(
+        [Regions.g18.value])
+    assert Order.query.count() == 3
+
+    # The transmissions start once per channel with orders ready to go
+    assert sorted(x.args[0] for x in mock_tx_start.call_args_list) == \
+        [constants.AUTH_CHANNEL, constants.GOSSIP_CHANNEL]
+
+
+def test_batch_order_upload_invalid(client):
+    rv = client.post('/admin/order/batch', data={'orders': '[]'})
+    assert_error(rv.get_json(), 'MESSAGE_MISSING')
+
+    rv = client.post('/admin/order/batch', data={'orders': '{'})
+    assert rv.status_code == HTTPStatus.BAD_REQUEST
+
+    # One file per entry without a text message
+    rv = client.post('/admin/order/batch',
+                     data={
+                         'orders': json.dumps([{}, {}]),
+                         'file': (io.BytesIO(b'x'), 'f0')
+                     })
+    assert rv.status_code == HTTPStatus.BAD_REQUEST
+    assert Order.query.count() == 0
+
+
+def test_batch_order_upload_too_large(client):
+    max_size = message_store.max_upload_size(admin_mode=True)
+    rv = client.post('/admin/order/batch',
+                     data={
+                         'orders':
+                         json.dumps([{}, {}]),
+                         'file': [(io.BytesIO(b'x'), 'f0'),
+                                  (io.BytesIO(b'x' * (max_size + 1)), 'f1')]
+                     })
+    assert rv.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_LARGE')
+
+    # No temporary upload file is left behind
+    assert not any(
+        x.startswith('.upload-') for x in os.listdir(constants.MSG_STORE_PATH))
+
+
+@patch('orders.transmitter.tx_start')
+def test_batch_order_upload_commit_failure(mock_tx_start, client):
+    entries = [{'channel': constants.GOSSIP_CHANNEL}]
+    with patch('orders.db.session.commit', side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            client.post('/admin/order/batch',
+                        data={
+                            'orders': json.dumps(entries),
+                            'file': (io.BytesIO(b'message'), 'f0')
+                        })
+
+    # The saved message is removed along with its blob
+    for root in [constants.MSG_STORE_PATH, constants.MSG_BLOB_PATH]:
+        for _, _, filenames in os.walk(root):
+            assert filenames == []
+
+
+def test_order_quote(client):
+    n_bytes = 1000
+    rv = client.get(f'/order/quote?size={n_bytes}')
+    assert rv.status_code == HTTPStatus.OK
+    quote = rv.get_json()
+    assert quote['size'] == n_bytes
+    assert quote['channel'] == constants.USER_CHANNEL
+    assert quote['ota_msg_len'] == bidding.calc_ota_msg_len(n_bytes)
+    assert quote['min_bid'] == bidding.get_min_bid(n_bytes)
+    assert quote['max_msg_size'] == constants.DEFAULT_MAX_MESSAGE_SIZE
+    assert quote['requires_payment']
+    assert quote['regions'] == [e.value for e in Regions]
+
+    rv = client.get('/order/quote?size=0')
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_SMALL')
+
+    n_bytes = constants.DEFAULT_MAX_MESSAGE_SIZE + 1
+    rv = client.get(f'/order/quote?size={n_bytes}')
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_LARGE')
+
+    rv = client.get('/order/quote')
+    assert rv.status_code == HTTPStatus.BAD_REQUEST
+
+    # Channels without user post permission are only quoted in admin mode
+    rv = client.get(
+        f'/order/quote?size=10&channel={constants.BTC_SRC_CHANNEL}')
+    assert_error(rv.get_json(), 'ORDER_CHANNEL_UNAUTHORIZED_OP')
+
+    rv = client.get(
+        f'/admin/order/quote?size=10&channel={constants.BTC_SRC_CHANNEL}')
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.get_json()['min_bid'] == 0
+    assert not rv.get_json()['requires_payment']
+
+
 @patch('orders.new_invoice')
 def test_uploaded_file_max_size(mock_new_invoice, client):
     n_bytes = constants.DEFAULT_MAX_MESSAGE_SIZE
@@ -299,36 +540,45 @@ def test_get_admin_order(mock_new_invoice, client):
     assert get_json_resp['uuid'] == uuid
 
 
-def test_adjust_bids(client):
-    # if the values like bid, unpaid_bid, bid_per_byte are wrong or become
-    # obsolete due to changes in the invoices, the adjust_bids function should
-    # be able to fix them all
+def test_update_bids(client):
     n_bytes = 1000
     paid_bid = 1000
     unpaid_bid = 10000
-    order = Order(id=1,
-                  uuid='a-b-c',
-                  bid=123,
+    order = Order(uuid='a-b-c',
                   message_size=n_bytes,
-                  bid_per_byte=56.0,
                   message_digest='abcd',
-                  status=OrderStatus.pending.value,
-                  unpaid_bid=2345,
-                  invoices=[
-                      new_invoice(1, InvoiceStatus.pending,
-                                  int(0.4 * unpaid_bid)),
-                      new_invoice(1, InvoiceStatus.pending,
-                                  int(0.6 * unpaid_bid)),
-                      new_invoice(1, InvoiceStatus.paid, int(0.3 * paid_bid)),
-                      new_invoice(1, InvoiceStatus.paid, int(0.7 * paid_bid))
-                  ])
-    assert _paid_invoices_total(order) == paid_bid
-    assert _unpaid_invoices_total(order) == unpaid_bid
-    adjust_bids(order)
+                  status=OrderStatus.pending.value)
+
+    # Before the order is stored, the aggregates are updated in memory
+    add_invoice(order,
+                new_invoice(1, InvoiceStatus.pending, int(0.4 * unpaid_bid)))
+    add_invoice(order, new_invoice(1, InvoiceStatus.paid, int(0.3 * paid_bid)))
+    assert order.bid == int(0.3 * paid_bid)
+    assert order.unpaid_bid == int(0.4 * unpaid_bid)
+    assert order.pending_invoices == 1
+    db.session.add(order)
+    db.session.commit()
+
+    # Afterwards, with SQL arithmetic
+    add_invoice(order,
+                new_invoice(1, InvoiceStatus.pending, int(0.6 * unpaid_bid)))
+    add_invoice(order, new_invoice(1, InvoiceStatus.paid, int(0.7 * paid_bid)))
+    db.session.commit()
     assert order.bid == paid_bid
     assert order.unpaid_bid == unpaid_bid
+    assert order.pending_invoices == 2
     expected_bid_per_byte = paid_bid / (n_bytes + 52)  # w/ 52 overhead bytes
     assert order.bid_per_byte == expected_bid_per_byte
+    assert len(order.invoices) == 4
+
+    # Concurrent updates do not overwrite each other
+    Order.query.filter_by(id=order.id).update(
+        {Order.unpaid_bid: Order.unpaid_bid - 1000})
+    update_bids(order, paid=1000, unpaid=-1000, pending_invoices=-1)
+    db.session.commit()
+    assert order.bid == paid_bid + 1000
+    assert order.unpaid_bid == unpaid_bid - 2000
+    assert order.pending_invoices == 1
 
 
 @patch('orders.new_invoice')
@@ -500,7 +750,7 @@ def test_cancel_order_twice(mock_new_invoice, client):
     db_order = Order.query.filter_by(uuid=uuid).first()
     assert db_order.status == OrderStatus.pending.value
     assert db_order.cancelled_at is None
-    message_path = os.path.join(constants.MSG_STORE_PATH, uuid)
+    message_path = message_store.message_path(uuid)
     assert os.path.exists(message_path)
 
     # Cancel the order
@@ -627,6 +877,109 @@ def test_get_sent_message_by_seq_number(mock_new_invoice, client, status):
     check_received_message(uuid, received_message)
 
 
+@patch('orders.new_invoice')
+def test_get_sent_message_conditional_request(mock_new_invoice, client):
+    uuid = generate_test_order(mock_new_invoice,
+                               client,
+                               order_status=OrderStatus.sent,
+                               tx_seq_num=1)['uuid']
+    db_order = Order.query.filter_by(uuid=uuid).first()
+
+    rv = client.get('/message/1')
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.headers['ETag'] == f'"{db_order.message_digest}"'
+    assert rv.headers['Accept-Ranges'] == 'bytes'
+    assert 'immutable' in rv.headers['Cache-Control']
+    assert f'max-age={constants.SENT_MESSAGE_CACHE_MAX_AGE}' in \
+        rv.headers['Cache-Control']
+    full_message = rv.data
+
+    # Revalidation of an unchanged message
+    rv = client.get('/message/1',
+                    headers={'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == HTTPStatus.NOT_MODIFIED
+    assert rv.data == b''
+
+    # Partial download
+    rv = client.get('/message/1', headers={'Range': 'bytes=100-199'})
+    assert rv.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert rv.headers['Content-Range'] == \
+        f'bytes 100-199/{db_order.message_size}'
+    assert rv.data == full_message[100:200]
+
+    # Messages not sent yet must be revalidated by caches
+    db_order.status = OrderStatus.transmitting.value
+    db.session.commit()
+    rv = client.get('/message/1')
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.headers['Cache-Control'] == 'no-cache'
+
+
+@patch('orders.new_invoice')
+@patch('constants.MSG_X_ACCEL_REDIRECT_PREFIX', '/internal/messages/')
+def test_get_sent_message_x_accel_redirect(mock_new_invoice, client):
+    uuid = generate_test_order(mock_new_invoice,
+                               client,
+                               order_status=OrderStatus.sent,
+                               tx_seq_num=1)['uuid']
+
+    # The file transfer should be delegated to the reverse proxy
+    rv = client.get('/message/1')
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.data == b''
+    assert rv.headers['X-Accel-Redirect'] == \
+        f'/internal/messages/{uuid[0:2]}/{uuid[2:4]}/{uuid}'
+    assert rv.headers['Content-Disposition'] == \
+        f'attachment; filename={uuid}'
+    # The ETag matches the one served without the reverse proxy
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    assert rv.headers['ETag'] == f'"{db_order.message_digest}"'
+
+
+@patch('orders.new_invoice')
+@patch('constants.MSG_X_ACCEL_REDIRECT_PREFIX', '/internal/messages/')
+def test_get_sent_message_x_accel_redirect_conditional(mock_new_invoice,
+                                                       client):
+    uuid = generate_test_order(mock_new_invoice,
+                               client,
+                               order_status=OrderStatus.sent,
+                               tx_seq_num=1)['uuid']
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    etag = f'"{db_order.message_digest}"'
+
+    # If-None-Match is answered before delegating to the reverse proxy
+    rv = client.get('/message/1', headers={'If-None-Match': etag})
+    assert rv.status_code == HTTPStatus.NOT_MODIFIED
+    assert 'X-Accel-Redirect' not in rv.headers
+    assert rv.headers['ETag'] == etag
+    assert 'immutable' in rv.headers['Cache-Control']
+
+    # A stale ETag gets the redirect
+    rv = client.get('/message/1', headers={'If-None-Match': '"other"'})
+    assert rv.status_code == HTTPStatus.OK
+    assert 'X-Accel-Redirect' in rv.headers
+
+    # If-Range is evaluated without the reverse proxy
+    rv = client.get('/message/1',
+                    headers={
+                        'If-Range': etag,
+                        'Range': 'bytes=0-1'
+                    })
+    assert rv.status_code == HTTPStatus.PARTIAL_CONTENT
+    assert 'X-Accel-Redirect' not in rv.headers
+    assert rv.headers['Content-Range'] == \
+        f'bytes 0-1/{db_order.message_size}'
+
+    rv = client.get('/message/1',
+                    headers={
+                        'If-Range': '"other"',
+                        'Range': 'bytes=0-1'
+                    })
+    assert rv.status_code == HTTPStatus.OK
+    assert 'X-Accel-Redirect' not in rv.headers
+    assert rv.headers['ETag'] == etag
+
+
 @patch('orders.new_invoice')
 def test_get_sent_message_by_seq_number_unauthorized_channel_op(
         mock_new_invoice, client):
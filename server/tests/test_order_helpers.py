@@ -6,10 +6,11 @@ from unittest.mock import patch
 
 from constants import EXPIRE_PENDING_ORDERS_AFTER_DAYS, \
     InvoiceStatus, MESSAGE_FILE_RETENTION_TIME_DAYS, \
-    OrderStatus, MSG_STORE_PATH
+    OrderStatus
 from database import db
 from models import Order, TxRetry
 from regions import Regions, region_number_list_to_code, region_number_to_id
+import message_store
 import order_helpers
 import server
 
@@ -42,7 +43,7 @@ def test_expire_pending_orders(mock_new_invoice, client):
 
     expired_orders = order_helpers.expire_old_pending_orders()
     assert len(expired_orders) == 1
-    assert expired_orders[0].uuid == to_be_expired_order_uuid
+    assert expired_orders[0] == to_be_expired_order_uuid
 
     # refetch and check
     # expectation is that the order gets expired
@@ -57,6 +58,27 @@ def test_expire_pending_orders(mock_new_invoice, client):
     assert pending_not_yet_expired_db_order.status == OrderStatus.pending.value
 
 
+@patch('constants.CLEANUP_BATCH_SIZE', 2)
+@patch('orders.new_invoice')
+def test_expire_pending_orders_in_batches(mock_new_invoice, client):
+    uuids = []
+    for i in range(5):
+        uuid = generate_test_order(mock_new_invoice, client,
+                                   order_id=i + 1)['uuid']
+        Order.query.filter_by(uuid=uuid).first().created_at = \
+            datetime.utcnow() - \
+            timedelta(days=EXPIRE_PENDING_ORDERS_AFTER_DAYS + 1)
+        uuids.append(uuid)
+    db.session.commit()
+
+    expired_uuids = order_helpers.expire_old_pending_orders()
+    assert sorted(expired_uuids) == sorted(uuids)
+    for uuid in uuids:
+        db_order = Order.query.filter_by(uuid=uuid).first()
+        assert db_order.status == OrderStatus.expired.value
+        assert not os.path.exists(message_store.message_path(uuid))
+
+
 @patch('orders.new_invoice')
 @pytest.mark.parametrize("status", [
     OrderStatus.paid, OrderStatus.transmitting, OrderStatus.sent,
@@ -110,51 +132,32 @@ def test_cleanup_old_message_files(mock_new_invoice, client):
     assert cleaned_up_orders[0].uuid == to_be_cleaned_order_uuid
 
     # refetch and check
-    message_path = os.path.join(MSG_STORE_PATH, to_be_cleaned_order_uuid)
+    message_path = message_store.message_path(to_be_cleaned_order_uuid)
     assert not os.path.exists(message_path)
-    message_path = os.path.join(MSG_STORE_PATH, not_to_be_cleaned_order_uuid)
+    message_path = message_store.message_path(not_to_be_cleaned_order_uuid)
     assert os.path.exists(message_path)
 
 
 @patch('orders.new_invoice')
-@pytest.mark.parametrize("status", [
-    OrderStatus.paid, OrderStatus.transmitting, OrderStatus.sent,
-    OrderStatus.received, OrderStatus.cancelled, OrderStatus.expired
-])
-def test_maybe_mark_order_as_expired_for_invalid_order(mock_new_invoice,
-                                                       client, status):
-    # when order does not exist
-    assert order_helpers.maybe_mark_order_as_expired(1) is None
-
-    # when order exists, but its status is not pending
-    generate_test_order(mock_new_invoice,
-                        client,
-                        order_id=1,
-                        order_status=status)
-    assert order_helpers.maybe_mark_order_as_expired(1) is None
-
+def test_maybe_mark_order_as_paid(mock_new_invoice, client):
+    uuid = generate_test_order(mock_new_invoice,
+                               client,
+                               order_id=1,
+                               invoice_status=InvoiceStatus.paid)['uuid']
+    assert order_helpers.maybe_mark_order_as_paid(1)
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    assert db_order.status == OrderStatus.paid.value
 
-@patch('orders.new_invoice')
-def test_maybe_mark_order_as_expired_pending_order_has_pending_invoice(
-        mock_new_invoice, client):
-    # when a pending order has a pending invoice
-    generate_test_order(mock_new_invoice, client, order_id=1)
-    assert order_helpers.maybe_mark_order_as_expired(1) is None
+    # Only the first call marks the order as paid
+    assert not order_helpers.maybe_mark_order_as_paid(1)
 
 
 @patch('orders.new_invoice')
-@pytest.mark.parametrize("invoice_status",
-                         [InvoiceStatus.paid, InvoiceStatus.expired])
-def test_maybe_mark_order_as_expired_successfully(mock_new_invoice, client,
-                                                  invoice_status):
-    # when a pending order does not have any pending invoice
-    uuid = generate_test_order(mock_new_invoice,
-                               client,
-                               order_id=1,
-                               invoice_status=invoice_status)['uuid']
-    assert order_helpers.maybe_mark_order_as_expired(1) is not None
+def test_maybe_mark_order_as_paid_insufficient_bid(mock_new_invoice, client):
+    uuid = generate_test_order(mock_new_invoice, client, order_id=1)['uuid']
+    assert not order_helpers.maybe_mark_order_as_paid(1)
     db_order = Order.query.filter_by(uuid=uuid).first()
-    assert db_order.status == OrderStatus.expired.value
+    assert db_order.status == OrderStatus.pending.value
 
 
 @patch('orders.new_invoice')
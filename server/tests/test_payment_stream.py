@@ -0,0 +1,49 @@
+import requests
+from unittest.mock import MagicMock, patch
+
+import payment_stream
+
+
+@patch('payment_stream.lightning_charge.get')
+def test_connect(mock_charge_get):
+    response = MagicMock()
+    response.__enter__.return_value = response
+    response.iter_lines.return_value = [
+        ':ok', '', 'data:{"id": "lid1", "status": "paid"}', '', 'data:invalid',
+        '', 'data:{"id": "lid2", "status": "paid"}', ''
+    ]
+    mock_charge_get.return_value = response
+
+    consumer = payment_stream.PaymentStreamConsumer()
+    assert consumer.missed_payments
+    consumer.connect()
+    assert consumer.connected
+    assert mock_charge_get.call_args[0] == ('/payment-stream', )
+    assert mock_charge_get.call_args[1]['stream']
+
+    paid = []
+    while not consumer.paid.empty():
+        paid.append(consumer.paid.get())
+    assert paid == ['lid1', 'lid2']
+
+
+@patch('payment_stream.time.sleep')
+@patch('payment_stream.lightning_charge.get')
+def test_reconnect(mock_charge_get, mock_sleep):
+    consumer = payment_stream.PaymentStreamConsumer()
+
+    def disconnect(*args, **kwargs):
+        consumer.connected = True
+        consumer.missed_payments = False
+        if mock_charge_get.call_count == 2:
+            consumer.stop()
+        raise requests.exceptions.ConnectionError
+
+    mock_charge_get.side_effect = disconnect
+    consumer.loop()
+
+    # The consumer reconnects and flags the payments possibly missed
+    assert mock_charge_get.call_count == 2
+    assert mock_sleep.call_count == 2
+    assert not consumer.connected
+    assert consumer.missed_payments
@@ -0,0 +1,295 @@
+from datetime import datetime, timedelta
+import pytest
+from unittest.mock import patch
+
+from redis.exceptions import ConnectionError
+
+from common import generate_test_order, new_invoice
+from constants import InvoiceStatus, OrderStatus, USER_CHANNEL, \
+    GOSSIP_CHANNEL, BTC_SRC_CHANNEL
+from database import db
+from invoice_helpers import pay_invoice
+from models import Order, TxRetry
+import constants
+import order_helpers
+import scheduler
+import server
+
+
+@pytest.fixture
+def client(mockredis):
+    app = server.create_app(from_test=True)
+    app.app_context().push()
+    with app.test_client() as client:
+        yield client
+    server.teardown_app(app)
+
+
+def add_order(uuid,
+              bid_per_byte,
+              status=OrderStatus.paid,
+              channel=USER_CHANNEL):
+    order = Order(uuid=uuid,
+                  unpaid_bid=0,
+                  bid_per_byte=bid_per_byte,
+                  message_size=10,
+                  message_digest='some digest',
+                  status=status.value,
+                  channel=channel)
+    db.session.add(order)
+    db.session.commit()
+    return order
+
+
+def test_next_order_by_bid(client):
+    for uuid, bid_per_byte in [('low', 1), ('high', 3), ('mid', 2)]:
+        scheduler.push(add_order(uuid, bid_per_byte))
+
+    for uuid in ['high', 'mid', 'low']:
+        order = scheduler.next_order(USER_CHANNEL)
+        assert order.uuid == uuid
+        scheduler.remove(order)
+    assert scheduler.next_order(USER_CHANNEL) is None
+
+
+def test_next_order_fifo_among_equal_bids(client):
+    # Push in reverse order to check the tie is broken by the order id
+    orders = [add_order(f'uuid{i}', 1) for i in range(12)]
+    for order in reversed(orders):
+        scheduler.push(order)
+
+    for expected in orders:
+        order = scheduler.next_order(USER_CHANNEL)
+        assert order.id == expected.id
+        scheduler.remove(order)
+
+
+def test_next_order_per_channel(client):
+    scheduler.push(add_order('user', 1))
+    scheduler.push(add_order('gossip', 2, channel=GOSSIP_CHANNEL))
+
+    assert scheduler.next_order(USER_CHANNEL).uuid == 'user'
+    assert scheduler.next_order(GOSSIP_CHANNEL).uuid == 'gossip'
+
+
+def test_next_order_skips_stale_entries(client, mockredis):
+    cancelled = add_order('cancelled', 3)
+    transmitting = add_order('transmitting', 2)
+    paid = add_order('paid', 1)
+    for order in [cancelled, transmitting, paid]:
+        scheduler.push(order)
+
+    # Change the states behind the scheduler's back
+    cancelled.status = OrderStatus.cancelled.value
+    transmitting.status = OrderStatus.transmitting.value
+    db.session.commit()
+
+    assert scheduler.next_order(USER_CHANNEL).uuid == 'paid'
+    # The stale entries are dropped from the queue
+    assert mockredis.zcard(scheduler.PAID_QUEUE.format(USER_CHANNEL)) == 1
+
+
+def test_next_order_unavailable(client, mockredis):
+    mockredis.zrange.side_effect = ConnectionError
+    with pytest.raises(scheduler.SchedulerUnavailable):
+        scheduler.next_order(USER_CHANNEL)
+    with pytest.raises(scheduler.SchedulerUnavailable):
+        scheduler.next_retransmission(USER_CHANNEL)
+
+
+def test_push_failure_is_not_fatal(client, mockredis):
+    mockredis.zadd.side_effect = ConnectionError
+    scheduler.push(add_order('uuid', 1))
+    mockredis.zadd.assert_called_once()
+
+
+def test_next_retransmission(client):
+    low = add_order('low', 1, status=OrderStatus.confirming)
+    high = add_order('high', 2, status=OrderStatus.confirming)
+    db.session.add(TxRetry(order_id=low.id, region_code=1))
+    db.session.add(TxRetry(order_id=high.id, region_code=1, pending=False))
+    db.session.commit()
+    scheduler.push_retry(low)
+    scheduler.push_retry(high)
+
+    # The highest bidder is no longer pending retransmission
+    order, retry_info = scheduler.next_retransmission(USER_CHANNEL)
+    assert order.uuid == 'low'
+    assert retry_info.order_id == low.id
+
+    scheduler.remove(low)
+    assert scheduler.next_retransmission(USER_CHANNEL) == (None, None)
+
+
+def test_rebuild(client, mockredis):
+    paid = add_order('paid', 1)
+    confirming = add_order('confirming', 2, status=OrderStatus.confirming)
+    sent = add_order('sent', 3, status=OrderStatus.sent)
+    db.session.add(TxRetry(order_id=confirming.id, region_code=1))
+    db.session.commit()
+    # Stale entry
+    scheduler.push(sent)
+
+    scheduler.rebuild()
+
+    paid_queue = scheduler.PAID_QUEUE.format(USER_CHANNEL)
+    retry_queue = scheduler.RETRY_QUEUE.format(USER_CHANNEL)
+    assert mockredis.zrange(paid_queue, 0, -1) == [f'{paid.id:012d}'.encode()]
+    assert mockredis.zrange(retry_queue, 0,
+                            -1) == [f'{confirming.id:012d}'.encode()]
+
+
+def test_rebuild_concurrent_push(client, mockredis):
+    paid = add_order('paid', 1)
+    bumped = add_order('bumped', 1)
+    pending = add_order('pending', 1, status=OrderStatus.pending)
+    scheduler.push(bumped)
+    paid_queue = scheduler.PAID_QUEUE.format(USER_CHANNEL)
+
+    # Pay the pending order and bump the queued one on the API server right
+    # after the database snapshot is taken by the rebuild
+    query = db.session.query
+
+    def query_and_push(*args):
+        res = query(*args)
+        mockredis.zadd(paid_queue, {
+            f'{pending.id:012d}': -2,
+            f'{bumped.id:012d}': -3
+        })
+        return res
+
+    with patch.object(db.session, 'query', side_effect=query_and_push):
+        scheduler.rebuild()
+
+    # Neither update is lost
+    assert mockredis.zrange(paid_queue, 0, -1, withscores=True) == [
+        (f'{bumped.id:012d}'.encode(), -3.0),
+        (f'{pending.id:012d}'.encode(), -2.0),
+        (f'{paid.id:012d}'.encode(), -1.0),
+    ]
+
+
+@patch('orders.new_invoice')
+def test_paid_bump_requeues_order(mock_new_invoice, client, mockredis):
+    uuid = generate_test_order(mock_new_invoice,
+                               client,
+                               invoice_status=InvoiceStatus.pending)['uuid']
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    assert scheduler.next_order(USER_CHANNEL) is None
+
+    # Paying the order queues it for transmission
+    pay_invoice(db_order.invoices[0])
+    assert scheduler.next_order(USER_CHANNEL).uuid == uuid
+    bid_per_byte = db_order.bid_per_byte
+
+    # Paying a bump of the paid order updates its priority
+    bump_invoice = new_invoice(db_order.id, InvoiceStatus.pending, 1000)
+    order_helpers.add_invoice(db_order, bump_invoice)
+    db.session.commit()
+    pay_invoice(bump_invoice)
+    assert db_order.bid_per_byte > bid_per_byte
+    mockredis.zadd.assert_called_with(
+        scheduler.PAID_QUEUE.format(USER_CHANNEL),
+        {f'{db_order.id:012d}': -db_order.bid_per_byte})
+
+
+@patch('orders.new_invoice')
+def test_cancelled_order_is_dequeued(mock_new_invoice, client, mockredis):
+    uuid = generate_test_order(mock_new_invoice,
+                               client,
+                               invoice_status=InvoiceStatus.pending)['uuid']
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    pay_invoice(db_order.invoices[0])
+    assert scheduler.next_order(USER_CHANNEL).uuid == uuid
+
+    rv = client.delete(
+        f'/order/{uuid}',
+        headers={'X-Auth-Token': order_helpers.compute_auth_token(uuid)})
+    assert rv.status_code == 200
+    assert mockredis.zcard(scheduler.PAID_QUEUE.format(USER_CHANNEL)) == 0
+
+
+def test_due_deadlines(client, mockredis):
+    first, second, third = [add_order(f'uuid{i}', 1) for i in range(3)]
+    now = datetime.utcnow()
+    scheduler.set_deadline(second, now - timedelta(seconds=1))
+    scheduler.set_deadline(first, now - timedelta(seconds=2))
+    scheduler.set_deadline(third, now + timedelta(seconds=1))
+
+    # Earliest deadline first
+    assert scheduler.due_deadlines(now) == [first.id, second.id]
+
+    # Resetting a timer replaces the previous deadline
+    scheduler.set_deadline(first, now + timedelta(seconds=2))
+    assert scheduler.due_deadlines(now) == [second.id]
+
+    scheduler.clear_deadline(second.id)
+    assert scheduler.due_deadlines(now) == []
+    assert scheduler.due_deadlines(now + timedelta(seconds=2)) == \
+        [third.id, first.id]
+
+    mockredis.zrangebyscore.side_effect = ConnectionError
+    with pytest.raises(scheduler.SchedulerUnavailable):
+        scheduler.due_deadlines(now)
+
+
+def drr_picks(heads, n, idle=set(), state=None):
+    """Pick n channels with DRR, assuming the heads never change"""
+    state = state or scheduler.new_drr_state()
+    return [scheduler.drr_pick(heads, idle, state) for _ in range(n)]
+
+
+def test_drr_pick_weights(mocker):
+    mocker.patch.object(constants.CHANNEL_INFO[USER_CHANNEL], 'weight', 3)
+    msg_len = constants.DRR_QUANTUM_BYTES
+    picks = drr_picks({USER_CHANNEL: msg_len, GOSSIP_CHANNEL: msg_len}, 400)
+    assert picks.count(USER_CHANNEL) == 300
+    assert picks.count(GOSSIP_CHANNEL) == 100
+
+
+def test_drr_pick_shares_bytes():
+    # Equal weights lead to equal shares of bytes, regardless of the message
+    # sizes, also when the messages are much larger than the quantum
+    small = constants.DRR_QUANTUM_BYTES // 10
+    large = constants.DRR_QUANTUM_BYTES * 100
+    heads = {USER_CHANNEL: small, BTC_SRC_CHANNEL: large}
+    picks = drr_picks(heads, 2002)
+    assert picks.count(BTC_SRC_CHANNEL) == 2
+    assert picks.count(USER_CHANNEL) == 2000
+    # The large messages do not wait for all the small ones
+    first_large = picks.index(BTC_SRC_CHANNEL)
+    assert 900 <= first_large <= 1000
+
+
+def test_drr_pick_idle_and_blocked_channels():
+    msg_len = constants.DRR_QUANTUM_BYTES * 2
+    state = scheduler.new_drr_state()
+
+    # Nothing to transmit
+    assert scheduler.drr_pick({}, set(constants.CHANNELS), state) is None
+
+    # A channel left out of the heads without being idle (e.g., with a full
+    # in-flight window) keeps its deficit
+    state['deficits'][GOSSIP_CHANNEL] = msg_len
+    assert drr_picks({USER_CHANNEL: msg_len}, 3, state=state) == \
+        [USER_CHANNEL] * 3
+    assert state['deficits'][GOSSIP_CHANNEL] == msg_len
+
+    # An idle channel loses its deficit
+    scheduler.drr_pick({USER_CHANNEL: msg_len}, {GOSSIP_CHANNEL}, state)
+    assert state['deficits'][GOSSIP_CHANNEL] == 0
+
+
+def test_drr_state_persistence(client):
+    heads = {USER_CHANNEL: 1000, GOSSIP_CHANNEL: 50000}
+    state = scheduler.new_drr_state()
+    expected = drr_picks(heads, 20, state=state)
+    scheduler.save_drr_state(scheduler.new_drr_state())
+
+    # Picking across processes, with the state stored on Redis
+    picks = []
+    for _ in range(20):
+        state = scheduler.load_drr_state()
+        picks.append(scheduler.drr_pick(heads, set(), state))
+        scheduler.save_drr_state(state)
+    assert picks == expected
@@ -1,17 +1,25 @@
 import json
 import pytest
+import threading
 from datetime import datetime, timedelta
+from math import ceil
 from unittest.mock import patch
 
+from redis.exceptions import ConnectionError
+
+from bidding import calc_ota_msg_len
 from common import generate_test_order, pay_invoice, confirm_tx
 from constants import InvoiceStatus, OrderStatus, USER_CHANNEL
+import scheduler
 import transmitter
 from database import db
 from schemas import order_schema
 from models import Order, TxRetry, TxConfirmation
 from regions import Regions, all_region_numbers, region_number_list_to_code
 from order_helpers import refresh_retransmission_table, \
-    get_next_retransmission, sent_or_received_criteria_met, assert_order_state
+    get_next_retransmission, sent_or_received_criteria_met, \
+    assert_order_state, process_retransmission_deadlines, \
+    schedule_retransmission
 import constants
 import server
 
@@ -143,6 +151,478 @@ def test_assign_tx_seq_num(mock_new_invoice, client):
     assert third_db_order.tx_seq_num == 3
 
 
+def test_next_tx_seq_num_concurrency(app):
+    n_threads = 8
+    n_allocations = 25
+    results = []
+
+    def allocate():
+        with app.app_context():
+            for _ in range(n_allocations):
+                results.append(transmitter.next_tx_seq_num())
+                db.session.commit()
+            db.session.remove()
+
+    threads = [threading.Thread(target=allocate) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each allocation gets a distinct number and there are no gaps
+    assert sorted(results) == list(range(1, n_threads * n_allocations + 1))
+
+
+@patch('orders.new_invoice')
+def test_assign_tx_seq_num_after_existing_orders(mock_new_invoice, client):
+    # The counter starts after the highest sequence number already assigned
+    generate_test_order(mock_new_invoice,
+                        client,
+                        order_status=OrderStatus.sent,
+                        tx_seq_num=7)
+    uuid = generate_test_order(mock_new_invoice, client, order_id=2)['uuid']
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    transmitter.assign_tx_seq_num(db_order)
+    assert db_order.tx_seq_num == 8
+
+
+def test_tx_start_concurrency(app):
+    for i in range(5):
+        order = Order(uuid=f'uuid{i}',
+                      unpaid_bid=0,
+                      bid_per_byte=i,
+                      message_size=10,
+                      message_digest='some digest',
+                      status=OrderStatus.paid.value)
+        db.session.add(order)
+    db.session.commit()
+    scheduler.rebuild()
+
+    def start():
+        with app.app_context():
+            transmitter.tx_start(USER_CHANNEL)
+            db.session.remove()
+
+    threads = [threading.Thread(target=start) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Only the highest bidder is transmitted
+    db.session.expire_all()
+    transmitting = Order.query.filter_by(
+        status=OrderStatus.transmitting.value).all()
+    assert [x.uuid for x in transmitting] == ['uuid4']
+    assert transmitting[0].tx_seq_num == 1
+
+    stats = transmitter.get_lock_stats()['transmissions']
+    assert stats['acquired'] == 8
+    assert stats['timeouts'] == 0
+    assert stats['wait_histogram']['+Inf'] == 8
+
+
+def test_tx_start_lock_timeout(app, mockredis):
+    generate_paid_test_orders()
+
+    # Another process holds the lock
+    lock = mockredis.lock(transmitter.TX_LOCK.format(USER_CHANNEL))
+    assert lock.acquire()
+    with patch('constants.TX_LOCK_TIMEOUT_SECS', 0.01):
+        transmitter.tx_start(USER_CHANNEL)
+    assert_order_state('uuid_user', 'paid')
+    stats = transmitter.get_lock_stats()['transmissions']
+    assert stats['acquired'] == 0
+    assert stats['timeouts'] == 1
+
+    # Once released, the transmission can start
+    lock.release()
+    transmitter.tx_start(USER_CHANNEL)
+    assert_order_state('uuid_user', 'transmitting')
+
+
+def test_tx_start_lock_unavailable(app, mockredis):
+    generate_paid_test_orders()
+    mockredis.lock.return_value.acquire.side_effect = ConnectionError
+    transmitter.tx_start(USER_CHANNEL)
+    assert_order_state('uuid_user', 'transmitting')
+    mockredis.lock.return_value.release.assert_not_called()
+
+
+def test_get_lock_stats(client):
+    generate_paid_test_orders()
+    transmitter.tx_start()
+
+    rv = client.get('/admin/tx/lock-stats')
+    assert rv.status_code == 200
+    for channel in constants.CHANNELS:
+        stats = rv.get_json()[constants.CHANNEL_INFO[channel].name]
+        assert stats['acquired'] == 1
+        assert stats['timeouts'] == 0
+        assert stats['mean_wait_secs'] == stats['wait_secs']
+        assert stats['wait_histogram']['+Inf'] == 1
+        assert stats['wait_histogram']['10'] == 1
+
+
+def test_tx_start_inflight_window(client, mocker):
+    mocker.patch.object(constants.CHANNEL_INFO[USER_CHANNEL], 'max_inflight',
+                        3)
+    for i in range(5):
+        db.session.add(
+            Order(uuid=f'uuid{i}',
+                  unpaid_bid=0,
+                  bid_per_byte=i,
+                  message_size=10,
+                  message_digest='some digest',
+                  status=OrderStatus.paid.value))
+    db.session.commit()
+    scheduler.rebuild()
+
+    # The three highest bidders are transmitted, with sequence numbers
+    # assigned in the order of transmission
+    transmitter.tx_start(USER_CHANNEL)
+    transmitting = Order.query.filter_by(
+        status=OrderStatus.transmitting.value).order_by(
+            Order.tx_seq_num).all()
+    assert [(x.uuid, x.tx_seq_num) for x in transmitting] == \
+        [('uuid4', 1), ('uuid3', 2), ('uuid2', 3)]
+
+    # The window is full
+    transmitter.tx_start(USER_CHANNEL)
+    assert_order_state('uuid1', 'paid')
+
+    # Once an order is confirmed by a Tx host, the next one starts
+    confirm_tx(1, [all_region_numbers[0]], client)
+    assert_order_state('uuid4', 'confirming')
+    assert_order_state('uuid1', 'transmitting')
+    assert Order.query.filter_by(uuid='uuid1').first().tx_seq_num == 4
+    assert_order_state('uuid0', 'paid')
+
+
+def test_retransmission_timeout_with_inflight_window(client, mocker):
+    mocker.patch.object(constants.CHANNEL_INFO[USER_CHANNEL], 'max_inflight',
+                        2)
+    generate_paid_test_orders()
+    transmitter.tx_start(USER_CHANNEL)
+    order = Order.query.filter_by(uuid='uuid_user').first()
+    tx_rate = constants.CHANNEL_INFO[USER_CHANNEL].tx_rate
+    tx_delay = int(ceil(calc_ota_msg_len(order.message_size) / tx_rate))
+
+    # The order may still be queued behind another order on the Tx hosts
+    order.started_transmission_at = datetime.utcnow() - timedelta(
+        seconds=1.5 * tx_delay + constants.DEFAULT_TX_CONFIRM_TIMEOUT_SECS)
+    db.session.commit()
+    refresh_retransmission_table()
+    assert_order_state('uuid_user', 'transmitting')
+
+    # Only once the serialization of both has elapsed, the order times out
+    order.started_transmission_at = datetime.utcnow() - timedelta(
+        seconds=2 * tx_delay + constants.DEFAULT_TX_CONFIRM_TIMEOUT_SECS + 1)
+    db.session.commit()
+    refresh_retransmission_table()
+    assert_order_state('uuid_user', 'confirming')
+
+
+def test_retransmission_timers(client):
+    generate_paid_test_orders()
+    transmitter.tx_start(USER_CHANNEL)
+    order = Order.query.filter_by(uuid='uuid_user').first()
+    tx_rate = constants.CHANNEL_INFO[USER_CHANNEL].tx_rate
+    tx_delay = int(ceil(calc_ota_msg_len(order.message_size) / tx_rate))
+    timeout_interval = timedelta(seconds=tx_delay +
+                                 constants.DEFAULT_TX_CONFIRM_TIMEOUT_SECS)
+    one_sec = timedelta(seconds=1)
+
+    # The timer is set when the transmission starts
+    t_start = order.started_transmission_at
+    assert order.id not in scheduler.due_deadlines(t_start + timeout_interval -
+                                                   one_sec)
+    assert order.id in scheduler.due_deadlines(t_start + timeout_interval)
+    assert process_retransmission_deadlines() == []
+    assert_order_state('uuid_user', 'transmitting')
+
+    # Once the timer expires, the order is scheduled for retransmission and
+    # the timer is cleared
+    order.started_transmission_at = t_start - timeout_interval - one_sec
+    db.session.commit()
+    schedule_retransmission(order)
+    assert process_retransmission_deadlines() == [order]
+    assert_order_state('uuid_user', 'confirming')
+    assert TxRetry.query.filter_by(order_id=order.id).first().pending
+    assert order.id not in scheduler.due_deadlines(datetime.max)
+
+    # The retransmission sets the timer again
+    transmitter.tx_start(USER_CHANNEL)
+    assert_order_state('uuid_user', 'transmitting')
+    retry_info = TxRetry.query.filter_by(order_id=order.id).first()
+    assert retry_info.retry_count == 1
+    assert order.id in scheduler.due_deadlines(retry_info.last_attempt +
+                                               timeout_interval)
+
+    # Each Tx confirmation restarts the confirmation timeout
+    confirm_tx(order.tx_seq_num, [all_region_numbers[0]], client)
+    assert_order_state('uuid_user', 'confirming')
+    last_confirmation = TxConfirmation.query.filter_by(
+        order_id=order.id).first()
+    t_confirm_timeout = last_confirmation.created_at + timedelta(
+        seconds=constants.DEFAULT_TX_CONFIRM_TIMEOUT_SECS)
+    assert order.id not in scheduler.due_deadlines(t_confirm_timeout - one_sec)
+    assert order.id in scheduler.due_deadlines(t_confirm_timeout)
+
+    # A timer that expires before the order's current deadline is pushed back
+    scheduler.set_deadline(order, datetime.utcnow() - one_sec)
+    assert process_retransmission_deadlines() == []
+    assert_order_state('uuid_user', 'confirming')
+    assert order.id in scheduler.due_deadlines(t_confirm_timeout)
+
+    # The timer is cleared when the transmission ends
+    confirm_tx(order.tx_seq_num, all_region_numbers, client)
+    assert_order_state('uuid_user', 'sent')
+    assert order.id not in scheduler.due_deadlines(datetime.max)
+
+
+def test_retransmission_timer_of_stale_order(client):
+    add_paid_orders(1)
+    order = Order.query.first()
+    scheduler.set_deadline(order, datetime.utcnow() - timedelta(seconds=1))
+
+    # The order is not awaiting Tx confirmations, so the timer is dropped
+    assert process_retransmission_deadlines() == []
+    assert_order_state('uuid0', 'paid')
+    assert scheduler.due_deadlines(datetime.max) == []
+
+
+def add_paid_orders(n, message_size=100000):
+    for i in range(n):
+        db.session.add(
+            Order(uuid=f'uuid{i}',
+                  unpaid_bid=0,
+                  bid_per_byte=n - i,
+                  message_size=message_size,
+                  message_digest='some digest',
+                  status=OrderStatus.paid.value))
+    db.session.commit()
+    scheduler.rebuild()
+
+
+def test_predict_end_of_transmissions(client):
+    assert transmitter.predict_end_of_transmissions(USER_CHANNEL) is None
+
+    add_paid_orders(2)
+    tx_rate = constants.CHANNEL_INFO[USER_CHANNEL].tx_rate
+    tx_delay = timedelta(seconds=calc_ota_msg_len(100000) / tx_rate)
+    transmitter.tx_start(USER_CHANNEL)
+    first_order = Order.query.filter_by(uuid='uuid0').first()
+    t_start = first_order.started_transmission_at
+    assert transmitter.predict_end_of_transmissions(USER_CHANNEL) == \
+        t_start + tx_delay
+
+    # Once the first order is confirmed, the second one starts. It starts
+    # serializing when published or, if the confirmation of the first order
+    # arrives later than that, when confirmed.
+    confirm_tx(first_order.tx_seq_num, [all_region_numbers[0]], client)
+    second_order = Order.query.filter_by(uuid='uuid1').first()
+    t_published = second_order.started_transmission_at
+    tx_confirmation = first_order.tx_confirmations[0]
+    for t_confirmed, t_start in [
+        (t_published - timedelta(seconds=10), t_published),
+        (t_published + timedelta(seconds=10),
+         t_published + timedelta(seconds=10)),
+    ]:
+        tx_confirmation.created_at = t_confirmed
+        db.session.commit()
+        assert transmitter.predict_end_of_transmissions(USER_CHANNEL) == \
+            t_start + tx_delay
+
+
+def test_predict_end_of_transmissions_with_retransmission(client, mocker):
+    mocker.patch.object(constants.CHANNEL_INFO[USER_CHANNEL], 'max_inflight',
+                        2)
+    add_paid_orders(2)
+    tx_rate = constants.CHANNEL_INFO[USER_CHANNEL].tx_rate
+    tx_delay = timedelta(seconds=calc_ota_msg_len(100000) / tx_rate)
+
+    # The first order was transmitted long ago and is now being retransmitted
+    # right behind a fresh transmission of the second order
+    transmitter.tx_start(USER_CHANNEL)
+    retransmitted = Order.query.filter_by(uuid='uuid0').first()
+    fresh = Order.query.filter_by(uuid='uuid1').first()
+    now = datetime.utcnow()
+    retransmitted.started_transmission_at = now - timedelta(hours=1)
+    fresh.started_transmission_at = now - timedelta(seconds=1)
+    db.session.add(
+        TxRetry(order_id=retransmitted.id,
+                region_code=1,
+                retry_count=1,
+                last_attempt=now,
+                pending=False))
+    db.session.commit()
+
+    # The retransmission is serialized after the fresh order
+    assert transmitter.predict_end_of_transmissions(USER_CHANNEL) == \
+        fresh.started_transmission_at + 2 * tx_delay
+
+
+def test_prestage_retransmission(client, mocker):
+    mocker.patch.object(constants.CHANNEL_INFO[USER_CHANNEL], 'prestage_secs',
+                        5)
+    add_paid_orders(2)
+    tx_rate = constants.CHANNEL_INFO[USER_CHANNEL].tx_rate
+    tx_delay = timedelta(seconds=calc_ota_msg_len(100000) / tx_rate)
+
+    # An order transmitted long ago has just been retransmitted
+    transmitter.tx_start(USER_CHANNEL)
+    order = Order.query.filter_by(uuid='uuid0').first()
+    now = datetime.utcnow()
+    order.started_transmission_at = now - timedelta(hours=1)
+    db.session.add(
+        TxRetry(order_id=order.id,
+                region_code=1,
+                retry_count=1,
+                last_attempt=now,
+                pending=False))
+    db.session.commit()
+    assert transmitter.predict_end_of_transmissions(USER_CHANNEL) == \
+        now + tx_delay
+
+    # The retransmission is far from its end, so nothing is pre-staged
+    transmitter.prestage()
+    assert_order_state('uuid1', 'paid')
+
+
+def test_prestage(client, mocker):
+    mocker.patch.object(constants.CHANNEL_INFO[USER_CHANNEL], 'prestage_secs',
+                        5)
+    add_paid_orders(3)
+    tx_rate = constants.CHANNEL_INFO[USER_CHANNEL].tx_rate
+    tx_delay = calc_ota_msg_len(100000) / tx_rate
+
+    # Nothing to pre-stage before the first transmission starts
+    transmitter.prestage()
+    assert_order_state('uuid0', 'paid')
+
+    # The current transmission is far from its end
+    transmitter.tx_start(USER_CHANNEL)
+    transmitter.prestage()
+    assert_order_state('uuid0', 'transmitting')
+    assert_order_state('uuid1', 'paid')
+
+    # Close to its end, the next order is pre-staged
+    first_order = Order.query.filter_by(uuid='uuid0').first()
+    first_order.started_transmission_at = datetime.utcnow() - timedelta(
+        seconds=tx_delay - 3)
+    db.session.commit()
+    transmitter.prestage()
+    assert_order_state('uuid1', 'transmitting')
+    assert Order.query.filter_by(uuid='uuid1').first().tx_seq_num == 2
+
+    # Only one order is pre-staged
+    transmitter.prestage()
+    assert_order_state('uuid2', 'paid')
+
+    # When the current order is confirmed, the pre-staged order becomes the
+    # current one, so no other transmission starts
+    confirm_tx(first_order.tx_seq_num, [all_region_numbers[0]], client)
+    assert_order_state('uuid0', 'confirming')
+    assert_order_state('uuid1', 'transmitting')
+    assert_order_state('uuid2', 'paid')
+
+
+def test_prestage_disabled(client):
+    add_paid_orders(2)
+    transmitter.tx_start(USER_CHANNEL)
+    first_order = Order.query.filter_by(uuid='uuid0').first()
+    first_order.started_transmission_at = datetime.utcnow() - timedelta(
+        hours=1)
+    db.session.commit()
+    transmitter.prestage()
+    assert_order_state('uuid1', 'paid')
+
+
+def end_transmissions():
+    Order.query.filter_by(status=OrderStatus.transmitting.value).update(
+        {Order.status: OrderStatus.sent.value})
+    db.session.commit()
+
+
+def test_carrier_sharing(client, mocker):
+    mocker.patch('constants.CARRIER_SCHEDULING', 'drr')
+    mocker.patch('constants.CARRIER_MAX_INFLIGHT', 1)
+    user_msg_len = calc_ota_msg_len(1000)
+    mocker.patch('constants.DRR_QUANTUM_BYTES', 2 * user_msg_len)
+    for i in range(20):
+        db.session.add(
+            Order(uuid=f'user{i}',
+                  unpaid_bid=0,
+                  bid_per_byte=1,
+                  message_size=1000,
+                  message_digest='some digest',
+                  status=OrderStatus.paid.value,
+                  channel=USER_CHANNEL))
+    db.session.add(
+        Order(uuid='btc',
+              unpaid_bid=0,
+              message_size=10000,
+              message_digest='some digest',
+              status=OrderStatus.paid.value,
+              channel=constants.BTC_SRC_CHANNEL))
+    db.session.commit()
+    scheduler.rebuild()
+
+    channels = []
+    for _ in range(21):
+        # A single transmission on the carrier at a time, on any channel
+        transmitter.tx_start(USER_CHANNEL)
+        transmitting = Order.query.filter_by(
+            status=OrderStatus.transmitting.value).all()
+        assert len(transmitting) == 1
+        channels.append(transmitting[0].channel)
+        end_transmissions()
+
+    # Two user orders per round, while the btc-src order accumulates the
+    # quantum of the five rounds it needs
+    assert channels.index(constants.BTC_SRC_CHANNEL) == 10
+    assert channels.count(USER_CHANNEL) == 20
+
+    # Nothing left to transmit
+    transmitter.tx_start()
+    assert Order.query.filter_by(
+        status=OrderStatus.transmitting.value).count() == 0
+
+
+def test_carrier_sharing_long_transmission(client, mocker):
+    mocker.patch('constants.CARRIER_SCHEDULING', 'drr')
+    mocker.patch('constants.CARRIER_MAX_INFLIGHT', 2)
+    add_paid_orders(3, message_size=1000)
+    db.session.add(
+        Order(uuid='btc',
+              unpaid_bid=0,
+              message_size=constants.CHANNEL_INFO[
+                  constants.BTC_SRC_CHANNEL].max_msg_size,
+              message_digest='some digest',
+              status=OrderStatus.paid.value,
+              channel=constants.BTC_SRC_CHANNEL))
+    db.session.commit()
+    scheduler.rebuild()
+
+    # The long transmission takes one of the slots of the carrier
+    transmitter.tx_start()
+    assert_order_state('btc', 'transmitting')
+    assert_order_state('uuid0', 'transmitting')
+
+    # The user orders keep going on the other one
+    for uuid in ['uuid1', 'uuid2']:
+        Order.query.filter_by(channel=USER_CHANNEL,
+                              status=OrderStatus.transmitting.value).update(
+                                  {Order.status: OrderStatus.sent.value})
+        db.session.commit()
+        transmitter.tx_start(USER_CHANNEL)
+        assert_order_state(uuid, 'transmitting')
+        assert_order_state('btc', 'transmitting')
+
+    assert 'carrier' in transmitter.get_lock_stats()
+
+
 @patch('orders.new_invoice')
 def test_startup_sequence(mock_new_invoice, client, mockredis):
     # create an old transmitted order
@@ -389,6 +869,9 @@ def test_retransmission(mock_new_invoice, client, mockredis):
             seconds=constants.DEFAULT_TX_CONFIRM_TIMEOUT_SECS + 1)
     db.session.commit()
 
+    # The retransmission worker refreshes the retransmission table and then
+    # calls tx_start(). The latter does not refresh the table by itself.
+    refresh_retransmission_table()
     transmitter.tx_start()
     assert_order_state(first_order_uuid, 'transmitting')
     retry_order = TxRetry.query.all()
@@ -554,6 +1037,9 @@ def generate_paid_test_orders():
     db.session.add(btc_order)
     db.session.add(auth_order)
     db.session.commit()
+    # The orders are inserted directly into the database, so queue them for
+    # transmission like the workers do on startup
+    scheduler.rebuild()
 
 
 def test_tx_start_with_single_channel(client):
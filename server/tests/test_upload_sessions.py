@@ -0,0 +1,173 @@
+import os
+import pytest
+import time
+from hashlib import sha256
+from http import HTTPStatus
+from unittest.mock import patch
+from uuid import uuid4
+
+from common import check_upload, new_invoice, rnd_string
+from constants import InvoiceStatus, OrderStatus
+from error import assert_error
+from models import Order
+import bidding
+import constants
+import server
+import upload_sessions
+
+
+@pytest.fixture
+def client(mockredis):
+    app = server.create_app(from_test=True)
+    app.app_context().push()
+    with app.test_client() as client:
+        yield client
+    server.teardown_app(app)
+
+
+def create_session(client, size, channel=constants.BTC_SRC_CHANNEL):
+    rv = client.post('/admin/order/upload',
+                     data={
+                         'size': size,
+                         'channel': channel
+                     })
+    assert rv.status_code == HTTPStatus.OK
+    return rv.get_json()
+
+
+def put_chunk(client, session_id, offset, data):
+    return client.put(f'/admin/order/upload/{session_id}?offset={offset}',
+                      data=data,
+                      content_type='application/octet-stream')
+
+
+def test_resumable_upload(client):
+    msg = rnd_string(1000)
+    session = create_session(client, len(msg))
+    assert session['offset'] == 0
+    assert session['size'] == len(msg)
+    session_id = session['id']
+
+    rv = put_chunk(client, session_id, 0, msg[:400].encode())
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.get_json()['offset'] == 400
+
+    # After a connection drop, the client can query the current offset
+    rv = client.get(f'/admin/order/upload/{session_id}')
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.get_json()['offset'] == 400
+
+    # Chunks must be sent in order
+    rv = put_chunk(client, session_id, 300, msg[300:].encode())
+    assert_error(rv.get_json(), 'UPLOAD_OFFSET_MISMATCH')
+    assert rv.status_code == HTTPStatus.CONFLICT
+
+    # The session cannot be finalized before receiving all chunks
+    digest = sha256(msg.encode()).hexdigest()
+    rv = client.post(f'/admin/order/upload/{session_id}',
+                     data={'sha256': digest})
+    assert_error(rv.get_json(), 'UPLOAD_INCOMPLETE')
+
+    rv = put_chunk(client, session_id, 400, msg[400:].encode())
+    assert rv.status_code == HTTPStatus.OK
+    assert rv.get_json()['offset'] == len(msg)
+
+    rv = client.post(f'/admin/order/upload/{session_id}',
+                     data={'sha256': digest})
+    assert rv.status_code == HTTPStatus.OK
+    uuid = rv.get_json()['uuid']
+    check_upload(uuid, msg)
+
+    db_order = Order.query.filter_by(uuid=uuid).first()
+    assert db_order.channel == constants.BTC_SRC_CHANNEL
+    assert db_order.status == OrderStatus.transmitting.value
+    assert db_order.message_digest == digest
+
+    # The session is removed once finalized
+    rv = client.get(f'/admin/order/upload/{session_id}')
+    assert_error(rv.get_json(), 'UPLOAD_SESSION_NOT_FOUND')
+    assert os.listdir(constants.UPLOAD_SESSION_PATH) == []
+
+
+def test_upload_session_invalid_requests(client):
+    rv = client.post('/admin/order/upload',
+                     data={
+                         'size': constants.DEFAULT_MAX_MESSAGE_SIZE + 1,
+                         'channel': constants.USER_CHANNEL
+                     })
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_LARGE')
+
+    rv = client.post('/admin/order/upload', data={'size': 0})
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_SMALL')
+
+    session_id = create_session(client, 10)['id']
+    rv = put_chunk(client, session_id, 0, bytes(11))
+    assert_error(rv.get_json(), 'MESSAGE_FILE_TOO_LARGE')
+
+    rv = client.put(f'/admin/order/upload/{session_id}', data=bytes(10))
+    assert rv.status_code == HTTPStatus.BAD_REQUEST  # missing offset
+
+    for bad_id in [str(uuid4()), '..', 'blobs']:
+        rv = client.get(f'/admin/order/upload/{bad_id}')
+        assert_error(rv.get_json(), 'UPLOAD_SESSION_NOT_FOUND')
+
+
+def test_upload_session_digest_mismatch(client):
+    msg = rnd_string(100)
+    session_id = create_session(client, len(msg))['id']
+    put_chunk(client, session_id, 0, msg.encode())
+
+    rv = client.post(f'/admin/order/upload/{session_id}',
+                     data={'sha256': sha256(b'other').hexdigest()})
+    assert_error(rv.get_json(), 'MESSAGE_DIGEST_MISMATCH')
+    assert Order.query.count() == 0
+
+    # The corrupted session is dropped
+    rv = client.get(f'/admin/order/upload/{session_id}')
+    assert_error(rv.get_json(), 'UPLOAD_SESSION_NOT_FOUND')
+
+
+@patch('orders.new_invoice')
+def test_upload_session_rejected_bid(mock_new_invoice, client):
+    msg = rnd_string(100)
+    bid = bidding.get_min_bid(len(msg))
+    digest = sha256(msg.encode()).hexdigest()
+    session_id = create_session(client, len(msg), constants.USER_CHANNEL)['id']
+    put_chunk(client, session_id, 0, msg.encode())
+
+    rv = client.post(f'/admin/order/upload/{session_id}',
+                     data={
+                         'sha256': digest,
+                         'bid': bid - 1
+                     })
+    assert_error(rv.get_json(), 'BID_TOO_SMALL')
+
+    # The session remains available for another attempt
+    mock_new_invoice.return_value = (True,
+                                     new_invoice(1, InvoiceStatus.pending,
+                                                 bid))
+    rv = client.post(f'/admin/order/upload/{session_id}',
+                     data={
+                         'sha256': digest,
+                         'bid': bid
+                     })
+    assert rv.status_code == HTTPStatus.OK
+    check_upload(rv.get_json()['uuid'], msg)
+    assert 'lightning_invoice' in rv.get_json()
+
+
+def test_cleanup_expired_sessions(client):
+    active_id = create_session(client, 10)['id']
+    expired_id = create_session(client, 10)['id']
+
+    expired_time = time.time() - constants.UPLOAD_SESSION_TIMEOUT_SECS - 1
+    os.utime(os.path.join(constants.UPLOAD_SESSION_PATH, expired_id),
+             (expired_time, expired_time))
+
+    assert upload_sessions.cleanup_expired_sessions() == [expired_id]
+    assert sorted(os.listdir(constants.UPLOAD_SESSION_PATH)) == \
+        [active_id, active_id + '.json']
+
+    rv = client.delete(f'/admin/order/upload/{active_id}')
+    assert rv.status_code == HTTPStatus.OK
+    assert os.listdir(constants.UPLOAD_SESSION_PATH) == []
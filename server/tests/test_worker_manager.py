@@ -1,15 +1,18 @@
 from datetime import datetime, timedelta
 import os
 import pytest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from common import generate_test_order
 from constants import InvoiceStatus, OrderStatus
 from database import db
 from models import Order, Invoice
 import constants
+import message_store
+import payment_stream
 import server
-from worker_manager import cleanup_database
+from worker_manager import cleanup_database, poll_payments, \
+    process_payments
 
 
 @pytest.fixture
@@ -70,8 +73,94 @@ def test_cleanup_database(mock_new_invoice, client, app):
     pending_db_order = Order.query.filter_by(uuid=pending_order_uuid).first()
     assert pending_db_order.status == OrderStatus.expired.value
 
-    message_path = os.path.join(constants.MSG_STORE_PATH, pending_order_uuid)
+    message_path = message_store.message_path(pending_order_uuid)
     assert not os.path.exists(message_path)
 
-    message_path = os.path.join(constants.MSG_STORE_PATH, sent_order_uuid)
+    message_path = message_store.message_path(sent_order_uuid)
     assert not os.path.exists(message_path)
+
+
+@patch('worker_manager.transmitter.tx_start')
+@patch('orders.new_invoice')
+def test_process_payments(mock_new_invoice, mock_tx_start, client, app):
+    orders = [
+        generate_test_order(mock_new_invoice, client, order_id=i)
+        for i in range(1, 4)
+    ]
+    lids = [x['lightning_invoice']['id'] for x in orders]
+
+    consumer = payment_stream.PaymentStreamConsumer()
+    consumer.consume([
+        f'data:{{"id": "{lids[0]}", "status": "paid"}}', '',
+        f'data: {{"id": "{lids[1]}", "status": "paid"}}', '',
+        'data: {"id": "unknown"}', ':keep-alive'
+    ])
+    process_payments(app, consumer)
+
+    statuses = [
+        Order.query.filter_by(uuid=x['uuid']).first().status for x in orders
+    ]
+    assert statuses == [
+        OrderStatus.paid.value, OrderStatus.paid.value,
+        OrderStatus.pending.value
+    ]
+    # A single tx_start call for the two orders on the same channel
+    mock_tx_start.assert_called_once_with(constants.USER_CHANNEL)
+    assert consumer.paid.empty()
+
+
+@patch('worker_manager.transmitter.tx_start')
+@patch('invoice_helpers.lightning_charge.get')
+@patch('orders.new_invoice')
+def test_poll_payments(mock_new_invoice, mock_charge_get, mock_tx_start,
+                       client, app):
+    order = generate_test_order(mock_new_invoice, client)
+    mock_charge_get.return_value = Mock(
+        status_code=200, json=Mock(return_value={'status': 'paid'}))
+
+    # No polling while the payment stream is healthy
+    consumer = payment_stream.PaymentStreamConsumer()
+    consumer.connected = True
+    consumer.missed_payments = False
+    poll_payments(app, consumer)
+    mock_charge_get.assert_not_called()
+
+    # Catch up with the payments missed while disconnected
+    consumer.missed_payments = True
+    poll_payments(app, consumer)
+    assert not consumer.missed_payments
+    mock_charge_get.assert_called_once_with(
+        f"/invoice/{order['lightning_invoice']['id']}")
+    db_order = Order.query.filter_by(uuid=order['uuid']).first()
+    assert db_order.status == OrderStatus.paid.value
+    mock_tx_start.assert_called_once_with(constants.USER_CHANNEL)
+
+
+@patch('constants.CHARGE_POLL_BATCH_SIZE', 2)
+@patch('worker_manager.transmitter.tx_start')
+@patch('invoice_helpers.lightning_charge.get')
+@patch('orders.new_invoice')
+def test_poll_payments_in_pages(mock_new_invoice, mock_charge_get,
+                                mock_tx_start, client, app):
+    orders = [
+        generate_test_order(mock_new_invoice, client, order_id=i + 1)
+        for i in range(5)
+    ]
+    mock_charge_get.return_value = Mock(
+        status_code=200, json=Mock(return_value={'status': 'unpaid'}))
+
+    # A pass over the pending invoices polls up to two invoices per call
+    consumer = payment_stream.PaymentStreamConsumer()
+    consumer.connected = True
+    for n_polled in [2, 4, 5]:
+        poll_payments(app, consumer)
+        assert mock_charge_get.call_count == n_polled
+    assert consumer.poll_cursor is None
+    assert not consumer.missed_payments
+    # Each invoice is polled once
+    assert sorted(x[0][0] for x in mock_charge_get.call_args_list) == \
+        sorted(f"/invoice/{x['lightning_invoice']['id']}" for x in orders)
+
+    # The pass is complete
+    poll_payments(app, consumer)
+    assert mock_charge_get.call_count == 5
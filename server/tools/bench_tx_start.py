@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Benchmark of concurrent transmission starts
+
+Calls transmitter.tx_start from several processes in parallel, like the
+gunicorn workers and the worker manager do in production, and checks that
+the transmissions get distinct and consecutive Tx sequence numbers. Each
+process repeatedly starts the next transmission on every channel and ends it
+right away, until all orders are transmitted.
+
+The benchmark runs on a scratch SQLite database, but requires a Redis server,
+to which the transmissions are published and where the scheduler queues are
+kept. Do not point it to the Redis server used by the API server, otherwise
+the SSE server would relay the benchmark transmissions.
+
+Example:
+
+    redis-server --port 6380 &
+    python3 tools/bench_tx_start.py --redis-uri redis://127.0.0.1:6380
+
+"""
+from collections import Counter
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+from flask import Flask
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import constants  # noqa: E402
+import scheduler  # noqa: E402
+import transmitter  # noqa: E402
+from database import db  # noqa: E402
+from models import Order  # noqa: E402
+
+
+def create_app(db_file, redis_uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_file}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config["REDIS_INSTANCE"] = redis.from_url(redis_uri)
+    db.init_app(app)
+    return app
+
+
+def setup(app, n_orders):
+    with app.app_context():
+        db.create_all()
+        for _ in range(n_orders):
+            bid = random.randint(1000, 100000)
+            db.session.add(
+                Order(uuid=str(uuid4()),
+                      bid=bid,
+                      bid_per_byte=bid / 1000,
+                      unpaid_bid=0,
+                      message_size=1000,
+                      message_digest='bench',
+                      status=constants.OrderStatus.paid.value,
+                      channel=random.choice(constants.CHANNELS)))
+        db.session.commit()
+        scheduler.rebuild()
+
+
+def end_transmissions(channel):
+    """End the ongoing transmissions of a channel"""
+    Order.query.filter_by(status=constants.OrderStatus.transmitting.value,
+                          channel=channel).update(
+                              {Order.status: constants.OrderStatus.sent.value},
+                              synchronize_session=False)
+    db.session.commit()
+
+
+def hammer(db_file, redis_uri, deadline, results):
+    app = create_app(db_file, redis_uri)
+    calls = 0
+    errors = Counter()
+    with app.app_context():
+        while time.time() < deadline:
+            if Order.query.filter_by(
+                    status=constants.OrderStatus.paid.value).first() is None:
+                break
+            channels = list(constants.CHANNELS)
+            random.shuffle(channels)
+            for channel in channels:
+                try:
+                    transmitter.tx_start(channel)
+                    end_transmissions(channel)
+                except Exception as e:
+                    db.session.rollback()
+                    errors[type(e).__name__] += 1
+                calls += 1
+    results.put((calls, errors))
+
+
+def report(app, n_orders, elapsed, results):
+    calls = sum(x[0] for x in results)
+    errors = sum((x[1] for x in results), Counter())
+    with app.app_context():
+        seq_nums = [
+            x[0] for x in db.session.query(Order.tx_seq_num).filter(
+                Order.tx_seq_num.isnot(None))
+        ]
+        n_paid = Order.query.filter_by(
+            status=constants.OrderStatus.paid.value).count()
+
+    duplicates = len(seq_nums) - len(set(seq_nums))
+    gaps = (max(seq_nums) - len(set(seq_nums))) if seq_nums else 0
+    print(f"Transmissions: {len(seq_nums)}/{n_orders} "
+          f"({n_paid} left paid) in {elapsed:.1f} s")
+    print(f"tx_start calls: {calls} ({calls / elapsed:.0f}/s)")
+    print(f"Transmissions per second: {len(seq_nums) / elapsed:.1f}")
+    print(f"Duplicate sequence numbers: {duplicates}")
+    # Orders started more than once leave gaps, as their first sequence
+    # numbers are overwritten
+    print(f"Gaps in the sequence numbers: {gaps}")
+    print("Errors: " + (', '.join(f"{k}: {v}"
+                                  for k, v in errors.items()) or "none"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--orders',
+                        type=int,
+                        default=1000,
+                        help='Number of paid orders to transmit')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=2 * os.cpu_count() + 1,
+                        help='Number of processes calling tx_start')
+    parser.add_argument('--redis-uri',
+                        required=True,
+                        help='URI of a Redis server not used by the API '
+                        'server')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=300,
+                        help='Maximum benchmark duration in seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_file = os.path.join(tmpdir, 'bench.sqlite3')
+        app = create_app(db_file, args.redis_uri)
+        setup(app, args.orders)
+
+        results = multiprocessing.Queue()
+        t_start = time.time()
+        workers = [
+            multiprocessing.Process(target=hammer,
+                                    args=(db_file, args.redis_uri,
+                                          t_start + args.timeout, results))
+            for _ in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        worker_results = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - t_start
+
+        report(app, args.orders, elapsed, worker_results)
+
+
+if __name__ == '__main__':
+    main()
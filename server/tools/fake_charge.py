@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Lightning Charge stand-in for load and latency testing
+
+Implements the subset of the Lightning Charge API used by the Satellite API
+(invoice creation, webhook registration, invoice lookup, node information,
+and the payment stream) and pays the invoices by itself, i.e., without any
+Lightning node. Each invoice is paid after a delay sampled from a
+configurable distribution, subject to a maximum payment rate. Once paid, the
+payment callbacks registered for the invoice are fired and the invoice is
+published on the payment stream.
+
+Example:
+
+    python3 tools/fake_charge.py --port 9112 --pay-delay exp:0.5 --rate 50
+
+Then, run the API server with CHARGE_ROOT=http://127.0.0.1:9112 and
+CALLBACK_URI_ROOT pointing to the API server itself.
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from flask import Flask, Response, request
+import requests
+
+DISTRIBUTIONS = {
+    'const': (1, lambda x: x),
+    'uniform': (2, random.uniform),
+    'exp': (1, lambda mean: random.expovariate(1 / mean) if mean > 0 else 0),
+    'lognormal': (2, random.lognormvariate)
+}
+
+
+def parse_delay(spec):
+    """Parse a delay distribution specification
+
+    The specification has the format "name:param[,param]", where the name is
+    one of: "const:value", "uniform:low,high", "exp:mean", or
+    "lognormal:mu,sigma". All values are in seconds, except the lognormal
+    parameters, which are the mean and standard deviation of the underlying
+    normal distribution.
+
+    Returns:
+        Function that samples a delay in seconds from the distribution.
+
+    """
+    name, _, params = spec.partition(':')
+    if name not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown distribution {name}")
+    n_params, fcn = DISTRIBUTIONS[name]
+    try:
+        params = [float(x) for x in params.split(',')]
+    except ValueError:
+        raise ValueError(f"Invalid parameters in {spec}")
+    if len(params) != n_params:
+        raise ValueError(f"{name} takes {n_params} parameter(s)")
+    return lambda: max(0, fcn(*params))
+
+
+class Payer:
+    """Pays the invoices and fires the corresponding payment notifications
+
+    Args:
+        pay_delay (callable): Sampler of the delay between the creation of
+            an invoice and its payment.
+        rate (float): Maximum number of payments per second (0 for no limit).
+        pay_ratio (float): Fraction of the invoices that get paid.
+        callback_workers (int): Number of threads firing the callbacks.
+        callback_retries (int): Maximum number of retries of a callback that
+            fails or responds with a not found or server error status.
+
+    """
+
+    def __init__(self,
+                 pay_delay,
+                 rate,
+                 pay_ratio,
+                 callback_workers,
+                 callback_retries=5):
+        self.pay_delay = pay_delay
+        self.callback_retries = callback_retries
+        self.min_interval = 1 / rate if rate > 0 else 0
+        self.pay_ratio = pay_ratio
+        self.invoices = {}
+        self.subscribers = []
+        self.stats = {'paid': 0, 'callbacks': 0, 'callback_errors': 0}
+        self._due = []  # heap of (due time, invoice id)
+        self._cond = threading.Condition()
+        self._callbacks = ThreadPoolExecutor(max_workers=callback_workers)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def add_invoice(self, invoice):
+        with self._cond:
+            self.invoices[invoice['id']] = invoice
+            if random.random() < self.pay_ratio:
+                heapq.heappush(self._due,
+                               (time.time() + self.pay_delay(), invoice['id']))
+                self._cond.notify()
+
+    def add_webhook(self, lid, url):
+        """Register a payment callback URL
+
+        If the invoice is already paid (e.g., with a short payment delay),
+        the callback is fired right away.
+
+        """
+        with self._cond:
+            invoice = self.invoices[lid]
+            invoice['webhooks'].append(url)
+            paid = invoice['status'] == 'paid'
+        if paid:
+            self._callbacks.submit(self._fire_callback, url)
+
+    def subscribe(self):
+        q = queue.Queue()
+        with self._cond:
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._cond:
+            self.subscribers.remove(q)
+
+    def _fire_callback(self, url, attempt=0):
+        # The callback can reach the API server before the order is committed
+        # (invoice not found), so retry it with exponential backoff
+        try:
+            rv = requests.post(url, timeout=30)
+            failed = rv.status_code == HTTPStatus.NOT_FOUND or \
+                rv.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR
+            error = rv.status_code
+        except requests.exceptions.RequestException as e:
+            failed = True
+            error = e
+
+        if failed and attempt < self.callback_retries:
+            threading.Timer(0.1 * 2**attempt,
+                            self._callbacks.submit,
+                            args=(self._fire_callback, url,
+                                  attempt + 1)).start()
+            return
+
+        if failed:
+            logging.warning(f"Payment callback {url} failed: {error}")
+        with self._cond:
+            self.stats['callback_errors' if failed else 'callbacks'] += 1
+
+    def pay(self, lid):
+        with self._cond:
+            invoice = self.invoices[lid]
+            invoice['status'] = 'paid'
+            invoice['paid_at'] = time.time()
+            invoice['msatoshi_received'] = invoice['msatoshi']
+            self.stats['paid'] += 1
+            webhooks = list(invoice['webhooks'])
+            subscribers = list(self.subscribers)
+
+        for q in subscribers:
+            q.put(invoice)
+        for url in webhooks:
+            self._callbacks.submit(self._fire_callback, url)
+
+    def _loop(self):
+        last_payment = 0
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.time():
+                    timeout = self._due[0][0] - time.time() \
+                        if self._due else None
+                    self._cond.wait(timeout)
+                _, lid = heapq.heappop(self._due)
+
+            # Rate limit
+            wait = last_payment + self.min_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            last_payment = time.time()
+            self.pay(lid)
+
+
+def create_app(payer, api_delay):
+    app = Flask(__name__)
+
+    @app.before_request
+    def simulate_latency():
+        time.sleep(api_delay())
+
+    @app.route('/invoice', methods=['POST'])
+    def new_invoice():
+        args = request.get_json(force=True)
+        now = time.time()
+        lid = hashlib.sha256(os.urandom(32)).hexdigest()[:21]
+        invoice = {
+            'id': lid,
+            'msatoshi': str(args['msatoshi']),
+            'description': args.get('description'),
+            'rhash': hashlib.sha256(lid.encode()).hexdigest(),
+            'payreq': f"lntb{args['msatoshi']}fake{lid}",
+            'expires_at': int(now + args.get('expiry', 3600)),
+            'created_at': int(now),
+            'metadata': args.get('metadata'),
+            'status': 'unpaid',
+            'webhooks': []
+        }
+        payer.add_invoice(invoice)
+        return dump_invoice(invoice), HTTPStatus.CREATED
+
+    @app.route('/invoice/<lid>', methods=['GET'])
+    def get_invoice(lid):
+        if lid not in payer.invoices:
+            return {'error': 'invoice not found'}, HTTPStatus.NOT_FOUND
+        return dump_invoice(payer.invoices[lid]), HTTPStatus.OK
+
+    @app.route('/invoice/<lid>/webhook', methods=['POST'])
+    def register_webhook(lid):
+        if lid not in payer.invoices:
+            return {'error': 'invoice not found'}, HTTPStatus.NOT_FOUND
+        payer.add_webhook(lid, request.get_json(force=True)['url'])
+        return {}, HTTPStatus.CREATED
+
+    @app.route('/info', methods=['GET'])
+    def info():
+        return {
+            'id': '02' + hashlib.sha256(b'fake-charge').hexdigest(),
+            'alias': 'fake-charge',
+            'network': 'regtest',
+            'version': 'fake',
+            'blockheight': 1,
+            'address': []
+        }, HTTPStatus.OK
+
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        return {**payer.stats, 'invoices': len(payer.invoices)}, HTTPStatus.OK
+
+    @app.route('/payment-stream', methods=['GET'])
+    def payment_stream():
+        q = payer.subscribe()
+
+        def events():
+            try:
+                yield ':connected\n\n'
+                while True:
+                    try:
+                        invoice = q.get(timeout=15)
+                    except queue.Empty:
+                        yield ':keepalive\n\n'
+                        continue
+                    yield f"data:{json.dumps(dump_invoice(invoice))}\n\n"
+            finally:
+                payer.unsubscribe(q)
+
+        return Response(events(), mimetype='text/event-stream')
+
+    return app
+
+
+def dump_invoice(invoice):
+    return {k: v for k, v in invoice.items() if k != 'webhooks'}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1', help='Bind address')
+    parser.add_argument('--port', type=int, default=9112, help='Port')
+    parser.add_argument('--pay-delay',
+                        type=parse_delay,
+                        default='exp:0.5',
+                        help='Distribution of the delay between the '
+                        'creation of an invoice and its payment')
+    parser.add_argument('--rate',
+                        type=float,
+                        default=0,
+                        help='Maximum payments per second (0 for no limit)')
+    parser.add_argument('--pay-ratio',
+                        type=float,
+                        default=1,
+                        help='Fraction of the invoices that get paid')
+    parser.add_argument('--api-delay',
+                        type=parse_delay,
+                        default='const:0',
+                        help='Distribution of the response delay of the '
+                        'API endpoints')
+    parser.add_argument('--callback-workers',
+                        type=int,
+                        default=8,
+                        help='Number of threads firing the payment callbacks')
+    parser.add_argument('--callback-retries',
+                        type=int,
+                        default=5,
+                        help='Maximum number of retries per payment callback')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    payer = Payer(args.pay_delay, args.rate, args.pay_ratio,
+                  args.callback_workers, args.callback_retries)
+    payer.start()
+    app = create_app(payer, args.api_delay)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
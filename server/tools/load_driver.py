@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Load driver for the Satellite API
+
+Places orders on the API server at a given rate, optionally bumps them, and
+tracks them until their transmissions start. Meant to run against an API
+server backed by the Lightning Charge stand-in (see fake_charge.py), which
+pays the invoices and fires the payment callbacks, so that the full
+upload-pay-transmit pipeline can be benchmarked on a single machine.
+
+Since there is no transmitter in this setup, the driver can also play the
+role of the Tx hosts (see --confirm) and confirm the transmission of each
+order as soon as it starts, which unblocks the next transmission.
+
+Example:
+
+    python3 tools/load_driver.py --orders 500 --rate 25 --confirm
+
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http import HTTPStatus
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+# Region numbers (see regions.Regions), confirmed for orders without regions
+ALL_REGIONS = list(range(6))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of values"""
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(values))))
+    return values[rank - 1]
+
+
+def to_timestamp(iso_datetime):
+    """Convert an API timestamp (naive UTC in ISO format) to Unix time"""
+    return datetime.fromisoformat(iso_datetime).replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+class LoadDriver:
+
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency +
+                                                1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.orders = []
+        self.errors = []
+        self.latency = {'upload': [], 'bump': []}
+        self._lock = threading.Lock()
+
+    def _record(self, key, value):
+        with self._lock:
+            self.latency[key].append(value)
+
+    def _error(self, what, response):
+        with self._lock:
+            self.errors.append(what)
+        logging.warning(f"{what} failed: {response.status_code} "
+                        f"{response.text.strip()}")
+
+    def get_min_bid(self):
+        rv = self.session.get(f"{self.args.api}/order/quote",
+                              params={
+                                  'size': self.args.size,
+                                  'channel': self.args.channel
+                              })
+        rv.raise_for_status()
+        return rv.json()['min_bid']
+
+    def place_order(self, bid):
+        data = {'bid': bid, 'channel': self.args.channel}
+        files = {'file': ('load_test', os.urandom(self.args.size))}
+        t_start = time.monotonic()
+        rv = self.session.post(f"{self.args.api}/order",
+                               data=data,
+                               files=files)
+        self._record('upload', time.monotonic() - t_start)
+        if rv.status_code != HTTPStatus.OK:
+            self._error('upload', rv)
+            return
+
+        resp = rv.json()
+        order = {
+            'uuid': resp['uuid'],
+            'auth_token': resp['auth_token'],
+            'lid': resp['lightning_invoice']['id'],
+            'uploaded_at': time.time()
+        }
+        for _ in range(self.args.bumps):
+            t_start = time.monotonic()
+            rv = self.session.post(
+                f"{self.args.api}/order/{order['uuid']}/bump",
+                data={'bid_increase': self.args.bump_increase},
+                headers={'X-Auth-Token': order['auth_token']})
+            self._record('bump', time.monotonic() - t_start)
+            if rv.status_code != HTTPStatus.OK:
+                self._error('bump', rv)
+
+        with self._lock:
+            self.orders.append(order)
+
+    def submit(self):
+        """Place the orders at the configured rate"""
+        bid = int(self.get_min_bid() * self.args.bid_factor)
+        interval = 1 / self.args.rate if self.args.rate > 0 else 0
+        t_start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for i in range(self.args.orders):
+                # Open-loop arrivals, independent of the response times
+                delay = t_start + i * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(self.place_order, bid)
+        return time.monotonic() - t_start
+
+    def confirm_tx(self, order, regions):
+        rv = self.session.post(
+            f"{self.args.api}/order/tx/{order['tx_seq_num']}",
+            data={'regions': json.dumps(regions or ALL_REGIONS)})
+        if rv.status_code != HTTPStatus.OK:
+            self._error('tx confirmation', rv)
+
+    def track(self, submitting):
+        """Poll the orders until their transmissions start (or end)
+
+        The orders are tracked while being placed, so that their
+        transmissions can be confirmed right away (see --confirm).
+
+        Args:
+            submitting (threading.Event): Set while orders are being placed.
+
+        Returns:
+            List of orders that did not reach the final state in time.
+
+        """
+        final_states = ['sent', 'received'] if self.args.confirm else \
+            ['transmitting', 'confirming', 'sent', 'received']
+        deadline = None
+        while True:
+            with self._lock:
+                tracked = [x for x in self.orders if 'ended_at' not in x]
+            if not submitting.is_set():
+                if not tracked:
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.args.timeout
+                elif time.monotonic() > deadline:
+                    break
+
+            for order in tracked:
+                rv = self.session.get(
+                    f"{self.args.api}/order/{order['uuid']}",
+                    headers={'X-Auth-Token': order['auth_token']})
+                if rv.status_code != HTTPStatus.OK:
+                    self._error('order lookup', rv)
+                    continue
+
+                resp = rv.json()
+                if resp['started_transmission_at'] is not None and \
+                        'started_at' not in order:
+                    order['started_at'] = to_timestamp(
+                        resp['started_transmission_at'])
+                    order['tx_seq_num'] = resp['tx_seq_num']
+                    if self.args.confirm:
+                        self.confirm_tx(order, resp['regions'])
+
+                if resp['status'] in final_states:
+                    order['ended_at'] = time.time()
+
+            time.sleep(self.args.poll_interval)
+        return tracked
+
+    def fetch_payment_times(self):
+        for order in self.orders:
+            if 'started_at' not in order:
+                continue
+            rv = self.session.get(f"{self.args.charge}/invoice/{order['lid']}")
+            if rv.status_code == HTTPStatus.OK and rv.json().get('paid_at'):
+                order['paid_at'] = float(rv.json()['paid_at'])
+
+    def report(self, submit_time, pending):
+        started = [x for x in self.orders if 'started_at' in x]
+        pay_to_tx = [
+            x['started_at'] - x['paid_at'] for x in started if 'paid_at' in x
+        ]
+        print(f"Orders placed: {len(self.orders)}/{self.args.orders} "
+              f"in {submit_time:.1f} s")
+        print(f"Transmissions started: {len(started)}")
+        print(f"Orders left pending: {len(pending)}")
+        print(f"Errors: {len(self.errors)}")
+        if started:
+            span = max(x['started_at'] for x in started) - \
+                min(x['uploaded_at'] for x in started)
+            print(f"Throughput: {len(started) / max(span, 1e-3):.2f} "
+                  "transmissions/s")
+
+        print(f"{'latency (ms)':<16}{'n':>6}{'p50':>10}{'p90':>10}"
+              f"{'p99':>10}{'max':>10}")
+        for name, values in [('upload', self.latency['upload']),
+                             ('bump', self.latency['bump']),
+                             ('pay-to-tx', pay_to_tx)]:
+            if not values:
+                continue
+            stats = [percentile(values, p) for p in (50, 90, 99, 100)]
+            print(f"{name:<16}{len(values):>6}" + ''.join(f"{1e3 * x:>10.1f}"
+                                                          for x in stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--api',
+                        default='http://127.0.0.1:9292',
+                        help='API server root URL')
+    parser.add_argument('--charge',
+                        default='http://127.0.0.1:9112',
+                        help='Lightning Charge stand-in root URL, used to '
+                        'fetch the payment timestamps')
+    parser.add_argument('--orders',
+                        type=int,
+                        default=100,
+                        help='Number of orders')
+    parser.add_argument('--rate',
+                        type=float,
+                        default=10,
+                        help='Orders per second (0 for no limit)')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='Maximum number of concurrent uploads')
+    parser.add_argument('--size',
+                        type=int,
+                        default=1024,
+                        help='Message size in bytes')
+    parser.add_argument('--channel',
+                        type=int,
+                        default=1,
+                        help='Logical channel')
+    parser.add_argument('--bid-factor',
+                        type=float,
+                        default=1,
+                        help='Bid as a multiple of the minimum bid')
+    parser.add_argument('--bumps',
+                        type=int,
+                        default=0,
+                        help='Number of bid bumps per order')
+    parser.add_argument('--bump-increase',
+                        type=int,
+                        default=1000,
+                        help='Bid increase per bump in millisatoshis')
+    parser.add_argument('--confirm',
+                        default=False,
+                        action='store_true',
+                        help='Confirm the transmissions on behalf of the Tx '
+                        'hosts and track the orders until sent')
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=0.2,
+                        help='Interval between order status polls in seconds')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=300,
+                        help='Maximum time to wait for the transmissions')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    driver = LoadDriver(args)
+    submitting = threading.Event()
+    submitting.set()
+    with ThreadPoolExecutor(max_workers=1) as tracker:
+        pending = tracker.submit(driver.track, submitting)
+        try:
+            submit_time = driver.submit()
+        finally:
+            submitting.clear()
+        pending = pending.result()
+    driver.fetch_payment_times()
+    driver.report(submit_time, pending)
+
+
+if __name__ == '__main__':
+    main()
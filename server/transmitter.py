@@ -1,26 +1,67 @@
+from contextlib import contextmanager
 import json
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 from flask import current_app
-from sqlalchemy import and_
+from flask_restful import Resource
+from redis.exceptions import RedisError
+from sqlalchemy import and_, func
+from sqlalchemy.exc import IntegrityError
 
+from bidding import calc_ota_msg_len
 import constants
 import order_helpers
+import scheduler
 from database import db
-from models import Order, TxRetry
+from models import Counter, Order, TxConfirmation, TxRetry
 from regions import region_code_to_number_list
 from schemas import order_schema
 
+TX_SEQ_NUM_COUNTER = 'tx_seq_num'
+TX_LOCK = 'tx_lock:{}'
+CARRIER = 'carrier'
+TX_LOCK_STATS = 'tx_lock_stats:{}'
+# Upper bounds of the lock wait time histogram buckets in seconds
+TX_LOCK_WAIT_BUCKETS = [0.001, 0.01, 0.1, 1, 10]
+
+
+def next_tx_seq_num():
+    """Allocate the next Tx sequence number
+
+    Increment the sequence number counter with a single UPDATE statement,
+    which holds the database write lock until the end of the transaction.
+    Hence, concurrent callers (e.g., on different gunicorn workers) are
+    serialized and get distinct sequence numbers. The caller must commit the
+    transaction to release the lock.
+
+    On the first allocation, the counter is created with the highest sequence
+    number assigned so far.
+
+    """
+    while True:
+        n_updated = Counter.query.filter_by(name=TX_SEQ_NUM_COUNTER).update(
+            {Counter.value: Counter.value + 1}, synchronize_session=False)
+        if n_updated == 1:
+            return db.session.query(
+                Counter.value).filter_by(name=TX_SEQ_NUM_COUNTER).scalar()
+
+        last_tx_seq_num = db.session.query(func.max(
+            Order.tx_seq_num)).scalar() or 0
+        try:
+            db.session.add(
+                Counter(name=TX_SEQ_NUM_COUNTER, value=last_tx_seq_num + 1))
+            db.session.flush()
+            return last_tx_seq_num + 1
+        except IntegrityError:
+            # Created concurrently by another caller. Increment it instead.
+            db.session.rollback()
+
 
 def assign_tx_seq_num(order):
     """Assign Tx sequence number to order"""
-    last_tx_order = Order.query.order_by(Order.tx_seq_num.desc()).first()
-
-    if last_tx_order.tx_seq_num:
-        order.tx_seq_num = last_tx_order.tx_seq_num + 1
-    else:
-        order.tx_seq_num = 1
+    order.tx_seq_num = next_tx_seq_num()
     db.session.commit()
 
 
@@ -41,46 +82,246 @@ def publish_to_sse_server(order, retransmit_info=None):
     return
 
 
+def record_lock_wait(channel, wait, acquired):
+    """Record the time waited for the transmission lock of a channel
+
+    The statistics are kept on Redis so that they aggregate the waits of all
+    processes (see get_lock_stats).
+
+    """
+    key = TX_LOCK_STATS.format(channel)
+    try:
+        pipe = redis().pipeline(transaction=False)
+        pipe.hincrby(key, 'acquired' if acquired else 'timeouts', 1)
+        pipe.hincrbyfloat(key, 'wait_secs', wait)
+        for bucket in TX_LOCK_WAIT_BUCKETS:
+            if wait <= bucket:
+                pipe.hincrby(key, f'wait_le_{bucket}', 1)
+        pipe.execute()
+    except RedisError as e:
+        logging.warning(f'failed to record the tx lock wait: {e}')
+
+
+def get_lock_stats():
+    """Get the transmission lock wait statistics of each channel
+
+    Returns:
+        Dictionary with the number of lock acquisitions and timeouts, the
+        total and mean wait times, and the cumulative histogram of the wait
+        times of each channel, or of the carrier lock when the channels share
+        the carrier.
+
+    """
+    res = {}
+    if constants.CARRIER_SCHEDULING == 'drr':
+        locks = [(CARRIER, CARRIER)]
+    else:
+        locks = [(x, constants.CHANNEL_INFO[x].name)
+                 for x in constants.CHANNELS]
+    for channel, name in locks:
+        stats = {
+            k.decode(): float(v)
+            for k, v in redis().hgetall(TX_LOCK_STATS.format(channel)).items()
+        }
+        n_waits = stats.get('acquired', 0) + stats.get('timeouts', 0)
+        histogram = {
+            str(bucket): int(stats.get(f'wait_le_{bucket}', 0))
+            for bucket in TX_LOCK_WAIT_BUCKETS
+        }
+        histogram['+Inf'] = int(n_waits)
+        res[name] = {
+            'acquired': int(stats.get('acquired', 0)),
+            'timeouts': int(stats.get('timeouts', 0)),
+            'wait_secs': stats.get('wait_secs', 0),
+            'mean_wait_secs':
+            stats.get('wait_secs', 0) / n_waits if n_waits else 0,
+            'wait_histogram': histogram
+        }
+    return res
+
+
+@contextmanager
+def channel_lock(channel):
+    """Critical section for the transmission start on a channel
+
+    Serializes the transmission starts on a channel across all processes
+    (gunicorn workers and worker manager) with a Redis lock, so that the
+    check for an ongoing transmission and the start of the next one happen
+    atomically. The lock has a lease (TX_LOCK_LEASE_SECS) so that a crashed
+    holder does not block the channel forever.
+
+    When the channels share the carrier (CARRIER_SCHEDULING set to 'drr'),
+    the transmission starts on all channels share a single lock instead.
+
+    Yields:
+        Boolean indicating whether the lock was acquired. If the lock could
+        not be acquired in time (TX_LOCK_TIMEOUT_SECS), another process is
+        starting a transmission on the channel, so the caller can give up.
+        If Redis is unavailable, the caller proceeds without the lock.
+
+    """
+    if constants.CARRIER_SCHEDULING == 'drr':
+        channel = CARRIER
+    lock = redis().lock(TX_LOCK.format(channel),
+                        timeout=constants.TX_LOCK_LEASE_SECS,
+                        blocking_timeout=constants.TX_LOCK_TIMEOUT_SECS)
+    t_start = time.monotonic()
+    try:
+        acquired = lock.acquire()
+    except RedisError as e:
+        logging.warning(f'failed to acquire the tx lock: {e}')
+        yield True
+        return
+
+    record_lock_wait(channel, time.monotonic() - t_start, acquired)
+    if not acquired:
+        logging.warning(f'timed out waiting for the tx lock of channel '
+                        f'{channel}')
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        try:
+            lock.release()
+        except RedisError as e:
+            # The lease expired and another process may hold the lock now
+            logging.warning(f'failed to release the tx lock: {e}')
+
+
 def tx_start(channel=None):
     """Look for pending transmissions and serve them
 
     An order is ready for transmission when already paid or when being
-    retransmitted. Also, a pending transmission can only be served if there is
-    no other ongoing transmission on the logical channel. Each channel can only
-    serve one transmission at a time.
+    retransmitted. Also, a pending transmission can only be served if the
+    number of ongoing transmissions on the logical channel is below the
+    channel's in-flight window (max_inflight), which, by default, allows a
+    single transmission at a time. This rule holds across processes, as the
+    transmission start on each channel runs under a lock (see channel_lock).
 
     This function works both for a single defined channel or for all channels.
     When the channel parameter is undefined, it looks for pending transmissions
-    in all channels. Otherwise, it processes the specified channel only.
+    in all channels. Otherwise, it processes the specified channel only,
+    unless the channels share the carrier (see _dispatch_carrier), in which
+    case all channels are processed regardless.
 
     Args:
         channel (int, optional): Logical transmission channel to serve.
             Defaults to None.
 
     """
+    # When the channels share the carrier, a transmission ending on any
+    # channel can free the carrier for any other channel
+    if constants.CARRIER_SCHEDULING == 'drr':
+        with channel_lock(channel) as locked:
+            if locked:
+                _dispatch_carrier()
+        return
+
     # Call itself recursively if the channel is not defined
     if (channel is None):
         for channel in constants.CHANNELS:
             tx_start(channel)
         return
 
-    transmitting_orders = Order.query.filter(
+    with channel_lock(channel) as locked:
+        if locked:
+            _tx_start(channel)
+
+
+def _tx_start(channel):
+    # Keep up to "max_inflight" orders in transmitting state on the channel,
+    # i.e., published to the Tx hosts but not confirmed by any of them yet, so
+    # that the Tx hosts have the next messages queued when the current one
+    # ends. With a window of one, do not start a new transmission while
+    # another order is being transmitted.
+    n_transmitting = Order.query.filter(
         and_(Order.status == constants.OrderStatus.transmitting.value,
-             Order.channel == channel)).all()
+             Order.channel == channel)).count()
 
-    # Do not start a new transmission if another order is being transmitted
-    # right now
-    if len(transmitting_orders) > 0:
-        return
+    while n_transmitting < constants.CHANNEL_INFO[channel].max_inflight:
+        if not _start_next_transmission(channel):
+            break
+        n_transmitting += 1
+
+
+def _next_ota_msg_len(channel):
+    """Over-the-air length of the next order to transmit on a channel
+
+    Returns:
+        The length in bytes or None if there is no order to transmit.
+
+    """
+    try:
+        order = scheduler.next_order(channel) or \
+            scheduler.next_retransmission(channel)[0]
+    except scheduler.SchedulerUnavailable:
+        order = Order.query.filter(
+            and_(Order.status == constants.OrderStatus.paid.value,
+                 Order.channel == channel)).order_by(
+                     Order.bid_per_byte.desc()).first() or \
+            order_helpers.get_next_retransmission(channel)[0]
+    return calc_ota_msg_len(order.message_size) if order else None
 
-    # First, try to find a paid order with the highest bid in the orders table
-    # and start its transmission. If no paid orders are found there, look into
-    # the tx_retries table and retransmit one of the orders from there if it
-    # meets the retransmission criteria
-    order = Order.query.filter(
-        and_(Order.status == constants.OrderStatus.paid.value,
-             Order.channel == channel)).order_by(
-                 Order.bid_per_byte.desc()).first()
+
+def _dispatch_carrier():
+    """Start transmissions on the channels sharing the carrier
+
+    Keep up to CARRIER_MAX_INFLIGHT orders in transmitting state across all
+    channels, still subject to the in-flight window of each channel, and
+    pick the channel of each transmission with deficit round-robin (see
+    scheduler.drr_pick). Thus, a channel with a large backlog (e.g., a long
+    push on the btc-src channel) gets its share of the carrier without
+    starving the others, while the capacity left by idle channels goes to the
+    busy ones.
+
+    """
+    n_transmitting = dict(
+        db.session.query(Order.channel, func.count(Order.id)).filter(
+            Order.status == constants.OrderStatus.transmitting.value).group_by(
+                Order.channel).all())
+    state = scheduler.load_drr_state()
+
+    while sum(n_transmitting.values()) < constants.CARRIER_MAX_INFLIGHT:
+        heads = {}
+        idle = set()
+        for channel in constants.CHANNELS:
+            msg_len = _next_ota_msg_len(channel)
+            if msg_len is None:
+                idle.add(channel)
+            elif n_transmitting.get(channel, 0) < \
+                    constants.CHANNEL_INFO[channel].max_inflight:
+                heads[channel] = msg_len
+
+        channel = scheduler.drr_pick(heads, idle, state)
+        if channel is None or not _start_next_transmission(channel):
+            break
+        n_transmitting[channel] = n_transmitting.get(channel, 0) + 1
+
+    scheduler.save_drr_state(state)
+
+
+def _start_next_transmission(channel):
+    """Start the next transmission on a channel
+
+    Returns:
+        Boolean indicating whether a transmission was started.
+
+    """
+    # First, try to find a paid order with the highest bid and start its
+    # transmission. If no paid orders are found, look for orders pending
+    # retransmission and retransmit the one with the highest bid. Both are
+    # picked from the scheduler queues, unless these are unavailable, in which
+    # case fall back to querying the database.
+    try:
+        order = scheduler.next_order(channel)
+    except scheduler.SchedulerUnavailable as e:
+        logging.warning(f'scheduler unavailable: {e}')
+        order = Order.query.filter(
+            and_(Order.status == constants.OrderStatus.paid.value,
+                 Order.channel == channel)).order_by(
+                     Order.bid_per_byte.desc()).first()
 
     if order:
         logging.info(f'transmission start {order.uuid}')
@@ -88,19 +329,141 @@ def tx_start(channel=None):
         order.status = constants.OrderStatus.transmitting.value
         order.started_transmission_at = datetime.utcnow()
         db.session.commit()
+        scheduler.remove(order)
+        order_helpers.schedule_retransmission(order)
         publish_to_sse_server(order)
-    else:
-        # No order found for the first transmission.
-        # Check if any order requires retransmission.
+        return True
+
+    # No order found for the first transmission.
+    # Check if any order requires retransmission.
+    try:
+        order, retransmit_info = scheduler.next_retransmission(channel)
+    except scheduler.SchedulerUnavailable:
         order, retransmit_info = order_helpers.get_next_retransmission(channel)
-        if order and retransmit_info:
-            logging.info(f'retransmission start {order.uuid}')
-            order.status = constants.OrderStatus.transmitting.value
-            retransmit_info.retry_count += 1
-            retransmit_info.last_attempt = datetime.utcnow()
-            retransmit_info.pending = False
-            db.session.commit()
-            publish_to_sse_server(order, retransmit_info)
+    if order and retransmit_info:
+        logging.info(f'retransmission start {order.uuid}')
+        order.status = constants.OrderStatus.transmitting.value
+        retransmit_info.retry_count += 1
+        retransmit_info.last_attempt = datetime.utcnow()
+        retransmit_info.pending = False
+        db.session.commit()
+        scheduler.remove(order)
+        order_helpers.schedule_retransmission(order)
+        publish_to_sse_server(order, retransmit_info)
+        return True
+
+    return False
+
+
+def predict_end_of_transmissions(channel):
+    """Predict when the ongoing transmissions of a channel end
+
+    Assume the Tx hosts serialize the orders in transmitting state one after
+    the other, in the order in which they were published, at the channel's
+    nominal transmit rate. An order is published when its transmission starts
+    or, in case of a retransmission, when its last retransmission starts. The
+    first of them starts serializing once the order published before it is
+    serialized, which is known as soon as the Tx confirmations of the latter
+    arrive, or when published, whichever comes later.
+
+    Returns:
+        The predicted end (naive UTC datetime) or None if there is no
+        ongoing transmission on the channel.
+
+    """
+    rows = db.session.query(Order, TxRetry.last_attempt).outerjoin(
+        TxRetry, TxRetry.order_id == Order.id).filter(
+            and_(Order.status == constants.OrderStatus.transmitting.value,
+                 Order.channel == channel)).all()
+    if not rows:
+        return None
+
+    inflight = sorted(
+        ((last_attempt
+          or order.started_transmission_at, order.tx_seq_num, order)
+         for order, last_attempt in rows),
+        key=lambda x: x[:2])
+    t_first = inflight[0][0]
+    inflight_ids = [order.id for _, _, order in inflight]
+
+    # The order published before the first in-flight order is either the
+    # last one transmitted before it or the last one retransmitted before it
+    candidates = []
+    prev_order = Order.query.filter(
+        and_(Order.channel == channel, Order.id.notin_(inflight_ids),
+             Order.started_transmission_at
+             < t_first)).order_by(Order.tx_seq_num.desc()).first()
+    if prev_order is not None:
+        candidates.append((prev_order.started_transmission_at, prev_order))
+    prev_retry = db.session.query(Order, TxRetry.last_attempt).filter(
+        and_(TxRetry.order_id == Order.id, Order.channel == channel,
+             Order.id.notin_(inflight_ids), TxRetry.last_attempt
+             < t_first)).order_by(TxRetry.last_attempt.desc()).first()
+    if prev_retry is not None:
+        candidates.append((prev_retry[1], prev_retry[0]))
+
+    t_free = None
+    if candidates:
+        prev_order = max(candidates, key=lambda x: x[0])[1]
+        t_free = db.session.query(func.max(TxConfirmation.created_at)).filter(
+            TxConfirmation.order_id == prev_order.id).scalar()
+
+    tx_rate = constants.CHANNEL_INFO[channel].tx_rate
+    for t_published, _, order in inflight:
+        t_start = t_published if t_free is None else max(t_free, t_published)
+        t_free = t_start + timedelta(
+            seconds=calc_ota_msg_len(order.message_size) / tx_rate)
+    return t_free
+
+
+def prestage(channel=None):
+    """Pre-stage the next transmission shortly before the current one ends
+
+    On channels with a pre-staging lead time (see ChannelInfo.prestage_secs),
+    start the next transmission (i.e., publish it to the Tx hosts) once the
+    ongoing transmissions are predicted to end within the lead time, even
+    though these are not confirmed yet. The Tx hosts can then prefetch the
+    next message and transmit it right after the current one. Only one order
+    is pre-staged beyond the channel's in-flight window.
+
+    Args:
+        channel (int, optional): Logical transmission channel. Defaults to
+            None, in which case all channels are processed.
+
+    """
+    if channel is None:
+        for channel in constants.CHANNELS:
+            prestage(channel)
+        return
+
+    # The carrier scheduling decides when to start each transmission when the
+    # channels share the carrier
+    if not constants.CHANNEL_INFO[channel].prestage_secs or \
+            constants.CARRIER_SCHEDULING == 'drr':
+        return
+
+    with channel_lock(channel) as locked:
+        if locked:
+            _prestage(channel)
+
+
+def _prestage(channel):
+    channel_info = constants.CHANNEL_INFO[channel]
+    n_transmitting = Order.query.filter(
+        and_(Order.status == constants.OrderStatus.transmitting.value,
+             Order.channel == channel)).count()
+    # Below the window, tx_start serves the channel. Above it, the next order
+    # is already pre-staged.
+    if n_transmitting != channel_info.max_inflight:
+        return
+
+    t_end = predict_end_of_transmissions(channel)
+    if (t_end - datetime.utcnow()).total_seconds() > \
+            channel_info.prestage_secs:
+        return
+
+    if _start_next_transmission(channel):
+        logging.info(f'pre-staged the next transmission on channel {channel}')
 
 
 def tx_end(order):
@@ -112,6 +475,14 @@ def tx_end(order):
         # Cleanup the TxRetry
         TxRetry.query.filter_by(order_id=order.id).delete()
         db.session.commit()
+        scheduler.remove(order)
+        scheduler.clear_deadline(order.id)
         publish_to_sse_server(order, retransmit_info)
         # Start the next queued order as soon as the current order finishes
         tx_start(order.channel)
+
+
+class TxLockStatsResource(Resource):
+
+    def get(self):
+        return get_lock_stats()
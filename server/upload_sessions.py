@@ -0,0 +1,255 @@
+"""Resumable upload sessions
+
+Messages sent over the admin channels can be much larger than the user
+messages (e.g., up to 16.2 MB on the btc-src channel). Instead of uploading
+them in a single request, an upload session allows for uploading the message
+in chunks, each on its own request, and resuming the upload from the last
+received chunk after a connection drop. Once all chunks are received, the
+session is finalized into an order, validated just like a regular upload.
+
+Each session is stored under UPLOAD_SESSION_PATH as a data file holding the
+chunks received so far, named after the session id, and a JSON metadata file
+(<id>.json) holding the declared message size and channel. The chunks are
+streamed straight into the data file, whose size gives the session's current
+offset. The sessions left inactive for UPLOAD_SESSION_TIMEOUT_SECS are removed
+by the database cleanup worker.
+
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import fcntl
+from http import HTTPStatus
+import json
+import os
+import time
+import uuid
+
+from flask import request
+from flask_restful import Resource
+from marshmallow import ValidationError
+
+from error import get_http_error_resp
+from schemas import upload_session_req_schema, upload_chunk_req_schema, \
+    upload_session_finalize_req_schema
+import constants
+import message_store
+import order_helpers
+import orders
+
+
+def _data_path(session_id):
+    return os.path.join(constants.UPLOAD_SESSION_PATH, session_id)
+
+
+def _meta_path(session_id):
+    return _data_path(session_id) + '.json'
+
+
+def _valid_session_id(session_id):
+    # The session id becomes a file name, so accept canonical UUIDs only
+    try:
+        return str(uuid.UUID(session_id)) == session_id
+    except ValueError:
+        return False
+
+
+def create_session(size, channel):
+    """Create an upload session for a message of given size and channel
+
+    Returns:
+        The session id.
+
+    """
+    session_id = str(uuid.uuid4())
+    os.makedirs(constants.UPLOAD_SESSION_PATH, exist_ok=True)
+    open(_data_path(session_id), 'xb').close()
+    with open(_meta_path(session_id), 'x') as f:
+        json.dump({'size': size, 'channel': channel}, f)
+    return session_id
+
+
+@contextmanager
+def _locked_session(session_id):
+    """Lock the upload session for exclusive access
+
+    Yields:
+        Tuple with the session metadata and its data file opened for reading
+        and writing, or None if the session does not exist.
+
+    """
+    if not _valid_session_id(session_id):
+        yield None
+        return
+
+    try:
+        f = open(_data_path(session_id), 'r+b')
+    except FileNotFoundError:
+        yield None
+        return
+
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # The session could have been finalized or removed while waiting for
+        # the lock, in which case its metadata file is already gone
+        try:
+            with open(_meta_path(session_id)) as meta_f:
+                meta = json.load(meta_f)
+        except FileNotFoundError:
+            yield None
+            return
+        yield meta, f
+
+
+def _remove_session(session_id):
+    for path in [_meta_path(session_id), _data_path(session_id)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _session_info(session_id, meta, data_file):
+    stat = os.fstat(data_file.fileno())
+    expires_at = datetime.utcfromtimestamp(stat.st_mtime) + timedelta(
+        seconds=constants.UPLOAD_SESSION_TIMEOUT_SECS)
+    return {
+        'id': session_id,
+        'size': meta['size'],
+        'channel': meta['channel'],
+        'offset': stat.st_size,
+        'expires_at': expires_at.isoformat(timespec='seconds')
+    }
+
+
+def cleanup_expired_sessions():
+    """Remove the upload sessions left inactive for too long
+
+    Returns:
+        List with the ids of the removed sessions.
+
+    """
+    if not os.path.isdir(constants.UPLOAD_SESSION_PATH):
+        return []
+
+    removed = []
+    deadline = time.time() - constants.UPLOAD_SESSION_TIMEOUT_SECS
+    for name in os.listdir(constants.UPLOAD_SESSION_PATH):
+        session_id = name[:-len('.json')]
+        if not name.endswith('.json') or not _valid_session_id(session_id):
+            continue
+        with _locked_session(session_id) as session:
+            if session is None:
+                continue
+            _, data_file = session
+            if os.fstat(data_file.fileno()).st_mtime < deadline:
+                _remove_session(session_id)
+                removed.append(session_id)
+
+    return removed
+
+
+class UploadSessionsResource(Resource):
+
+    def post(self):
+        try:
+            args = upload_session_req_schema.load(request.form)
+        except ValidationError as error:
+            return error.messages, HTTPStatus.BAD_REQUEST
+
+        error = order_helpers.check_message_size(args['size'], args['channel'])
+        if error:
+            return error
+
+        session_id = create_session(args['size'], args['channel'])
+        with _locked_session(session_id) as (meta, data_file):
+            return _session_info(session_id, meta, data_file)
+
+
+class UploadSessionResource(Resource):
+
+    def get(self, session_id):
+        with _locked_session(session_id) as session:
+            if session is None:
+                return get_http_error_resp('UPLOAD_SESSION_NOT_FOUND',
+                                           session_id)
+            return _session_info(session_id, *session)
+
+    def put(self, session_id):
+        try:
+            args = upload_chunk_req_schema.load(request.args)
+        except ValidationError as error:
+            return error.messages, HTTPStatus.BAD_REQUEST
+
+        if request.content_length is None:
+            return "Content-Length required", HTTPStatus.LENGTH_REQUIRED
+
+        with _locked_session(session_id) as session:
+            if session is None:
+                return get_http_error_resp('UPLOAD_SESSION_NOT_FOUND',
+                                           session_id)
+            meta, data_file = session
+
+            offset = os.fstat(data_file.fileno()).st_size
+            if args['offset'] != offset:
+                return get_http_error_resp('UPLOAD_OFFSET_MISMATCH', offset)
+
+            if offset + request.content_length > meta['size']:
+                return get_http_error_resp('MESSAGE_FILE_TOO_LARGE',
+                                           meta['size'] / (2**20))
+
+            # Stream the chunk into the data file. If the connection drops
+            # midway, the data received so far is kept, and the client can
+            # resume from the resulting offset.
+            data_file.seek(offset)
+            for block in iter(
+                    lambda: request.stream.read(message_store.CHUNK_SIZE),
+                    b''):
+                data_file.write(block)
+            data_file.flush()
+
+            return _session_info(session_id, meta, data_file)
+
+    def post(self, session_id):
+        try:
+            args = upload_session_finalize_req_schema.load(request.form)
+        except ValidationError as error:
+            return error.messages, HTTPStatus.BAD_REQUEST
+
+        with _locked_session(session_id) as session:
+            if session is None:
+                return get_http_error_resp('UPLOAD_SESSION_NOT_FOUND',
+                                           session_id)
+            meta, data_file = session
+
+            offset = os.fstat(data_file.fileno()).st_size
+            if offset != meta['size']:
+                return get_http_error_resp('UPLOAD_INCOMPLETE', offset,
+                                           meta['size'])
+
+            upload = message_store.MessageUpload.from_file(
+                _data_path(session_id), meta['size'])
+            if upload.digest != args['sha256']:
+                # The data cannot be fixed by resuming the upload, so drop the
+                # session altogether
+                upload.close()
+                _remove_session(session_id)
+                return get_http_error_resp('MESSAGE_DIGEST_MISMATCH',
+                                           upload.digest)
+
+            args['channel'] = meta['channel']
+            resp = orders.create_order(upload, args)
+
+            # Keep the session if the order is rejected (e.g., due to an
+            # insufficient bid) so that it can be finalized again
+            if not isinstance(resp, tuple):
+                _remove_session(session_id)
+
+            return resp
+
+    def delete(self, session_id):
+        with _locked_session(session_id) as session:
+            if session is None:
+                return get_http_error_resp('UPLOAD_SESSION_NOT_FOUND',
+                                           session_id)
+            _remove_session(session_id)
+            return {'message': 'upload session removed'}
@@ -1,4 +1,5 @@
 import logging
+import queue
 import time
 
 from flask import Flask
@@ -6,15 +7,27 @@ import redis
 
 import constants
 import invoice_helpers
+import message_store
 import order_helpers
+import payment_stream
+import scheduler
 import transmitter
+import upload_sessions
 from database import db
 from models import TxRetry
 from worker import Worker
 
 ONE_MINUTE = 60
 CLEANUP_DUTY_CYCLE = 5 * ONE_MINUTE  # five minutes
-ORDER_RETRANSMIT_CYCLE_SECONDS = 10
+# The retransmissions are driven by per-order timers checked every second. The
+# periodic scan of all orders awaiting Tx confirmations only resynchronizes the
+# timers, e.g., after Redis was unavailable.
+RETRANSMISSION_TIMER_CYCLE_SECONDS = 1
+ORDER_RETRANSMIT_CYCLE_SECONDS = ONE_MINUTE
+PRESTAGE_CYCLE_SECONDS = 1
+WEBHOOK_REGISTRATION_CYCLE_SECONDS = 1
+PAYMENT_PROCESSING_CYCLE_SECONDS = 1
+PAYMENT_POLLING_CYCLE_SECONDS = 10
 
 
 def cleanup_database(app):
@@ -23,14 +36,77 @@ def cleanup_database(app):
          expired_orders) = invoice_helpers.expire_unpaid_invoices()
         expired_orders.extend(order_helpers.expire_old_pending_orders())
         cleaned_up_orders = order_helpers.cleanup_old_message_files()
+        expired_sessions = upload_sessions.cleanup_expired_sessions()
+        n_stale_uploads = message_store.cleanup_stale_uploads()
+        # Resynchronize the scheduler queues with the database in case any
+        # update was lost (e.g., while Redis was unavailable)
+        scheduler.rebuild()
 
         work = [
-            len(x)
-            for x in [expired_invoices, expired_orders, cleaned_up_orders]
+            len(x) for x in [
+                expired_invoices, expired_orders, cleaned_up_orders,
+                expired_sessions
+            ]
         ]
+        work.append(n_stale_uploads)
         if (any(work)):
             logging.info("Database cleanup: expired {} invoices, "
-                         "{} orders, and removed {} files".format(*work))
+                         "{} orders, and removed {} files, {} upload "
+                         "sessions and {} stale uploads".format(*work))
+
+
+def register_webhooks(app):
+    with app.app_context():
+        registered, paid = invoice_helpers.register_pending_webhooks()
+        if paid:
+            transmitter.tx_start()
+        if registered:
+            logging.info("Registered the webhooks of {} invoices, {} of which "
+                         "were already paid".format(len(registered),
+                                                    len(paid)))
+
+
+def process_payments(app, consumer):
+    """Pay the invoices received on the payment stream since the last call"""
+    lids = []
+    while True:
+        try:
+            lids.append(consumer.paid.get_nowait())
+        except queue.Empty:
+            break
+
+    with app.app_context():
+        for channel in sorted(invoice_helpers.pay_invoices(lids)):
+            transmitter.tx_start(channel)
+
+
+def poll_payments(app, consumer):
+    """Poll the pending invoices when payments may have been missed
+
+    Each call polls a page of the pending invoices (see
+    invoice_helpers.poll_paid_invoices), and successive calls go through all
+    of them.
+
+    """
+    if not consumer.missed_payments and consumer.poll_cursor is None:
+        return
+
+    if consumer.poll_cursor is None:
+        # Once connected, a full pass over the pending invoices catches up
+        # with the payments missed so far. If disconnected again in the
+        # meantime, another pass follows.
+        if consumer.connected:
+            consumer.missed_payments = False
+        consumer.poll_cursor = 0
+
+    with app.app_context():
+        lids, consumer.poll_cursor = invoice_helpers.poll_paid_invoices(
+            consumer.poll_cursor)
+        channels = invoice_helpers.pay_invoices(lids)
+        for channel in sorted(channels):
+            transmitter.tx_start(channel)
+        if lids:
+            logging.info(f"Polling found {len(lids)} paid invoices")
 
 
 def retry_transmission(app):
@@ -41,6 +117,22 @@ def retry_transmission(app):
             transmitter.tx_start()
 
 
+def fire_retransmission_timers(app):
+    with app.app_context():
+        try:
+            orders = order_helpers.process_retransmission_deadlines()
+        except scheduler.SchedulerUnavailable as e:
+            logging.warning(f'retransmission timers unavailable: {e}')
+            return
+        for channel in sorted(set(order.channel for order in orders)):
+            transmitter.tx_start(channel)
+
+
+def prestage_transmissions(app):
+    with app.app_context():
+        transmitter.prestage()
+
+
 def start_workers(app):
     cleanup_worker = Worker(period=CLEANUP_DUTY_CYCLE,
                             fcn=cleanup_database,
@@ -52,8 +144,62 @@ def start_workers(app):
                           args=(app, ),
                           name="order retransmission")
 
+    timer_worker = Worker(period=RETRANSMISSION_TIMER_CYCLE_SECONDS,
+                          fcn=fire_retransmission_timers,
+                          args=(app, ),
+                          name="retransmission timers")
+
+    # Publish the next transmission shortly before the current one ends on the
+    # channels configured for pre-staging
+    prestage_enabled = any(x.prestage_secs > 0
+                           for x in constants.CHANNEL_INFO.values())
+    if prestage_enabled:
+        prestage_worker = Worker(period=PRESTAGE_CYCLE_SECONDS,
+                                 fcn=prestage_transmissions,
+                                 args=(app, ),
+                                 name="transmission pre-staging")
+
+    # Register the invoice webhooks deferred by the API server and retry the
+    # failed registrations
+    if constants.LN_WEBHOOK_REGISTRATION == 'async':
+        webhook_worker = Worker(period=WEBHOOK_REGISTRATION_CYCLE_SECONDS,
+                                fcn=register_webhooks,
+                                args=(app, ),
+                                name="webhook registration")
+
+    # Consume the payments from the Lightning Charge payment stream instead of
+    # the webhook callbacks. Fall back to polling while disconnected.
+    if constants.LN_WEBHOOK_REGISTRATION == 'none':
+        consumer = payment_stream.PaymentStreamConsumer()
+        consumer.start()
+        payment_worker = Worker(period=PAYMENT_PROCESSING_CYCLE_SECONDS,
+                                fcn=process_payments,
+                                args=(app, consumer),
+                                name="payment processing")
+        polling_worker = Worker(period=PAYMENT_POLLING_CYCLE_SECONDS,
+                                fcn=poll_payments,
+                                args=(app, consumer),
+                                name="payment polling")
+
+    # Migrate the message files stored with a legacy layout in the background
+    # while the API keeps serving them. After the first run, the migration
+    # becomes a cheap no-op unless new legacy files show up.
+    migration_worker = Worker(period=CLEANUP_DUTY_CYCLE,
+                              fcn=message_store.migrate_legacy_files,
+                              args=(),
+                              name="message store migration")
+
     cleanup_worker.thread.join()
     retry_worker.thread.join()
+    timer_worker.thread.join()
+    migration_worker.thread.join()
+    if prestage_enabled:
+        prestage_worker.thread.join()
+    if constants.LN_WEBHOOK_REGISTRATION == 'async':
+        webhook_worker.thread.join()
+    if constants.LN_WEBHOOK_REGISTRATION == 'none':
+        payment_worker.thread.join()
+        polling_worker.thread.join()
 
 
 def create_app():
@@ -75,6 +221,7 @@ def main():
         # instead. Also, wait a bit before calling tx_start so that clients
         # have enough time to reconnect to the SSE server.
         time.sleep(3)
+        scheduler.rebuild()
         transmitter.tx_start()
         start_workers(app)
 